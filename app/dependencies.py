@@ -6,9 +6,46 @@ def get_env_vars():
     cbioportal_url = os.getenv('CBIOPORTAL_URL')
     galaxy_url = os.getenv('GALAXY_URL')
     xnat_url = os.getenv('XNAT_URL', None)
+    xnat_timeout = os.getenv('XNAT_TIMEOUT', '30')
+    xnat_cache_ttl = os.getenv('XNAT_CACHE_TTL', '600')
     api_key = os.getenv('CBIOPORTAL_CACHE_API_KEY')
     galaxy_workflow_name = os.getenv('GALAXY_WORKFLOW_NAME', None)
     image_upload_directory = os.getenv('IMAGE_UPLOAD_DIRECTORY', '/uploaded_images')
+    image_max_upload_size = os.getenv('IMAGE_MAX_UPLOAD_SIZE', str(100 * 1024 * 1024))
+    image_cache_max_age = os.getenv('IMAGE_CACHE_MAX_AGE', '3600')
+    image_stat_cache_ttl = os.getenv('IMAGE_STAT_CACHE_TTL', '2')
+    image_variant_directory = os.getenv('IMAGE_VARIANT_DIRECTORY', None)
+    image_variant_cache_size = os.getenv('IMAGE_VARIANT_CACHE_SIZE', str(1024 * 1024 * 1024))
+    image_variant_max_dimension = os.getenv('IMAGE_VARIANT_MAX_DIMENSION', '4096')
+    image_variant_workers = os.getenv('IMAGE_VARIANT_WORKERS', '2')
+    image_bulk_upload_workers = os.getenv('IMAGE_BULK_UPLOAD_WORKERS', '4')
+    import_max_workers = os.getenv('IMPORT_MAX_WORKERS', '2')
+    import_coalesce_window = os.getenv('IMPORT_COALESCE_WINDOW', '5')
+    import_incremental = os.getenv('IMPORT_INCREMENTAL', 'true')
+    galaxy_client_cache_ttl = os.getenv('GALAXY_CLIENT_CACHE_TTL', '600')
+    galaxy_client_cache_size = os.getenv('GALAXY_CLIENT_CACHE_SIZE', '128')
+    galaxy_pool_size = os.getenv('GALAXY_POOL_SIZE', '10')
+    galaxy_max_retries = os.getenv('GALAXY_MAX_RETRIES', '5')
+    galaxy_retry_delay = os.getenv('GALAXY_RETRY_DELAY', '0.5')
+    galaxy_circuit_breaker_threshold = os.getenv('GALAXY_CIRCUIT_BREAKER_THRESHOLD', '5')
+    galaxy_health_probe_interval = os.getenv('GALAXY_HEALTH_PROBE_INTERVAL', '10')
+    galaxy_dataset_timeout = os.getenv('GALAXY_DATASET_TIMEOUT', '120')
+    galaxy_metadata_cache_ttl = os.getenv('GALAXY_METADATA_CACHE_TTL', '300')
+    galaxy_upload_compress_threshold = os.getenv('GALAXY_UPLOAD_COMPRESS_THRESHOLD', str(10 * 1024 * 1024))
+    export_max_body_size = os.getenv('EXPORT_MAX_BODY_SIZE', str(1024 * 1024 * 1024))
+    galaxy_upload_workers = os.getenv('GALAXY_UPLOAD_WORKERS', '4')
+    galaxy_workflow_batch_workers = os.getenv('GALAXY_WORKFLOW_BATCH_WORKERS', '2')
+    cbioportal_timeout = os.getenv('CBIOPORTAL_TIMEOUT', '30')
+    importer_workers = os.getenv('IMPORTER_WORKERS', import_max_workers)
+    importer_worker_max_jobs = os.getenv('IMPORTER_WORKER_MAX_JOBS', '50')
+    cbioportal_max_retries = os.getenv('CBIOPORTAL_MAX_RETRIES', '3')
+    cbioportal_retry_delay = os.getenv('CBIOPORTAL_RETRY_DELAY', '0.5')
+    study_lock_timeout = os.getenv('STUDY_LOCK_TIMEOUT', '300')
+    import_lock_timeout = os.getenv('IMPORT_LOCK_TIMEOUT', '3600')
+    job_store_path = os.getenv('JOB_STORE_PATH', '')
+    import_drain_timeout = os.getenv('IMPORT_DRAIN_TIMEOUT', '600')
+    max_concurrent_requests = os.getenv('MAX_CONCURRENT_REQUESTS', '100')
+    max_request_body_size = os.getenv('MAX_REQUEST_BODY_SIZE', str(1024 * 1024 * 1024))
 
 
     missing_vars = []
@@ -31,5 +68,42 @@ def get_env_vars():
         "galaxy_url": galaxy_url.strip(),
         "galaxy_workflow_name": galaxy_workflow_name.strip() if galaxy_workflow_name else None,
         "image_upload_directory": image_upload_directory.strip(),
-        "xnat_url": xnat_url.strip() if xnat_url else None
+        "image_max_upload_size": int(image_max_upload_size),
+        "image_cache_max_age": int(image_cache_max_age),
+        "image_stat_cache_ttl": float(image_stat_cache_ttl),
+        "image_variant_directory": image_variant_directory.strip() if image_variant_directory else None,
+        "image_variant_cache_size": int(image_variant_cache_size),
+        "image_variant_max_dimension": int(image_variant_max_dimension),
+        "image_variant_workers": int(image_variant_workers),
+        "image_bulk_upload_workers": int(image_bulk_upload_workers),
+        "xnat_url": xnat_url.strip() if xnat_url else None,
+        "xnat_timeout": float(xnat_timeout),
+        "xnat_cache_ttl": float(xnat_cache_ttl),
+        "import_max_workers": int(import_max_workers),
+        "import_coalesce_window": float(import_coalesce_window),
+        "import_incremental": import_incremental.lower() == 'true',
+        "galaxy_client_cache_ttl": float(galaxy_client_cache_ttl),
+        "galaxy_client_cache_size": int(galaxy_client_cache_size),
+        "galaxy_pool_size": int(galaxy_pool_size),
+        "galaxy_max_retries": int(galaxy_max_retries),
+        "galaxy_retry_delay": float(galaxy_retry_delay),
+        "galaxy_circuit_breaker_threshold": int(galaxy_circuit_breaker_threshold),
+        "galaxy_health_probe_interval": float(galaxy_health_probe_interval),
+        "galaxy_dataset_timeout": float(galaxy_dataset_timeout),
+        "galaxy_metadata_cache_ttl": float(galaxy_metadata_cache_ttl),
+        "galaxy_upload_compress_threshold": int(galaxy_upload_compress_threshold),
+        "export_max_body_size": int(export_max_body_size),
+        "galaxy_upload_workers": int(galaxy_upload_workers),
+        "galaxy_workflow_batch_workers": int(galaxy_workflow_batch_workers),
+        "cbioportal_timeout": float(cbioportal_timeout),
+        "cbioportal_max_retries": int(cbioportal_max_retries),
+        "cbioportal_retry_delay": float(cbioportal_retry_delay),
+        "importer_workers": int(importer_workers),
+        "importer_worker_max_jobs": int(importer_worker_max_jobs),
+        "study_lock_timeout": float(study_lock_timeout),
+        "import_lock_timeout": float(import_lock_timeout),
+        "job_store_path": job_store_path.strip() if job_store_path else None,
+        "import_drain_timeout": float(import_drain_timeout),
+        "max_concurrent_requests": int(max_concurrent_requests),
+        "max_request_body_size": int(max_request_body_size)
     }
\ No newline at end of file
@@ -1,16 +1,51 @@
 from fastapi import FastAPI, Request, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from ipaddress import ip_network, ip_address
-from routers import galaxy_image_handler, cbioportal_to_galaxy_handler, galaxy_to_cbioportal_handler
+from routers import galaxy_image_handler, cbioportal_to_galaxy_handler, galaxy_to_cbioportal_handler, job_handler, \
+    metrics_handler
 from dependencies import get_env_vars
 from utils.logger import setup_logger
 from app.middleware.https_redirect import CustomHTTPSRedirectMiddleware
+from app.middleware.request_limits import RequestLimitMiddleware
+from app.services.importer_common import study_directory_index
+from app.services.importer_worker import get_importer_pool, shutdown_importer_pool
+from app.services.job_queue import get_import_queue, shutdown_import_queue
+from routers.cbioportal_to_galaxy_handler import shutdown_workflow_batches
+from starlette.concurrency import run_in_threadpool
+from contextlib import asynccontextmanager
 import os
 
-list_unrestricted_endpoints = ["/export-to-galaxy/", "/galaxy-workflow/"]
+list_unrestricted_endpoints = ["/export-to-galaxy/", "/export-to-galaxy/batch/", "/galaxy-workflow/",
+                               "/galaxy-workflow/batch/"]
 
 logger = setup_logger("uvicorn.error")
-app = FastAPI()
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Build the study index once so that the first export does not pay for the scan
+    study_directory_path = get_env_vars()['study_directory_path']
+    try:
+        study_directory_index.rebuild(study_directory_path)
+    except FileNotFoundError:
+        logger.warning(f"Study directory {study_directory_path} not found, study index not built")
+    # Start the importer workers now so that they are warm for the first import
+    importer_pool = get_importer_pool(get_env_vars())
+    if importer_pool is not None:
+        importer_pool.start()
+    # Jobs of worker processes that did not exit cleanly would otherwise stay queued or running forever
+    get_import_queue(get_env_vars()).store.fail_interrupted_jobs()
+    yield
+    # Workflow runs and imports already accepted are finished before the worker exits
+    await run_in_threadpool(shutdown_workflow_batches)
+    await run_in_threadpool(shutdown_import_queue, get_env_vars()['import_drain_timeout'])
+    shutdown_importer_pool()
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Get environment variables and display them
+dict_env_vars = get_env_vars()
 
 # Define allowed IPs and subnet
 ALLOWED_IPS = ["127.0.0.1"]
@@ -45,6 +80,10 @@ async def ip_filter_middleware(request: Request, call_next):
     response = await call_next(request)
     return response
 
+# Limit the requests in progress and the request body size of each worker
+app.add_middleware(RequestLimitMiddleware, max_concurrency=dict_env_vars['max_concurrent_requests'],
+                   max_body_size=dict_env_vars['max_request_body_size'])
+
 # Configure CORS settings
 app.add_middleware(
     CORSMiddleware,
@@ -57,9 +96,8 @@ app.add_middleware(
 app.include_router(galaxy_image_handler.router)
 app.include_router(cbioportal_to_galaxy_handler.router)
 app.include_router(galaxy_to_cbioportal_handler.router)
-
-# Get environment variables and display them
-dict_env_vars = get_env_vars()
+app.include_router(job_handler.router)
+app.include_router(metrics_handler.router)
 
 # logger.info(f"Using study directory: {dict_env_vars['study_directory_path']}")
 # logger.info(f"Using Galaxy URL: {dict_env_vars['galaxy_url']}")
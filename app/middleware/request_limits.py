@@ -0,0 +1,73 @@
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+
+class RequestLimitMiddleware:
+    """
+    Rejects requests with a 503 while max_concurrency requests are in progress in this worker,
+    and request bodies larger than max_body_size bytes with a 413. A limit of 0 disables it.
+    """
+
+    def __init__(self, app: ASGIApp, max_concurrency: int = 0, max_body_size: int = 0):
+        self.app = app
+        self.max_concurrency = max_concurrency
+        self.max_body_size = max_body_size
+        self.in_flight = 0
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        if self.max_concurrency and self.in_flight >= self.max_concurrency:
+            response = JSONResponse({"detail": "Too many requests in progress, try again later."},
+                                    status_code=503, headers={"Retry-After": "1"})
+            await response(scope, receive, send)
+            return
+
+        if self.max_body_size:
+            content_length = dict(scope["headers"]).get(b"content-length")
+            if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body_size:
+                await self.reject_body(send)
+                return
+            receive, send = self.limit_body(receive, send)
+
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
+
+    async def reject_body(self, send: Send) -> None:
+        response = JSONResponse({"detail": f"Request body is larger than {self.max_body_size} bytes"},
+                                status_code=413)
+        await send({"type": "http.response.start", "status": response.status_code,
+                    "headers": response.raw_headers})
+        await send({"type": "http.response.body", "body": response.body})
+
+    def limit_body(self, receive: Receive, send: Send):
+        """
+        Chunked bodies have no Content-Length, their size is only known while they are read. Once it goes over
+        the limit, the 413 is sent, the application sees a disconnected client and its own response is dropped.
+        """
+        state = {"received": 0, "response_started": False, "rejected": False}
+
+        async def limited_receive() -> Message:
+            message = await receive()
+            if message["type"] == "http.request":
+                state["received"] += len(message.get("body", b""))
+                if state["received"] > self.max_body_size:
+                    if not state["response_started"]:
+                        state["rejected"] = True
+                        await self.reject_body(send)
+                    return {"type": "http.disconnect"}
+            return message
+
+        async def limited_send(message: Message) -> None:
+            if state["rejected"]:
+                return
+            if message["type"] == "http.response.start":
+                state["response_started"] = True
+            await send(message)
+
+        return limited_receive, limited_send
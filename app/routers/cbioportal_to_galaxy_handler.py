@@ -1,20 +1,68 @@
-from typing import Dict
+import asyncio
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Awaitable, Callable, Dict, List, Optional
 
 from fastapi import APIRouter, HTTPException, Request, Depends
-from app.services.xnat_common import get_experiment_label_from_xnat, get_project_label_from_xnat
+from app.services.xnat_common import get_xnat_labels
+from app.services.galaxy_common import get_galaxy_instance_async, get_galaxy_metadata_cache, \
+    get_metadata_cache_key, get_single_flight_lock
+from app.services.galaxy_readiness import wait_for_dataset
+from app.services.galaxy_upload import upload_text
+from app.services.job_queue import get_import_queue
 from app.utils.logger import setup_logger
-import time
+from bioblend import ConnectionError as BioblendConnectionError
 from bioblend.galaxy import GalaxyInstance
+from bioblend.galaxy.dataset_collections import CollectionDescription, HistoryDatasetElement
+from starlette.concurrency import run_in_threadpool
 from requests.exceptions import ConnectionError
 from datetime import datetime
-import tempfile
 from urllib.parse import urlparse
 
 from app.dependencies import get_env_vars
+from app.utils.request_body import read_json_body
 
 router = APIRouter()
 logger = setup_logger(__name__)
 
+_upload_executor = None
+_upload_executor_lock = threading.Lock()
+
+
+def get_upload_executor(env_vars: dict) -> ThreadPoolExecutor:
+    global _upload_executor
+    with _upload_executor_lock:
+        if _upload_executor is None:
+            _upload_executor = ThreadPoolExecutor(max_workers=env_vars['galaxy_upload_workers'],
+                                                  thread_name_prefix="galaxy-upload")
+        return _upload_executor
+
+
+_workflow_batch_executor = None
+_workflow_batch_executor_lock = threading.Lock()
+
+
+def get_workflow_batch_executor(env_vars: dict) -> ThreadPoolExecutor:
+    global _workflow_batch_executor
+    with _workflow_batch_executor_lock:
+        if _workflow_batch_executor is None:
+            _workflow_batch_executor = ThreadPoolExecutor(max_workers=env_vars['galaxy_workflow_batch_workers'],
+                                                          thread_name_prefix="galaxy-workflow-batch")
+        return _workflow_batch_executor
+
+
+def shutdown_workflow_batches() -> None:
+    """
+    Runs the cohort workflow runs accepted by this process to completion.
+    """
+    global _workflow_batch_executor
+    with _workflow_batch_executor_lock:
+        executor, _workflow_batch_executor = _workflow_batch_executor, None
+    if executor is not None:
+        logger.info("Waiting for the queued workflow runs to finish")
+        executor.shutdown(wait=True)
+
 
 def validate_and_fix_url(url: str) -> str:
     parsed = urlparse(url)
@@ -25,67 +73,141 @@ def validate_and_fix_url(url: str) -> str:
     return url
 
 
-def get_galaxy_instance(url: str, key: str, max_retries: int = 5, delay: int = 5) -> GalaxyInstance:
-    logger.info(f"Creating GalaxyInstance with URL: {url}")
-    for attempt in range(max_retries):
-        try:
-            return GalaxyInstance(url, key)
-        except ConnectionError as e:
-            if attempt < max_retries - 1:
-                logger.debug(f"Attempt {attempt + 1} failed, retrying in {delay} seconds...")
-                time.sleep(delay)
-            else:
-                logger.error(f"Failed to establish a new connection: {e}")
-                raise HTTPException(status_code=500, detail=f"Failed to establish a new connection: {e}")
-
-
 def upload_data_string(galaxy_instance: GalaxyInstance, history_id: str, data_string: str, study_id: str, case_id: str,
-                       file_suffix: str = 'data.txt') -> Dict[str, str]:
+                       file_suffix: str = 'data.txt', compress_threshold: int = 0,
+                       first_line: Optional[str] = None) -> Dict[str, str]:
     current_time = datetime.now().strftime("%Y%m%dT%H%M")
     if case_id:
         file_name = f"{current_time}_{study_id}_{case_id}_{file_suffix}"
     else:
         file_name = f"{current_time}_{study_id}_{file_suffix}"
 
-    with tempfile.NamedTemporaryFile(delete=True, mode='w', suffix=file_name) as tmp_file:
-        tmp_file.write(data_string)
-        tmp_file_path = tmp_file.name
-        upload_info = galaxy_instance.tools.upload_file(tmp_file_path, history_id, file_name=file_name)
-    return upload_info
+    return upload_text(galaxy_instance, history_id, data_string, file_name, compress_threshold, first_line)
 
 
-def get_galaxy_instance_from_request(data: dict, env_vars: dict) -> GalaxyInstance:
+async def get_galaxy_instance_from_request(data: dict, env_vars: dict) -> GalaxyInstance:
     galaxy_token = data.get('galaxyToken')
     galaxy_url = env_vars['galaxy_url']
     if not galaxy_token:
         logger.error("Missing Galaxy token in the request.")
         raise ValueError("Missing Galaxy token in the request.")
-    return get_galaxy_instance(galaxy_url, galaxy_token)
-
+    return await get_galaxy_instance_async(galaxy_url, galaxy_token, env_vars)
+
+
+class MissingHistoryError(Exception):
+    pass
+
+
+def get_or_create_galaxy_history(gi: GalaxyInstance, galaxy_history_name: str, env_vars: dict,
+                                 stale_history_id: Optional[str] = None) -> str:
+    """
+    Returns the ID of the named history, creating it if needed. stale_history_id is the ID of a history
+    Galaxy reported as missing or deleted, it is dropped from the cache and never returned.
+    """
+    cache = get_galaxy_metadata_cache(env_vars)
+    cache_key = get_metadata_cache_key(gi, "history", galaxy_history_name)
+    history_id = cache.get(cache_key)
+    if history_id and history_id != stale_history_id:
+        return history_id
+
+    # Only one request creates the history, concurrent requests wait for it and reuse its ID
+    with get_single_flight_lock(cache_key):
+        history_id = cache.get(cache_key)
+        if history_id and history_id != stale_history_id:
+            return history_id
+        histories = [history for history in gi.histories.get_histories(name=galaxy_history_name)
+                     if history['id'] != stale_history_id]
+        if histories:
+            history_id = histories[0]['id']
+        else:
+            history_id = gi.histories.create_history(name=galaxy_history_name)['id']
+        cache.set(cache_key, history_id)
+        return history_id
 
-def get_or_create_galaxy_history(gi: GalaxyInstance, galaxy_history_name: str) -> str:
-    histories = gi.histories.get_histories(name=galaxy_history_name)
-    if histories:
-        return histories[0]['id']
-    else:
-        history = gi.histories.create_history(name=galaxy_history_name)
-        return history['id']
 
+def is_missing_history(gi: GalaxyInstance, history_id: str) -> bool:
+    try:
+        history = gi.histories.show_history(history_id)
+    except BioblendConnectionError as e:
+        if e.status_code is not None and 400 <= e.status_code < 500:
+            return True
+        raise
+    return bool(history.get('deleted') or history.get('purged'))
+
+
+async def call_in_galaxy_history(gi: GalaxyInstance, galaxy_history_name: str, env_vars: dict,
+                                 func: Callable[[str], Awaitable]) -> tuple:
+    """
+    Awaits func(history_id) with the ID of the named history and returns the history ID and the result.
+    If the cached history was deleted in Galaxy, func is run again once with a new history.
+    """
+    history_id = await run_in_threadpool(get_or_create_galaxy_history, gi, galaxy_history_name, env_vars)
+    try:
+        return history_id, await func(history_id)
+    except Exception as e:
+        is_client_error = isinstance(e, BioblendConnectionError) and e.status_code is not None and \
+            400 <= e.status_code < 500
+        if not isinstance(e, MissingHistoryError) and \
+                not (is_client_error and await run_in_threadpool(is_missing_history, gi, history_id)):
+            raise
+        logger.warning(f"History {history_id} ({galaxy_history_name}) is missing or deleted in Galaxy, "
+                       f"retrying with a new history")
+
+    history_id = await run_in_threadpool(get_or_create_galaxy_history, gi, galaxy_history_name, env_vars,
+                                         history_id)
+    return history_id, await func(history_id)
+
+
+def get_workflow_id(gi: GalaxyInstance, workflow_name: str, env_vars: dict) -> str:
+    cache = get_galaxy_metadata_cache(env_vars)
+    cache_key = get_metadata_cache_key(gi, "workflow_id", workflow_name)
+    workflow_id = cache.get(cache_key)
+    if workflow_id:
+        return workflow_id
 
-def get_workflow_id(gi: GalaxyInstance, workflow_name: str) -> str:
     workflows = gi.workflows.get_workflows(name=workflow_name)
     if workflows:
+        cache.set(cache_key, workflows[0]['id'])
         return workflows[0]['id']
     else:
         raise ValueError(f"Workflow with name {workflow_name} not found")
 
 
+def get_workflow(gi: GalaxyInstance, workflow_name: str, env_vars: dict) -> dict:
+    cache = get_galaxy_metadata_cache(env_vars)
+    workflow_id = get_workflow_id(gi, workflow_name, env_vars)
+    cache_key = get_metadata_cache_key(gi, "workflow", workflow_id)
+    workflow = cache.get(cache_key)
+    if workflow:
+        return workflow
+
+    try:
+        workflow = gi.workflows.show_workflow(workflow_id)
+    except BioblendConnectionError:
+        # The cached workflow ID may belong to a deleted workflow, look it up again once
+        cache.pop(get_metadata_cache_key(gi, "workflow_id", workflow_name))
+        workflow = gi.workflows.show_workflow(get_workflow_id(gi, workflow_name, env_vars))
+    cache.set(get_metadata_cache_key(gi, "workflow", workflow['id']), workflow)
+    return workflow
+
+
 def upload_data_to_galaxy(gi: GalaxyInstance, history_id: str, data: str, cbioportal_study_id: str,
-                          cbioportal_case_id: str) -> dict:
+                          cbioportal_case_id: str, compress_threshold: int = 0, first_line: Optional[str] = None) -> dict:
     if not data:
         logger.error("Missing data in the request.")
         raise ValueError("Missing data in the request.")
-    return upload_data_string(gi, history_id, data, cbioportal_study_id, cbioportal_case_id)
+    return upload_data_string(gi, history_id, data, cbioportal_study_id, cbioportal_case_id,
+                              compress_threshold=compress_threshold, first_line=first_line)
+
+
+def get_fixed_header(data: str) -> str:
+    """
+    Returns the header line of the exported data with spaces replaced by underscores and in lower case.
+    """
+    header_end = data.find('\n')
+    if header_end == -1:
+        raise ValueError("The data must contain a header line followed by data lines.")
+    return data[:header_end].replace(' ', '_').lower()
 
 def run_xnat_importer_tool(galaxy_instance: GalaxyInstance, history_id: str, cbioportal_study_id: str, cbioportal_case_id: str, xnat_experiment_id: str) -> dict:
     
@@ -111,8 +233,7 @@ def upload_resource_to_galaxy(galaxy_instance: GalaxyInstance, history_id: str,
                           cbioportal_case_id: str, env_vars: dict) -> dict:
     if "viewer.imaging.datacommons" in resource_url:
         # cbioportal_study_id = "eosc4cancer_tcga_coad"
-        experiment_id = get_experiment_label_from_xnat(resource_url, cbioportal_study_id, cbioportal_case_id, env_vars)
-        project_id = get_project_label_from_xnat(cbioportal_study_id=cbioportal_study_id, env_vars=env_vars)
+        experiment_id, project_id = get_xnat_labels(resource_url, cbioportal_study_id, cbioportal_case_id, env_vars)
         run_xnat_importer_tool(galaxy_instance, history_id, project_id, cbioportal_case_id, experiment_id)
     else:
         upload_info = upload_data_to_galaxy(galaxy_instance, history_id, resource_url + "\n", cbioportal_study_id, cbioportal_case_id)
@@ -121,32 +242,132 @@ def upload_resource_to_galaxy(galaxy_instance: GalaxyInstance, history_id: str,
         return {"message": "Data received successfully"}
     
 
+def upload_batch_item(gi: GalaxyInstance, history_id: str, item: dict, compress_threshold: int) -> dict:
+    data = item.get('data')
+    if not isinstance(data, str) or not data or data.startswith('http'):
+        raise ValueError("Batch items must contain tabular data.")
+    upload_info = upload_data_to_galaxy(gi, history_id, data, item.get('studyId'), item.get('caseId'),
+                                        compress_threshold, get_fixed_header(data))
+    logger.info(f"Uploaded: {upload_info['outputs'][0]['name']}, ID: {upload_info['outputs'][0]['id']}")
+    return upload_info['outputs'][0]
+
+
+async def upload_batch_items(gi: GalaxyInstance, history_id: str, items: List[dict], env_vars: dict) -> List[dict]:
+    """
+    Uploads the items concurrently on the upload pool and returns the result of each item, in order.
+    Raises MissingHistoryError when no item was uploaded because the history was deleted.
+    """
+    loop = asyncio.get_running_loop()
+    executor = get_upload_executor(env_vars)
+    outputs = await asyncio.gather(
+        *(loop.run_in_executor(executor, upload_batch_item, gi, history_id, item,
+                               env_vars['galaxy_upload_compress_threshold']) for item in items),
+        return_exceptions=True)
+
+    results = []
+    for item, output in zip(items, outputs):
+        result = {"studyId": item.get('studyId'), "caseId": item.get('caseId')}
+        if isinstance(output, Exception):
+            logger.error(f"Failed to upload case {item.get('caseId')} of study {item.get('studyId')}: {output}")
+            result.update(status="failed", error=str(output))
+        else:
+            result.update(status="uploaded", datasetId=output['id'], name=output['name'])
+        results.append(result)
+    if not any(result['status'] == "uploaded" for result in results) and \
+            await run_in_threadpool(is_missing_history, gi, history_id):
+        raise MissingHistoryError(f"History {history_id} is missing or deleted in Galaxy")
+    return results
+
+
+def get_batch_items(data: dict) -> List[dict]:
+    items = data.get('items')
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        logger.error("Missing items in the request.")
+        raise ValueError("Missing items in the request.")
+    return items
+
+
+def create_list_collection(gi: GalaxyInstance, history_id: str, collection_name: str, results: List[dict]) -> dict:
+    """
+    Groups the uploaded datasets of the results in a list collection, with one element per case.
+    """
+    identifiers = set()
+    elements = []
+    for index, result in enumerate(results):
+        if result['status'] != "uploaded":
+            continue
+        # Element identifiers must be unique within a collection
+        identifier = str(result['caseId'] or result['studyId'] or index)
+        if identifier in identifiers:
+            identifier = f"{identifier}_{index}"
+        identifiers.add(identifier)
+        elements.append(HistoryDatasetElement(name=identifier, id=result['datasetId']))
+    if not elements:
+        raise ValueError("No dataset was uploaded, the collection can not be created.")
+
+    collection = gi.histories.create_dataset_collection(
+        history_id, CollectionDescription(name=collection_name, type="list", elements=elements))
+    logger.info(f"Created collection {collection_name} with {len(elements)} datasets, ID: {collection['id']}")
+    return {"id": collection['id'], "name": collection_name}
+
+
+@router.post("/export-to-galaxy/batch/")
+async def export_batch_to_galaxy(request: Request, env_vars: dict = Depends(get_env_vars)) -> dict:
+    try:
+        data = await read_json_body(request, env_vars['export_max_body_size'])
+        items = get_batch_items(data)
+
+        gi = await get_galaxy_instance_from_request(data, env_vars)
+        logger.info("Created GalaxyInstance successfully")
+
+        logger.info(f"Uploading {len(items)} items to history {data.get('galaxyHistoryName')}")
+        history_id, results = await call_in_galaxy_history(
+            gi, data.get('galaxyHistoryName'), env_vars,
+            lambda history_id: upload_batch_items(gi, history_id, items, env_vars))
+        logger.info(f"Working with history ID: {history_id}")
+        response = {"message": "Data received successfully", "results": results}
+        if data.get('collectionName'):
+            response["collection"] = await run_in_threadpool(create_list_collection, gi, history_id,
+                                                             data.get('collectionName'), results)
+        return response
+    except HTTPException:
+        raise
+    except ConnectionError as e:
+        logger.error(f"Connection error: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to establish a new connection: {e}")
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
+
+
 @router.post("/export-to-galaxy/")
 async def export_to_galaxy(request: Request, env_vars: dict = Depends(get_env_vars)) -> dict:
     try:
-        data = await request.json()
+        data = await read_json_body(request, env_vars['export_max_body_size'])
         logger.debug(f"Received data: {data}")
 
-        gi = get_galaxy_instance_from_request(data, env_vars)
+        gi = await get_galaxy_instance_from_request(data, env_vars)
         logger.info("Created GalaxyInstance successfully")
 
-        history_id = get_or_create_galaxy_history(gi, data.get('galaxyHistoryName'))
-        logger.info(f"Working with history ID: {history_id}")
-        
-        # Check if data is an url
-        if data.get('data').startswith('http'):
-            upload_resource_to_galaxy(gi, history_id, data.get('data'), data.get('studyId'), data.get('caseId'), env_vars)
-            # pass
-        else:
-            data_header, data_body = data.get('data').split('\n', 1)
-            fixed_header = data_header.replace(' ', '_').lower()
+        async def upload(history_id: str) -> None:
+            logger.info(f"Working with history ID: {history_id}")
+            # Check if data is an url
+            if data.get('data').startswith('http'):
+                await run_in_threadpool(upload_resource_to_galaxy, gi, history_id, data.get('data'),
+                                        data.get('studyId'), data.get('caseId'), env_vars)
+            else:
+                # The header is replaced while uploading to avoid copying the data
+                fixed_header = get_fixed_header(data.get('data'))
+                upload_info = await run_in_threadpool(upload_data_to_galaxy, gi, history_id, data.get('data'),
+                                                     data.get('studyId'), data.get('caseId'),
+                                                     env_vars['galaxy_upload_compress_threshold'], fixed_header)
+                logger.info(f"Uploaded: {upload_info['outputs'][0]['name']}, ID: {upload_info['outputs'][0]['id']}")
 
-            data_modified = f"{fixed_header}\n{data_body}"
-            
-            upload_info = upload_data_to_galaxy(gi, history_id, data_modified, data.get('studyId'), data.get('caseId'))
-            logger.info(f"Uploaded: {upload_info['outputs'][0]['name']}, ID: {upload_info['outputs'][0]['id']}")
+        await call_in_galaxy_history(gi, data.get('galaxyHistoryName'), env_vars, upload)
 
         return {"message": "Data received successfully"}
+    except HTTPException:
+        raise
     except ConnectionError as e:
         logger.error(f"Connection error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to establish a new connection: {e}")
@@ -155,76 +376,175 @@ async def export_to_galaxy(request: Request, env_vars: dict = Depends(get_env_va
         raise HTTPException(status_code=500, detail=str(e))
 
 
-@router.post("/galaxy-workflow/")
-async def galaxy_workflow(request: Request, env_vars: dict = Depends(get_env_vars)) -> dict:
-    try:
-        data = await request.json()
-        logger.debug(f"Received data: {data}")
+def get_workflow_inputs(workflow: dict, src: str, input_id: str) -> dict:
+    # Assuming the workflow has a single input we want to map to our uploaded data
+    return {
+        workflow_input: {
+            'src': src,
+            'id': input_id,
+            'label': details['label'],
+            'uuid': details['uuid']
+        }
+        for workflow_input, details in workflow['inputs'].items()
+    }
 
-        gi = get_galaxy_instance_from_request(data, env_vars)
-        logger.info("Created GalaxyInstance successfully")
 
-        history_id = get_or_create_galaxy_history(gi, data.get('galaxyHistoryName'))
-        logger.info(f"Working with history ID: {history_id}")
+async def wait_for_batch_datasets(gi: GalaxyInstance, results: List[dict], timeout: float) -> None:
+    """
+    Waits for the uploaded datasets of the results, marking the results of datasets that never get ready as failed.
+    """
+    async def wait(result):
+        try:
+            await wait_for_dataset(gi, result['datasetId'], timeout)
+        except Exception as e:
+            logger.error(f"Dataset of case {result['caseId']} is not ready: {e}")
+            result.update(status="failed", error=str(e))
 
-        data_header, data_body = data.get('data').split('\n', 1)
-        fixed_header = data_header.replace(' ', '_').lower()
+    await asyncio.gather(*(wait(result) for result in results if result['status'] == "uploaded"))
 
-        data_modified = f"{fixed_header}\n{data_body}"
 
-        upload_info = upload_data_to_galaxy(gi, history_id, data_modified, data.get('studyId'), data.get('caseId'))
-        logger.info(f"Uploaded: {upload_info['outputs'][0]['name']}, ID: {upload_info['outputs'][0]['id']}")
-        logger.debug(f"Information: {upload_info}")
+async def run_workflow_batch(gi: GalaxyInstance, galaxy_history_name: str, workflow: dict, items: List[dict],
+                             job_ids: List[str], batch_size: int, collection_name: str, env_vars: dict) -> None:
+    """
+    Uploads the cases, then invokes the workflow once per batch of batch_size cases on a list collection of
+    their datasets. The status of every case is kept in its job.
+    """
+    store = get_import_queue(env_vars).store
+    for job_id in job_ids:
+        await run_in_threadpool(store.update, job_id, status="running", started_at=datetime.now().isoformat())
 
-        # Bioblend, get workflow ID from name from environment variable
-        workflow_id = get_workflow_id(gi, env_vars['galaxy_workflow_name'])
-
-        # List files in history every 5 seconds for 2 minutes
-        for _ in range(24):
-            files = gi.histories.show_history(history_id, contents=True)
-            for file in files:
-                if file['name'] == upload_info['outputs'][0]['name'] and file['state'] == 'ok':
-                    logger.info(f"File {file['name']} is ready")
-                    logger.debug(f"File info: {file}")
-                    break
-            else:
-                time.sleep(5)
-                continue
-            break
+    try:
+        history_id, results = await call_in_galaxy_history(
+            gi, galaxy_history_name, env_vars, lambda history_id: upload_batch_items(gi, history_id, items, env_vars))
+        await wait_for_batch_datasets(gi, results, env_vars['galaxy_dataset_timeout'])
+    except Exception as e:
+        logger.error(f"Failed to upload the cases of workflow {workflow['id']}: {e}")
+        for job_id in job_ids:
+            await run_in_threadpool(store.update, job_id, status="failed", finished_at=datetime.now().isoformat(),
+                                    error=str(e))
+        return
+
+    ready = []
+    for job_id, result in zip(job_ids, results):
+        if result['status'] == "uploaded":
+            ready.append((job_id, result))
         else:
-            raise ValueError("No files found in history after 2 minutes")
+            await run_in_threadpool(store.update, job_id, status="failed", finished_at=datetime.now().isoformat(),
+                                    error=result['error'])
+
+    batch_count = (len(ready) + batch_size - 1) // batch_size
+    for batch_number, start in enumerate(range(0, len(ready), batch_size), 1):
+        batch = ready[start:start + batch_size]
+        batch_id = uuid.uuid4().hex
+        name = collection_name if batch_count == 1 else f"{collection_name} {batch_number}"
+        try:
+            collection = await run_in_threadpool(create_list_collection, gi, history_id, name,
+                                                 [result for _, result in batch])
+            invocation = await run_in_threadpool(gi.workflows.invoke_workflow, workflow['id'],
+                                                 inputs=get_workflow_inputs(workflow, 'hdca', collection['id']),
+                                                 history_id=history_id)
+            logger.info(f"Invoked workflow {workflow['id']} on {len(batch)} cases, invocation ID: {invocation['id']}")
+            fields = {"status": "succeeded", "collection": collection, "invocation": invocation}
+        except Exception as e:
+            logger.error(f"Failed to invoke workflow {workflow['id']} on collection {name}: {e}")
+            fields = {"status": "failed", "error": str(e)}
+
+        for job_id, result in batch:
+            output = {"datasetId": result['datasetId']}
+            if fields["status"] == "succeeded":
+                output.update(collectionId=fields["collection"]['id'], invocationId=fields["invocation"]['id'],
+                              invocationState=fields["invocation"].get('state'))
+            await run_in_threadpool(store.update, job_id, status=fields["status"],
+                                    finished_at=datetime.now().isoformat(), batch_id=batch_id, batch_size=len(batch),
+                                    output=output, error=fields.get("error"))
+
+
+def run_workflow_batch_in_thread(*args) -> None:
+    """
+    Runs run_workflow_batch on its own event loop, in a thread of the workflow batch executor, so that a cohort
+    run neither holds the request that submitted it nor slows down the event loop serving requests.
+    """
+    try:
+        asyncio.run(run_workflow_batch(*args))
+    except Exception as e:
+        logger.error(f"Workflow batch failed: {e}")
 
 
+@router.post("/galaxy-workflow/batch/")
+async def galaxy_workflow_batch(request: Request, env_vars: dict = Depends(get_env_vars)) -> dict:
+    try:
+        data = await read_json_body(request, env_vars['export_max_body_size'])
+        items = get_batch_items(data)
+        batch_size = int(data.get('batchSize') or len(items))
+        if batch_size < 1:
+            raise ValueError("batchSize must be a positive number.")
 
+        gi = await get_galaxy_instance_from_request(data, env_vars)
+        logger.info("Created GalaxyInstance successfully")
 
+        # Looked up before queuing so that a missing workflow is reported right away
+        workflow = await run_in_threadpool(get_workflow, gi, env_vars['galaxy_workflow_name'], env_vars)
+
+        store = get_import_queue(env_vars).store
+        jobs = [await run_in_threadpool(store.create, f"{item.get('studyId')}/{item.get('caseId')}") for item in items]
+        get_workflow_batch_executor(env_vars).submit(
+            run_workflow_batch_in_thread, gi, data.get('galaxyHistoryName'), workflow, items,
+            [job['id'] for job in jobs], batch_size, data.get('collectionName') or env_vars['galaxy_workflow_name'],
+            env_vars)
+
+        return {
+            "message": "Workflow invocations queued",
+            "jobs": [{"studyId": item.get('studyId'), "caseId": item.get('caseId'), "job_id": job['id']}
+                     for item, job in zip(items, jobs)],
+        }
+    except HTTPException:
+        raise
+    except ConnectionError as e:
+        logger.error(f"Connection error: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to establish a new connection: {e}")
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        # get file content from uploaded file
-        file_content = gi.datasets.show_dataset(upload_info['outputs'][0]['id'])
-        logger.debug(f"File content: {file_content}")
-        logger.debug(f"File uploaded: {upload_info}")
 
+@router.post("/galaxy-workflow/")
+async def galaxy_workflow(request: Request, env_vars: dict = Depends(get_env_vars)) -> dict:
+    try:
+        data = await read_json_body(request, env_vars['export_max_body_size'])
+        logger.debug(f"Received data: {data}")
+
+        gi = await get_galaxy_instance_from_request(data, env_vars)
+        logger.info("Created GalaxyInstance successfully")
 
-        # Fetch the workflow details
-        workflow = gi.workflows.show_workflow(workflow_id)
-        workflow_inputs = workflow['inputs']
+        fixed_header = get_fixed_header(data.get('data'))
+        history_id, upload_info = await call_in_galaxy_history(
+            gi, data.get('galaxyHistoryName'), env_vars,
+            lambda history_id: run_in_threadpool(upload_data_to_galaxy, gi, history_id, data.get('data'),
+                                                 data.get('studyId'), data.get('caseId'),
+                                                 env_vars['galaxy_upload_compress_threshold'], fixed_header))
+        logger.info(f"Working with history ID: {history_id}")
+        logger.info(f"Uploaded: {upload_info['outputs'][0]['name']}, ID: {upload_info['outputs'][0]['id']}")
+        logger.debug(f"Information: {upload_info}")
+
+        # Bioblend, get workflow details from name from environment variable
+        workflow = await run_in_threadpool(get_workflow, gi, env_vars['galaxy_workflow_name'], env_vars)
+        workflow_id = workflow['id']
+
+        # Wait for the uploaded dataset to be ready before using it as workflow input
+        dataset = await wait_for_dataset(gi, upload_info['outputs'][0]['id'], env_vars['galaxy_dataset_timeout'])
+        logger.info(f"File {dataset['name']} is ready")
+        logger.debug(f"File info: {dataset}")
+        logger.debug(f"File uploaded: {upload_info}")
 
-        # Assuming the workflow has a single input we want to map to our uploaded dataset
-        logger.info(f"Input: {workflow_inputs}")
+        logger.info(f"Input: {workflow['inputs']}")
         logger.info(f"Workflow: {workflow}")
-        dict_inputs = {}
-        for workflow_input in workflow_inputs:
-            dict_inputs[workflow_input] = {
-                'src': 'hda',
-                'id': upload_info['outputs'][0]['id'],
-                'label': workflow_inputs[workflow_input]['label'],
-                'uuid': workflow_inputs[workflow_input]['uuid']
-            }
+        dict_inputs = get_workflow_inputs(workflow, 'hda', upload_info['outputs'][0]['id'])
 
 
         # Bioblend, invoke workflow
-        workflow_info = gi.workflows.invoke_workflow(workflow_id,
-                                                     inputs=dict_inputs,
-                                                     history_id=history_id)
+        workflow_info = await run_in_threadpool(gi.workflows.invoke_workflow, workflow_id,
+                                                inputs=dict_inputs,
+                                                history_id=history_id)
         logger.debug(f"Workflow info: {workflow_info}")
 
 
@@ -245,6 +565,8 @@ async def galaxy_workflow(request: Request, env_vars: dict = Depends(get_env_var
         # logger.info(f"Invoked workflow: {workflow_info['id']}")
         #
         # return {"message": "Workflow invoked successfully"}
+    except HTTPException:
+        raise
     except ConnectionError as e:
         logger.error(f"Connection error: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to establish a new connection: {e}")
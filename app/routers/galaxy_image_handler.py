@@ -1,12 +1,121 @@
 import os
+import asyncio
+import hashlib
+import tarfile
+import zipfile
 from app.utils.logger import setup_logger
-from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Request, Form
-from fastapi.responses import FileResponse
+from typing import Callable, List, Optional, Tuple
+from fastapi import APIRouter, Depends, UploadFile, File, HTTPException, Request, Form, Query
+from fastapi.responses import FileResponse, JSONResponse, Response
+from email.utils import formatdate, parsedate_to_datetime
+from starlette.concurrency import run_in_threadpool
+from starlette.types import Message, Receive, Scope, Send
 from app.dependencies import get_env_vars
+from app.utils.cache import TTLCache
+from app.services.image_store import ImageStore, get_image_store, is_valid_image_name
+from app.services.image_variants import VARIANT_FORMATS, DEFAULT_VARIANT_FORMAT, RENDER_ERRORS, get_image_variant, \
+    delete_image_variants
 
 router = APIRouter()
 logger = setup_logger(__name__)
 
+# Size of the chunks read from uploaded files
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+ZIP_EXTENSIONS = (".zip",)
+TAR_EXTENSIONS = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+
+_image_stat_cache = None
+
+
+def get_image_stat_cache(env_vars: dict) -> TTLCache:
+    global _image_stat_cache
+    if _image_stat_cache is None:
+        _image_stat_cache = TTLCache(env_vars['image_stat_cache_ttl'], max_size=4096)
+    return _image_stat_cache
+
+
+def check_image_name(image_name: str):
+    if not is_valid_image_name(image_name):
+        raise HTTPException(status_code=400, detail=f"Invalid image name '{image_name}'.")
+
+
+def stat_image(image_name: str, env_vars: dict):
+    """
+    Returns the cached path, SHA-256 and os.stat result of an image, or None if it does not exist.
+    """
+    cache = get_image_stat_cache(env_vars)
+    image = cache.get(image_name)
+    if image is None:
+        found = get_image_store(env_vars).lookup(image_name)
+        if found is None:
+            return None
+        try:
+            image = (found[0], found[1], os.stat(found[0]))
+        except FileNotFoundError:
+            return None
+        cache.set(image_name, image)
+    return image
+
+
+class ImageFileResponse(FileResponse):
+    """
+    FileResponse answering 404 when its file is removed before it is sent, as when another worker process
+    overwrites or deletes the image after it was looked up. The response start is held back until the file
+    is open, and on_missing is called so that the stale lookup is dropped.
+    """
+
+    def __init__(self, *args, on_missing: Optional[Callable[[], None]] = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.on_missing = on_missing
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        state = {"start": None, "sent": False}
+
+        async def deferred_send(message: Message) -> None:
+            if message["type"] == "http.response.start":
+                state["start"] = message
+                return
+            if state["start"] is not None:
+                start, state["start"] = state["start"], None
+                state["sent"] = True
+                await send(start)
+            await send(message)
+
+        try:
+            await super().__call__(scope, receive, deferred_send)
+        except (FileNotFoundError, RuntimeError):
+            # FileResponse raises a RuntimeError when it has no stat result and does not find the file
+            if state["sent"] or os.path.exists(self.path):
+                raise
+            logger.warning(f"File {self.path} was removed before it was sent")
+            if self.on_missing is not None:
+                self.on_missing()
+            await JSONResponse({"detail": "Image not found"}, status_code=404)(scope, receive, send)
+
+
+def get_etag(stat_result: os.stat_result, sha256: Optional[str] = None) -> str:
+    if sha256:
+        return f'"{sha256}"'
+    # Legacy images are replaced by renaming a new file, so inode, size and mtime identify the content
+    return f'"{stat_result.st_ino:x}-{stat_result.st_size:x}-{stat_result.st_mtime_ns:x}"'
+
+
+def is_not_modified(request: Request, etag: str, stat_result: os.stat_result) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        etags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in etags or etag in etags or f"W/{etag}" in etags
+
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is not None:
+        try:
+            return int(stat_result.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
+
 
 # UPLOAD_DIRECTORY = "/uploaded_images"
 # os.makedirs(UPLOAD_DIRECTORY, exist_ok=True)
@@ -18,48 +127,236 @@ def create_upload_directory(dir_path: str):
     else:
         logger.info(f"Directory already exists: {dir_path}")
 
+async def save_upload_file(file: UploadFile, image_store: ImageStore, max_size: int) -> Tuple[str, str]:
+    """
+    Streams the uploaded file to a temporary file of the image store.
+    Returns the path of the temporary file and the SHA-256 of the content.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    tmp_file = await run_in_threadpool(image_store.create_temp_file)
+    try:
+        while True:
+            chunk = await file.read(UPLOAD_CHUNK_SIZE)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_size:
+                raise HTTPException(status_code=413,
+                                    detail=f"Image '{file.filename}' is larger than the maximum size of {max_size} bytes.")
+            sha256.update(chunk)
+            await run_in_threadpool(tmp_file.write, chunk)
+        await run_in_threadpool(tmp_file.close)
+    except BaseException:
+        tmp_file.close()
+        if os.path.exists(tmp_file.name):
+            os.remove(tmp_file.name)
+        raise
+    return tmp_file.name, sha256.hexdigest()
+
+
 @router.post("/upload-image/")
 async def upload_image(request: Request, file: UploadFile = File(...), overwrite: bool = Form(False), env_vars: dict = Depends(get_env_vars)):
-    upload_directory = env_vars.get('image_upload_directory')
-    
+    image_store = get_image_store(env_vars)
+
     image_name = os.path.basename(file.filename)
-    file_location = os.path.join(upload_directory, image_name)
+    check_image_name(image_name)
 
-    if os.path.exists(file_location):
+    if await run_in_threadpool(image_store.lookup, image_name):
         if not overwrite:
             raise HTTPException(status_code=409,
                                 detail=f"Image named '{image_name}' already exists. Set overwrite to true to replace it.")
         else:
-            message = f"file '{file.filename}' overwritten at '{file_location}'"
+            message = f"file '{file.filename}' overwritten as '{image_name}'"
             logger.info(message)
 
     else:
-        message = f"file '{file.filename}' saved at '{file_location}'"
+        message = f"file '{file.filename}' saved as '{image_name}'"
         logger.info(message)
 
-    with open(file_location, "wb+") as file_object:
-        file_object.write(file.file.read())
+    tmp_path, sha256 = await save_upload_file(file, image_store, env_vars['image_max_upload_size'])
+    try:
+        await run_in_threadpool(image_store.commit, image_name, tmp_path, sha256)
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    get_image_stat_cache(env_vars).pop(image_name)
+    await run_in_threadpool(delete_image_variants, image_name, env_vars)
 
     base_url = str(request.base_url)
     image_url = f"{base_url}images/{image_name}"
 
-    return {"info": message, "url": image_url}
+    return {"info": message, "url": image_url, "sha256": sha256}
+
+
+def write_temp_file(source, image_store: ImageStore, image_name: str, max_size: int) -> Tuple[str, str]:
+    """
+    Blocking counterpart of save_upload_file for file objects such as archive members.
+    """
+    sha256 = hashlib.sha256()
+    size = 0
+    with image_store.create_temp_file() as tmp_file:
+        try:
+            while True:
+                chunk = source.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise HTTPException(status_code=413,
+                                        detail=f"Image '{image_name}' is larger than the maximum size of {max_size} bytes.")
+                sha256.update(chunk)
+                tmp_file.write(chunk)
+        except BaseException:
+            tmp_file.close()
+            os.remove(tmp_file.name)
+            raise
+    return tmp_file.name, sha256.hexdigest()
+
+
+def store_bulk_entry(image_name: str, source, overwrite: bool, env_vars: dict) -> dict:
+    """
+    Stores one image of a bulk upload, returning its result instead of raising so that the other images are stored.
+    """
+    image_store = get_image_store(env_vars)
+    try:
+        check_image_name(image_name)
+        if not overwrite and image_store.lookup(image_name):
+            raise HTTPException(status_code=409,
+                                detail=f"Image named '{image_name}' already exists. Set overwrite to true to replace it.")
+        tmp_path, sha256 = write_temp_file(source, image_store, image_name, env_vars['image_max_upload_size'])
+        try:
+            image_store.commit(image_name, tmp_path, sha256)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+    except HTTPException as e:
+        return {"name": image_name, "status_code": e.status_code, "detail": e.detail}
+    get_image_stat_cache(env_vars).pop(image_name)
+    delete_image_variants(image_name, env_vars)
+    logger.info(f"Bulk uploaded image '{image_name}'")
+    return {"name": image_name, "sha256": sha256}
+
+
+def store_zip_entry(archive: zipfile.ZipFile, info: zipfile.ZipInfo, overwrite: bool, env_vars: dict) -> dict:
+    with archive.open(info) as source:
+        return store_bulk_entry(os.path.basename(info.filename), source, overwrite, env_vars)
+
+
+def store_tar_entries(fileobj, overwrite: bool, env_vars: dict) -> List[dict]:
+    results = []
+    # Tar archives are read as a stream, so their members are stored one after the other
+    with tarfile.open(fileobj=fileobj, mode="r|*") as archive:
+        for member in archive:
+            image_name = os.path.basename(member.name)
+            if member.isfile() and is_bulk_image_name(image_name):
+                results.append(store_bulk_entry(image_name, archive.extractfile(member), overwrite, env_vars))
+    return results
+
+
+def is_bulk_image_name(image_name: str) -> bool:
+    # Skips directories and hidden files such as the resource forks added by macOS archivers
+    return is_valid_image_name(image_name)
+
+
+async def run_bulk_entries(entries: list, env_vars: dict) -> List[dict]:
+    semaphore = asyncio.Semaphore(env_vars['image_bulk_upload_workers'])
+
+    async def run_entry(func, *args):
+        async with semaphore:
+            return await run_in_threadpool(func, *args)
+
+    return list(await asyncio.gather(*(run_entry(*entry) for entry in entries)))
+
+
+@router.post("/upload-images/")
+async def upload_images(request: Request, files: List[UploadFile] = File(...), overwrite: bool = Form(False),
+                        env_vars: dict = Depends(get_env_vars)):
+    """
+    Stores several images, uploaded as separate files or as a single zip or tar archive.
+    """
+    archive_name = files[0].filename.lower() if len(files) == 1 and files[0].filename else ""
+    try:
+        if archive_name.endswith(ZIP_EXTENSIONS):
+            archive = await run_in_threadpool(zipfile.ZipFile, files[0].file)
+            results = await run_bulk_entries(
+                [(store_zip_entry, archive, info, overwrite, env_vars) for info in archive.infolist()
+                 if not info.is_dir() and is_bulk_image_name(os.path.basename(info.filename))
+                 and "__MACOSX/" not in info.filename], env_vars)
+        elif archive_name.endswith(TAR_EXTENSIONS):
+            results = await run_in_threadpool(store_tar_entries, files[0].file, overwrite, env_vars)
+        else:
+            results = await run_bulk_entries(
+                [(store_bulk_entry, os.path.basename(file.filename), file.file, overwrite, env_vars)
+                 for file in files], env_vars)
+    except (zipfile.BadZipFile, tarfile.TarError) as e:
+        raise HTTPException(status_code=400, detail=f"Invalid archive '{files[0].filename}': {e}")
+
+    names = [result["name"] for result in results]
+    duplicates = {name for name in names if names.count(name) > 1}
+    if duplicates:
+        logger.warning(f"Bulk upload contained several images named {sorted(duplicates)}, the last one stored is kept")
+
+    base_url = str(request.base_url)
+    images = [{"name": result["name"], "url": f"{base_url}images/{result['name']}", "sha256": result["sha256"]}
+              for result in results if "sha256" in result]
+    errors = [result for result in results if "sha256" not in result]
+    return {"images": images, "errors": errors}
 
 
 @router.get("/images/{image_name}")
-async def get_image(image_name: str, env_vars: dict = Depends(get_env_vars)):
-    upload_directory = env_vars.get('image_upload_directory')
-    file_location = os.path.join(upload_directory, image_name)
-    if not os.path.exists(file_location):
+async def get_image(request: Request, image_name: str, width: Optional[int] = Query(None, gt=0),
+                    height: Optional[int] = Query(None, gt=0), format: Optional[str] = None,
+                    env_vars: dict = Depends(get_env_vars)):
+    check_image_name(image_name)
+    image = stat_image(image_name, env_vars)
+    if image is None:
         raise HTTPException(status_code=404, detail="Image not found")
-    return FileResponse(file_location)
+
+    file_location, sha256, stat_result = image
+    etag = get_etag(stat_result, sha256)
+    variant_format = None
+    if width or height or format:
+        max_dimension = env_vars['image_variant_max_dimension']
+        if (width and width > max_dimension) or (height and height > max_dimension):
+            raise HTTPException(status_code=400, detail=f"Width and height must be at most {max_dimension} pixels.")
+        # Keep the format of the original image unless another one is requested
+        variant_format = (format or os.path.splitext(image_name)[1].lstrip(".")).lower()
+        variant_format = "jpeg" if variant_format == "jpg" else variant_format
+        if not format and variant_format not in VARIANT_FORMATS:
+            variant_format = DEFAULT_VARIANT_FORMAT
+        if variant_format not in VARIANT_FORMATS:
+            raise HTTPException(status_code=400,
+                                detail=f"Unsupported format, use one of: {', '.join(VARIANT_FORMATS)}.")
+        etag = f'{etag[:-1]}-{width or 0}x{height or 0}.{variant_format}"'
+
+    headers = {
+        "etag": etag,
+        "last-modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "cache-control": f"public, max-age={env_vars['image_cache_max_age']}",
+    }
+    if is_not_modified(request, etag, stat_result):
+        return Response(status_code=304, headers=headers)
+
+    if variant_format:
+        try:
+            variant_path = await get_image_variant(file_location, image_name, stat_result, width, height,
+                                                   variant_format, env_vars)
+        except RENDER_ERRORS as e:
+            logger.error(f"Failed to render a variant of {image_name}: {e}")
+            raise HTTPException(status_code=422, detail=f"Image '{image_name}' can not be resized or converted.")
+        return ImageFileResponse(variant_path, headers=headers, media_type=VARIANT_FORMATS[variant_format][1])
+
+    # FileResponse answers Range and If-Range requests
+    return ImageFileResponse(file_location, headers=headers, stat_result=stat_result,
+                             on_missing=lambda: get_image_stat_cache(env_vars).pop(image_name))
 
 
 @router.delete("/images/{image_name}")
 async def delete_image(image_name: str, env_vars: dict = Depends(get_env_vars)):
-    upload_directory = env_vars.get('image_upload_directory')
-    file_location = os.path.join(upload_directory, image_name)
-    if not os.path.exists(file_location):
+    check_image_name(image_name)
+    if not await run_in_threadpool(get_image_store(env_vars).delete, image_name):
         raise HTTPException(status_code=404, detail="Image not found")
-    os.remove(file_location)
+    get_image_stat_cache(env_vars).pop(image_name)
+    await run_in_threadpool(delete_image_variants, image_name, env_vars)
     return {"detail": f"Image '{image_name}' deleted successfully"}
@@ -1,21 +1,30 @@
 from fastapi import APIRouter, HTTPException, Request, Depends
 import os
+import shutil
+import tempfile
 from app.utils.logger import setup_logger
 from io import StringIO
 import pandas as pd
-from app.services.importer_common import clear_cache_cbioportal, load_data_to_cbioportal, get_study_directory
+from app.services.importer_common import import_study_to_cbioportal, get_study_directory, study_directory_index
+from app.services.job_queue import get_import_queue
+from app.services.study_data_store import upsert_data_file
+from app.services.study_files import study_lock, write_file_atomic, IMPORT_LOCK_FILE_NAME
+from starlette.concurrency import run_in_threadpool
 from app.dependencies import get_env_vars
 
 router = APIRouter()
 logger = setup_logger(__name__)
 
 
-def merge_data(new_data: str, data_file_path: str, key_columns: list) -> pd.DataFrame:
-    df_input = pd.read_csv(StringIO(new_data), sep='\t', header=0)
+def merge_data(new_data: str, data_file_path: str, key_columns: list, as_strings: bool = False) -> pd.DataFrame:
+    # Reading the values as strings writes them back unchanged, instead of turning integer columns with blanks
+    # into float columns
+    read_options = {"dtype": str, "keep_default_na": False} if as_strings else {}
+    df_input = pd.read_csv(StringIO(new_data), sep='\t', header=0, **read_options)
 
     # If a file exists, read it and merge the new data with the previous data
     if os.path.exists(data_file_path):
-        df_previous = pd.read_csv(data_file_path, sep="\t")
+        df_previous = pd.read_csv(data_file_path, sep="\t", **read_options)
         try:
             # Remove rows in df_previous that have the same values in key_columns as in df_input
             df_previous = df_previous[
@@ -44,6 +53,200 @@ def merge_data_patient(new_data: str, data_file_path: str) -> pd.DataFrame:
     return merge_data(new_data, data_file_path, ["PATIENT_ID", "RESOURCE_ID"])
 
 
+# Expected content of the exported files, following the cBioPortal file formats
+PAYLOAD_SPECS = {
+    "timeline": {
+        "meta": {"genetic_alteration_type": "CLINICAL", "datatype": "TIMELINE"},
+        "required_columns": ["PATIENT_ID", "START_DATE", "STOP_DATE", "EVENT_TYPE"],
+        "non_empty_columns": ["PATIENT_ID", "START_DATE", "EVENT_TYPE"],
+        "integer_columns": ["START_DATE", "STOP_DATE"],
+        "allowed_values": {},
+        "unique_columns": None,
+    },
+    "resource_definition": {
+        "meta": {"resource_type": "DEFINITION"},
+        "required_columns": ["RESOURCE_ID", "DISPLAY_NAME", "RESOURCE_TYPE"],
+        "non_empty_columns": ["RESOURCE_ID", "DISPLAY_NAME", "RESOURCE_TYPE"],
+        "integer_columns": ["PRIORITY"],
+        "allowed_values": {"RESOURCE_TYPE": {"SAMPLE", "PATIENT", "STUDY"}, "OPEN_BY_DEFAULT": {"TRUE", "FALSE"}},
+        "unique_columns": ["RESOURCE_ID"],
+    },
+    "resource_patient": {
+        "meta": {"resource_type": "PATIENT"},
+        "required_columns": ["PATIENT_ID", "RESOURCE_ID", "URL"],
+        "non_empty_columns": ["PATIENT_ID", "RESOURCE_ID", "URL"],
+        "integer_columns": [],
+        "allowed_values": {},
+        "unique_columns": None,
+    },
+}
+
+# Maximum number of offending lines listed in an error
+MAX_REPORTED_LINES = 5
+
+
+def format_lines(mask: pd.Series) -> str:
+    # Line 1 is the header
+    lines = [str(index + 2) for index in mask[mask].index[:MAX_REPORTED_LINES]]
+    return ", ".join(lines) + (", ..." if mask.sum() > MAX_REPORTED_LINES else "")
+
+
+def validate_meta(meta_content: str, spec: dict, study_id: str, data_file_name: str) -> list:
+    errors = []
+    meta = {}
+    for line_number, line in enumerate(meta_content.splitlines(), 1):
+        if not line.strip() or line.startswith('#'):
+            continue
+        if ':' not in line:
+            errors.append(f"line {line_number} of the meta file is not a 'key: value' pair")
+            continue
+        key, value = line.split(':', 1)
+        meta[key.strip()] = value.strip()
+
+    expected = dict(spec["meta"], cancer_study_identifier=study_id, data_filename=data_file_name)
+    for key, value in expected.items():
+        if key not in meta:
+            errors.append(f"meta key '{key}' is missing")
+        elif meta[key] != value:
+            errors.append(f"meta key '{key}' is '{meta[key]}' instead of '{value}'")
+    return errors
+
+
+def validate_data(data_content: str, spec: dict) -> list:
+    try:
+        df = pd.read_csv(StringIO(data_content), sep='\t', header=0, dtype=str, keep_default_na=False)
+    except (pd.errors.ParserError, pd.errors.EmptyDataError) as e:
+        return [f"data can not be parsed: {e}"]
+
+    missing_columns = [column for column in spec["required_columns"] if column not in df.columns]
+    if missing_columns:
+        return [f"required columns {missing_columns} are missing"]
+    if df.empty:
+        return ["data has no rows"]
+
+    errors = []
+    for column in spec["non_empty_columns"]:
+        empty = df[column].str.strip().eq("")
+        if empty.any():
+            errors.append(f"column {column} is empty on lines {format_lines(empty)}")
+    for column in spec["integer_columns"]:
+        if column in df.columns:
+            values = df[column].str.strip()
+            invalid = values.ne("") & ~values.str.fullmatch(r"[+-]?\d+")
+            if invalid.any():
+                errors.append(f"column {column} is not an integer on lines {format_lines(invalid)}")
+    for column, allowed in spec["allowed_values"].items():
+        if column in df.columns:
+            values = df[column].str.strip().str.upper()
+            invalid = values.ne("") & ~values.isin(allowed)
+            if invalid.any():
+                errors.append(f"column {column} is not one of {sorted(allowed)} on lines {format_lines(invalid)}")
+    if spec["unique_columns"]:
+        duplicated = df.duplicated(spec["unique_columns"], keep=False)
+        if duplicated.any():
+            errors.append(f"{spec['unique_columns']} are not unique on lines {format_lines(duplicated)}")
+    return errors
+
+
+def validate_payload(kind: str, study_id: str, meta_content: str, data_content: str, data_file_path: str) -> None:
+    """
+    Checks an exported meta/data pair against the format of its kind, raising a 400 listing every problem found.
+    """
+    spec = PAYLOAD_SPECS[kind]
+    data_file_name = os.path.basename(data_file_path)
+    errors = validate_meta(meta_content, spec, study_id, data_file_name) + validate_data(data_content, spec)
+    if errors:
+        logger.error(f"Invalid {data_file_name} export for study {study_id}: {errors}")
+        raise HTTPException(status_code=400, detail=f"Invalid {data_file_name}: {'; '.join(errors)}")
+
+
+def stage_delta(study_id: str, file_pairs: list) -> dict:
+    """
+    Copies the exported meta/data pairs to a new delta directory so that they can be imported incrementally.
+    Must be called before the files are written to the study directory.
+    file_pairs is a list of (meta_file_path, meta_content, data_file_path, data_content, key_columns).
+    """
+    delta_directory_path = tempfile.mkdtemp(prefix=f"{study_id}_delta_")
+    delta_item = {"delta_directory": delta_directory_path, "key_columns": {}, "full_reload": False}
+
+    for meta_file_path, meta_content, data_file_path, data_content, key_columns in file_pairs:
+        # Changing the meta file of existing data can not be done incrementally
+        if os.path.exists(meta_file_path):
+            with open(meta_file_path) as f:
+                if f.read() != meta_content:
+                    delta_item["full_reload"] = True
+
+        with open(os.path.join(delta_directory_path, os.path.basename(meta_file_path)), 'w') as f:
+            f.write(meta_content)
+        with open(os.path.join(delta_directory_path, os.path.basename(data_file_path)), 'w') as f:
+            f.write(data_content)
+        delta_item["key_columns"][os.path.basename(data_file_path)] = key_columns
+
+    return delta_item
+
+
+def write_study_files(study_id: str, study_id_directory_path: str, file_pairs: list, env_vars: dict) -> dict:
+    """
+    Stages the delta of the exported files, then merges the data files and replaces the meta files,
+    all under the study lock so that concurrent exports to the study, from any worker, do not lose rows.
+    file_pairs is a list of (meta_file_path, meta_content, data_file_path, data_content, key_columns).
+    """
+    os.makedirs(study_id_directory_path, exist_ok=True)
+    with study_lock(study_id_directory_path, env_vars['study_lock_timeout']):
+        delta_item = stage_delta(study_id, file_pairs)
+        try:
+            for meta_file_path, meta_content, data_file_path, data_content, key_columns in file_pairs:
+                # Merge the new rows into the data file through its keyed store and write the meta file
+                upsert_data_file(data_content, data_file_path, key_columns)
+                write_file_atomic(meta_file_path, meta_content)
+        except BaseException:
+            # The export is not imported, so nothing else removes its delta
+            shutil.rmtree(delta_item["delta_directory"], ignore_errors=True)
+            raise
+    return delta_item
+
+
+def merge_delta_directories(delta_items: list) -> str:
+    if len(delta_items) == 1:
+        return delta_items[0]["delta_directory"]
+
+    batch_directory_path = tempfile.mkdtemp(prefix="delta_batch_")
+    for delta_item in delta_items:
+        for file_name in sorted(os.listdir(delta_item["delta_directory"])):
+            source_path = os.path.join(delta_item["delta_directory"], file_name)
+            target_path = os.path.join(batch_directory_path, file_name)
+            key_columns = delta_item["key_columns"].get(file_name)
+            if key_columns:
+                with open(source_path) as f:
+                    merge_data(f.read(), target_path, key_columns, as_strings=True).to_csv(target_path, sep='\t',
+                                                                                            index=False)
+            else:
+                shutil.copyfile(source_path, target_path)
+    return batch_directory_path
+
+
+def enqueue_study_import(study_id_directory_path: str, delta_item: dict, env_vars: dict) -> str:
+    def run_import(delta_items: list) -> dict:
+        logger.info(f"Importing {study_id_directory_path} for {len(delta_items)} export(s)")
+        delta_directories = {item["delta_directory"] for item in delta_items}
+        try:
+            delta_directory_path = None
+            if env_vars['import_incremental'] and not any(item["full_reload"] for item in delta_items):
+                delta_directory_path = merge_delta_directories(delta_items)
+                delta_directories.add(delta_directory_path)
+            # Other worker processes have their own queue, the import lock keeps one import at a time per study
+            with study_lock(study_id_directory_path, env_vars['import_lock_timeout'], IMPORT_LOCK_FILE_NAME):
+                return import_study_to_cbioportal(study_id_directory_path, env_vars['cbioportal_url'],
+                                                  env_vars['api_key'], delta_directory_path=delta_directory_path,
+                                                  env_vars=env_vars)
+        finally:
+            for directory_path in delta_directories:
+                shutil.rmtree(directory_path, ignore_errors=True)
+
+    # Exports to the same study arriving within IMPORT_COALESCE_WINDOW share a single importer run
+    return get_import_queue(env_vars).submit(study_id_directory_path, delta_item, run_import)
+
+
 @router.post("/export-timeline-to-cbioportal/")
 async def export_timeline_to_cbioportal(request: Request, env_vars: dict = Depends(get_env_vars)) -> dict:
     try:
@@ -64,22 +267,18 @@ async def export_timeline_to_cbioportal(request: Request, env_vars: dict = Depen
         meta_outfile_path = os.path.join(study_id_directory_path, f"meta_timeline_{suffix}.txt")
         data_outfile_path = os.path.join(study_id_directory_path, f"data_timeline_{suffix}.txt")
 
-        df = merge_data_timeline(data_content, data_outfile_path)
-
-        os.makedirs(study_id_directory_path, exist_ok=True)
+        # Rejected before anything is written or imported
+        # The payload is parsed with pandas, which would hold the event loop for large exports
+        await run_in_threadpool(validate_payload, "timeline", study_id, meta_content, data_content, data_outfile_path)
 
-        # Write the data and meta files to incremental_import directory
-        df.to_csv(data_outfile_path, sep='\t', index=False)
-        with open(meta_outfile_path, 'w') as f:
-            f.write(meta_content)
-
-        load_message = load_data_to_cbioportal(study_id_directory_path, env_vars['cbioportal_url'], incremental=False)
-        logger.debug(f"Load message: {load_message}")
+        delta_item = await run_in_threadpool(write_study_files, study_id, study_id_directory_path, [
+            (meta_outfile_path, meta_content, data_outfile_path, data_content, ["PATIENT_ID"])], env_vars)
 
-        clear_cache_message = clear_cache_cbioportal(env_vars['cbioportal_url'], env_vars['api_key'])
-        logger.debug(f"Clear cache message: {clear_cache_message}")
+        job_id = await run_in_threadpool(enqueue_study_import, study_id_directory_path, delta_item, env_vars)
 
-        return {"message": "Data successfully exported to cBioPortal."}
+        return {"message": "Data successfully exported to cBioPortal. Import queued.", "job_id": job_id}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -108,27 +307,35 @@ async def export_ressource_to_cbioportal(request: Request, env_vars: dict = Depe
         meta_patient_outfile_path = os.path.join(study_id_directory_path, "meta_resource_patient.txt")
         data_patient_outfile_path = os.path.join(study_id_directory_path, "data_resource_patient.txt")
 
-        df_definition = merge_data_resource_definition(data_definition_content, data_definition_outfile_path)
-        df_patient = merge_data_patient(data_patient_content, data_patient_outfile_path)
+        await run_in_threadpool(validate_payload, "resource_definition", study_id, meta_resource_content,
+                                data_definition_content, data_definition_outfile_path)
+        await run_in_threadpool(validate_payload, "resource_patient", study_id, meta_patient_content,
+                                data_patient_content, data_patient_outfile_path)
 
-        os.makedirs(study_id_directory_path, exist_ok=True)
+        delta_item = await run_in_threadpool(write_study_files, study_id, study_id_directory_path, [
+            (meta_definition_outfile_path, meta_resource_content, data_definition_outfile_path,
+             data_definition_content, ["RESOURCE_ID"]),
+            (meta_patient_outfile_path, meta_patient_content, data_patient_outfile_path,
+             data_patient_content, ["PATIENT_ID", "RESOURCE_ID"]),
+        ], env_vars)
 
-        df_definition.to_csv(data_definition_outfile_path, sep='\t', index=False)
-        with open(meta_definition_outfile_path, 'w') as f:
-            f.write(meta_resource_content)
+        job_id = await run_in_threadpool(enqueue_study_import, study_id_directory_path, delta_item, env_vars)
 
-        df_patient.to_csv(data_patient_outfile_path, sep='\t', index=False)
-        with open(meta_patient_outfile_path, 'w') as f:
-            f.write(meta_patient_content)
+        return {"message": "Data successfully exported to cBioPortal. Import queued.", "job_id": job_id}
 
-        load_message = load_data_to_cbioportal(study_id_directory_path, env_vars['cbioportal_url'], incremental=False)
-        logger.debug(f"Load message: {load_message}")
-
-        clear_cache_message = clear_cache_cbioportal(env_vars['cbioportal_url'], env_vars['api_key'])
-        logger.debug(f"Clear cache message: {clear_cache_message}")
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.error(f"An error occurred: {e}")
+        raise HTTPException(status_code=500, detail=str(e))
 
-        return {"message": "Data successfully exported to cBioPortal."}
 
+@router.post("/studies/index/rebuild")
+async def rebuild_study_index(env_vars: dict = Depends(get_env_vars)) -> dict:
+    try:
+        index = study_directory_index.rebuild(env_vars['study_directory_path'])
+        duplicates = sorted(study_id for study_id, list_dir in index.items() if len(list_dir) > 1)
+        return {"message": f"Indexed {len(index)} studies.", "duplicate_studies": duplicates}
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -0,0 +1,15 @@
+from fastapi import APIRouter, HTTPException, Depends
+from app.dependencies import get_env_vars
+from app.services.job_queue import get_import_queue
+from app.utils.logger import setup_logger
+
+router = APIRouter()
+logger = setup_logger(__name__)
+
+
+@router.get("/jobs/{job_id}")
+async def get_job(job_id: str, env_vars: dict = Depends(get_env_vars)) -> dict:
+    job = get_import_queue(env_vars).get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found")
+    return job
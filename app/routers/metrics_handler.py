@@ -0,0 +1,11 @@
+from fastapi import APIRouter
+from app.services.cbioportal_client import get_cbioportal_metrics
+from app.services.study_files import get_study_lock_metrics, IMPORT_LOCK_FILE_NAME
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def get_metrics() -> dict:
+    return {"cbioportal": get_cbioportal_metrics(), "study_locks": get_study_lock_metrics(),
+            "import_locks": get_study_lock_metrics(IMPORT_LOCK_FILE_NAME)}
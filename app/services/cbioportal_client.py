@@ -0,0 +1,132 @@
+import random
+import threading
+import time
+from typing import Dict
+
+import requests
+from fastapi import HTTPException
+from requests.adapters import HTTPAdapter
+
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Number of connections kept open to a cBioPortal instance
+CBIOPORTAL_POOL_SIZE = 4
+
+
+class CBioPortalClient:
+    """
+    Admin client of a cBioPortal instance, sending its requests through a pooled session.
+
+    Cache invalidations are single-flight: a caller whose invalidation request arrives while another
+    invalidation is running waits for the next one, and every caller that was waiting when an
+    invalidation started shares its result instead of sending its own request.
+    """
+
+    def __init__(self, cbioportal_url: str, timeout: float, max_retries: int, retry_delay: float):
+        self.cbioportal_url = cbioportal_url.rstrip("/")
+        self.timeout = timeout
+        # The request is sent at least once, even when retries are disabled
+        self.max_retries = max(1, max_retries)
+        self.retry_delay = retry_delay
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=CBIOPORTAL_POOL_SIZE, pool_maxsize=CBIOPORTAL_POOL_SIZE)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._lock = threading.Lock()
+        self._flight_lock = threading.Lock()
+        self._requested_generation = 0
+        self._completed_generation = 0
+        self._last_result = None
+        self._metrics = {
+            "requests": 0,
+            "failures": 0,
+            "retries": 0,
+            "deduplicated": 0,
+            "latency_total": 0.0,
+            "latency_max": 0.0,
+            "latency_last": None,
+        }
+
+    def invalidate_cache(self, api_key: str) -> Dict[str, str]:
+        with self._lock:
+            self._requested_generation += 1
+            generation = self._requested_generation
+
+        with self._flight_lock:
+            with self._lock:
+                if self._completed_generation >= generation:
+                    self._metrics["deduplicated"] += 1
+                    logger.info(f"Cache of {self.cbioportal_url} already cleared by a concurrent invalidation")
+                    return self._last_result
+                # This invalidation covers every request made until now
+                started_generation = self._requested_generation
+
+            result = {"output": self._request("delete", "/api/cache", api_key)}
+            with self._lock:
+                self._completed_generation = started_generation
+                self._last_result = result
+            return result
+
+    def get_metrics(self) -> Dict:
+        with self._lock:
+            metrics = dict(self._metrics)
+        metrics["latency_mean"] = metrics["latency_total"] / metrics["requests"] if metrics["requests"] else None
+        return metrics
+
+    def _request(self, method: str, path: str, api_key: str) -> str:
+        url = f"{self.cbioportal_url}{path}"
+        for attempt in range(self.max_retries):
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, headers={"X-API-KEY": api_key}, timeout=self.timeout)
+                error = None if response.status_code < 500 else f"{response.status_code}: {response.text}"
+            except requests.exceptions.RequestException as e:
+                response, error = None, str(e)
+            self._record(time.monotonic() - start, error is not None or response.status_code >= 400)
+
+            if error is None:
+                if response.status_code >= 400:
+                    # Like the curl command used before, client errors are reported in the output only
+                    logger.warning(f"{method.upper()} {url} returned {response.status_code}: {response.text}")
+                return response.text
+            if attempt == self.max_retries - 1:
+                logger.error(f"{method.upper()} {url} failed after {self.max_retries} attempts: {error}")
+                raise HTTPException(status_code=500, detail=error)
+
+            delay = self.retry_delay * 2 ** attempt
+            delay += random.uniform(0, delay)
+            with self._lock:
+                self._metrics["retries"] += 1
+            logger.warning(f"{method.upper()} {url} failed ({error}), retrying in {delay:.2f} seconds")
+            time.sleep(delay)
+
+    def _record(self, latency: float, failed: bool) -> None:
+        with self._lock:
+            self._metrics["requests"] += 1
+            self._metrics["failures"] += int(failed)
+            self._metrics["latency_total"] += latency
+            self._metrics["latency_max"] = max(self._metrics["latency_max"], latency)
+            self._metrics["latency_last"] = latency
+
+
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_cbioportal_client(cbioportal_url: str, env_vars: dict) -> CBioPortalClient:
+    with _clients_lock:
+        client = _clients.get(cbioportal_url)
+        if client is None:
+            client = CBioPortalClient(cbioportal_url, env_vars['cbioportal_timeout'], env_vars['cbioportal_max_retries'],
+                                      env_vars['cbioportal_retry_delay'])
+            _clients[cbioportal_url] = client
+        return client
+
+
+def get_cbioportal_metrics() -> Dict[str, Dict]:
+    with _clients_lock:
+        clients = dict(_clients)
+    return {cbioportal_url: client.get_metrics() for cbioportal_url, client in clients.items()}
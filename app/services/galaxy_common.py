@@ -0,0 +1,275 @@
+import asyncio
+import hashlib
+import json
+import random
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from typing import Any, Callable
+
+import requests
+from bioblend import ConnectionError
+from bioblend.galaxy import GalaxyInstance
+from bioblend.util import FileStream
+from fastapi import HTTPException
+from requests.adapters import HTTPAdapter
+from requests_toolbelt import MultipartEncoder
+from starlette.concurrency import run_in_threadpool
+
+from app.utils.cache import TTLCache
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Upper bound of the backoff between two connection attempts, in seconds
+MAX_RETRY_DELAY = 30
+
+
+class PooledGalaxyInstance(GalaxyInstance):
+    """
+    GalaxyInstance sending its requests through a shared requests.Session to reuse connections.
+
+    When a circuit breaker is attached, requests fail fast with a 503 while it is open and their
+    connection failures and server errors are reported to it.
+    """
+
+    def __init__(self, url: str, key: str, session: requests.Session, breaker: "CircuitBreaker" = None):
+        super().__init__(url, key)
+        self.session = session
+        self.breaker = breaker
+
+    def make_get_request(self, url: str, **kwargs: Any) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        kwargs.setdefault("verify", self.verify)
+        return self._call(self.session.get, url, headers=self.json_headers, **kwargs)
+
+    def make_post_request(self, url: str, payload: dict = None, params: dict = None,
+                          files_attached: bool = False) -> Any:
+        if files_attached:
+            fields = dict(payload or {})
+            fields.update(params or {})
+            # The encoder streams attached files from their file objects instead of loading them
+            data = MultipartEncoder(fields={name: value if isinstance(value, (FileStream, str, bytes)) else json.dumps(value)
+                                            for name, value in fields.items()})
+            headers = dict(self.json_headers, **{"Content-Type": data.content_type})
+            return self._decode(self._call(self.session.post, url, data=data, headers=headers, timeout=self.timeout,
+                                           allow_redirects=False, verify=self.verify))
+        return self._decode(self._send("post", url, payload, params))
+
+    def make_delete_request(self, url: str, payload: dict = None, params: dict = None) -> requests.Response:
+        return self._send("delete", url, payload, params)
+
+    def make_put_request(self, url: str, payload: dict = None, params: dict = None) -> Any:
+        return self._decode(self._send("put", url, payload, params))
+
+    def make_patch_request(self, url: str, payload: dict = None, params: dict = None) -> Any:
+        return self._decode(self._send("patch", url, payload, params))
+
+    def _send(self, method: str, url: str, payload: dict, params: dict) -> requests.Response:
+        return self._call(self.session.request, method, url, params=params,
+                          data=json.dumps(payload) if payload is not None else None,
+                          headers=self.json_headers, timeout=self.timeout, allow_redirects=False,
+                          verify=self.verify)
+
+    def _call(self, send: Callable, *args: Any, **kwargs: Any) -> requests.Response:
+        if self.breaker is None:
+            return send(*args, **kwargs)
+        if self.breaker.is_open:
+            raise HTTPException(status_code=503, detail=f"Galaxy at {self.base_url} is unavailable, retry later")
+        try:
+            response = send(*args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            if self.breaker.record_failure():
+                logger.error(f"Opening circuit breaker for {self.base_url} after {self.breaker.failures} failures")
+            raise
+        if response.status_code >= 500:
+            if self.breaker.record_failure():
+                logger.error(f"Opening circuit breaker for {self.base_url} after {self.breaker.failures} failures")
+        else:
+            self.breaker.record_success()
+        return response
+
+    @staticmethod
+    def _decode(r: requests.Response) -> Any:
+        if r.status_code == 200:
+            try:
+                return r.json()
+            except Exception as e:
+                raise ConnectionError(f"Request was successful, but cannot decode the response content: {e}",
+                                      body=r.content, status_code=r.status_code)
+        raise ConnectionError(f"Unexpected HTTP status code: {r.status_code}", body=r.text,
+                              status_code=r.status_code)
+
+
+class CircuitBreaker:
+    """
+    Opens after ``failure_threshold`` consecutive connection failures so that requests fail fast.
+    A health probe closes it again once Galaxy answers.
+    """
+
+    def __init__(self, failure_threshold: int):
+        self.failure_threshold = failure_threshold
+        self.failures = 0
+        self.is_open = False
+        self.probe_task = None
+        self._lock = threading.Lock()
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.failures = 0
+            self.is_open = False
+
+    def record_failure(self) -> bool:
+        """
+        Returns True if this failure opened the breaker.
+        """
+        with self._lock:
+            self.failures += 1
+            if not self.is_open and self.failures >= self.failure_threshold:
+                self.is_open = True
+                return True
+            return False
+
+
+_sessions = {}
+_sessions_lock = threading.Lock()
+_galaxy_clients = None
+_circuit_breakers = {}
+_galaxy_metadata = None
+# Keys share a fixed set of locks so that the table does not grow with every history name and token
+SINGLE_FLIGHT_LOCK_COUNT = 64
+_single_flight_locks = [threading.Lock() for _ in range(SINGLE_FLIGHT_LOCK_COUNT)]
+
+
+def is_connection_failure(e: Exception) -> bool:
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    # bioblend raises its own ConnectionError for unexpected HTTP status codes, only retry server errors
+    return isinstance(e, ConnectionError) and (e.status_code is None or e.status_code >= 500)
+
+
+def get_galaxy_session(galaxy_url: str, pool_size: int) -> requests.Session:
+    with _sessions_lock:
+        session = _sessions.get(galaxy_url)
+        if session is None:
+            session = requests.Session()
+            # The session is shared between users, never keep their cookies
+            session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+            _sessions[galaxy_url] = session
+        return session
+
+
+def get_galaxy_client_cache(env_vars: dict) -> TTLCache:
+    global _galaxy_clients
+    with _sessions_lock:
+        if _galaxy_clients is None:
+            _galaxy_clients = TTLCache(env_vars['galaxy_client_cache_ttl'], env_vars['galaxy_client_cache_size'])
+        return _galaxy_clients
+
+
+def get_circuit_breaker(galaxy_url: str, env_vars: dict) -> CircuitBreaker:
+    with _sessions_lock:
+        breaker = _circuit_breakers.get(galaxy_url)
+        if breaker is None:
+            breaker = _circuit_breakers[galaxy_url] = CircuitBreaker(env_vars['galaxy_circuit_breaker_threshold'])
+        return breaker
+
+
+def get_galaxy_metadata_cache(env_vars: dict) -> TTLCache:
+    global _galaxy_metadata
+    with _sessions_lock:
+        if _galaxy_metadata is None:
+            _galaxy_metadata = TTLCache(env_vars['galaxy_metadata_cache_ttl'], max_size=1024)
+        return _galaxy_metadata
+
+
+def get_metadata_cache_key(gi: GalaxyInstance, kind: str, name: str) -> tuple:
+    return kind, gi.base_url, hash_token(gi.key), name
+
+
+def get_single_flight_lock(cache_key: tuple) -> threading.Lock:
+    # Never hold two of these locks at once, two keys may map to the same lock
+    return _single_flight_locks[hash(cache_key) % SINGLE_FLIGHT_LOCK_COUNT]
+
+
+def hash_token(galaxy_token: str) -> str:
+    return hashlib.sha256(galaxy_token.encode()).hexdigest()
+
+
+def create_galaxy_instance(galaxy_url: str, galaxy_token: str, env_vars: dict) -> GalaxyInstance:
+    gi = PooledGalaxyInstance(galaxy_url, galaxy_token,
+                              get_galaxy_session(galaxy_url, env_vars['galaxy_pool_size']))
+    # Fail now rather than in the middle of an export if Galaxy can not be reached
+    gi.config.get_version()
+    # Attached after the check, whose failures are already counted by call_galaxy_with_retry
+    gi.breaker = get_circuit_breaker(galaxy_url, env_vars)
+    return gi
+
+
+async def probe_galaxy(galaxy_url: str, breaker: CircuitBreaker, env_vars: dict) -> None:
+    session = get_galaxy_session(galaxy_url, env_vars['galaxy_pool_size'])
+    while breaker.is_open:
+        await asyncio.sleep(env_vars['galaxy_health_probe_interval'])
+        try:
+            response = await run_in_threadpool(session.get, f"{galaxy_url.rstrip('/')}/api/version", timeout=10)
+            if response.status_code == 200:
+                logger.info(f"Galaxy at {galaxy_url} is reachable again, closing circuit breaker")
+                breaker.record_success()
+        except requests.exceptions.RequestException as e:
+            logger.debug(f"Health probe of {galaxy_url} failed: {e}")
+
+
+def raise_if_open(galaxy_url: str, breaker: CircuitBreaker, env_vars: dict) -> None:
+    """
+    Raises a 503 while the breaker is open, making sure a health probe is running to close it.
+    """
+    if breaker.is_open:
+        if breaker.probe_task is None or breaker.probe_task.done():
+            breaker.probe_task = asyncio.create_task(probe_galaxy(galaxy_url, breaker, env_vars))
+        raise HTTPException(status_code=503, detail=f"Galaxy at {galaxy_url} is unavailable, retry later")
+
+
+async def call_galaxy_with_retry(galaxy_url: str, env_vars: dict, func: Callable, *args) -> Any:
+    """
+    Runs func(*args) in the thread pool, retrying connection failures with exponential backoff and jitter.
+    """
+    breaker = get_circuit_breaker(galaxy_url, env_vars)
+    max_retries = env_vars['galaxy_max_retries']
+    for attempt in range(max_retries):
+        raise_if_open(galaxy_url, breaker, env_vars)
+        try:
+            result = await run_in_threadpool(func, *args)
+            breaker.record_success()
+            return result
+        except Exception as e:
+            if not is_connection_failure(e):
+                raise
+            if breaker.record_failure():
+                logger.error(f"Opening circuit breaker for {galaxy_url} after {breaker.failures} failures")
+            if attempt == max_retries - 1:
+                logger.error(f"Failed to establish a new connection: {e}")
+                raise HTTPException(status_code=500, detail=f"Failed to establish a new connection: {e}")
+            delay = min(env_vars['galaxy_retry_delay'] * 2 ** attempt, MAX_RETRY_DELAY) * random.uniform(0.5, 1)
+            logger.debug(f"Attempt {attempt + 1} failed, retrying in {delay:.1f} seconds...")
+            await asyncio.sleep(delay)
+
+
+async def get_galaxy_instance_async(galaxy_url: str, galaxy_token: str, env_vars: dict) -> GalaxyInstance:
+    """
+    Returns the cached client for this Galaxy URL and token, connecting a new one if needed.
+    """
+    # Cached clients also fail fast while Galaxy is down instead of waiting for connection timeouts
+    raise_if_open(galaxy_url, get_circuit_breaker(galaxy_url, env_vars), env_vars)
+    cache = get_galaxy_client_cache(env_vars)
+    cache_key = (galaxy_url, hash_token(galaxy_token))
+    gi = cache.get(cache_key)
+    if gi is None:
+        logger.info(f"Creating GalaxyInstance with URL: {galaxy_url}")
+        gi = await call_galaxy_with_retry(galaxy_url, env_vars, create_galaxy_instance, galaxy_url, galaxy_token,
+                                          env_vars)
+        cache.set(cache_key, gi)
+    else:
+        logger.debug(f"Reusing GalaxyInstance for {galaxy_url}")
+    return gi
@@ -0,0 +1,107 @@
+import asyncio
+import threading
+import weakref
+from typing import Dict
+
+from bioblend.galaxy import GalaxyInstance
+from starlette.concurrency import run_in_threadpool
+
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Dataset states after which a dataset will never become ready
+FAILED_STATES = {"error", "failed_metadata", "discarded"}
+
+
+class DatasetReadinessScheduler:
+    """
+    Polls the state of every pending dataset from a single background task.
+
+    Each dataset is polled on its own schedule, starting after ``initial_delay`` seconds and
+    backing off by ``backoff`` up to ``max_delay`` seconds, and its waiter is woken up as soon
+    as the dataset reaches the ``ok`` state. A poll taking more than ``poll_timeout`` seconds counts
+    as a failed poll, so that a hung Galaxy call does not hold the other waits.
+    """
+
+    def __init__(self, initial_delay: float = 0.5, max_delay: float = 5.0, backoff: float = 1.5,
+                 poll_timeout: float = 30.0):
+        self.initial_delay = initial_delay
+        self.max_delay = max_delay
+        self.backoff = backoff
+        self.poll_timeout = poll_timeout
+        self.loop = asyncio.get_running_loop()
+        self._waits = []
+        self._wake_up = asyncio.Event()
+        self._task = None
+
+    async def wait_until_ready(self, gi: GalaxyInstance, dataset_id: str, timeout: float) -> Dict:
+        wait = {
+            "gi": gi,
+            "dataset_id": dataset_id,
+            "future": self.loop.create_future(),
+            "delay": self.initial_delay,
+            "next_poll": self.loop.time() + self.initial_delay,
+        }
+        self._waits.append(wait)
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        self._wake_up.set()
+
+        try:
+            return await asyncio.wait_for(wait["future"], timeout)
+        except asyncio.TimeoutError:
+            raise ValueError(f"Dataset {dataset_id} was not ready after {timeout} seconds")
+        finally:
+            if wait in self._waits:
+                self._waits.remove(wait)
+
+    async def _run(self) -> None:
+        while self._waits:
+            now = self.loop.time()
+            due = [wait for wait in self._waits if wait["next_poll"] <= now and not wait["future"].done()]
+            results = await asyncio.gather(
+                *(asyncio.wait_for(run_in_threadpool(wait["gi"].datasets.show_dataset, wait["dataset_id"]),
+                                   self.poll_timeout) for wait in due),
+                return_exceptions=True)
+
+            for wait, result in zip(due, results):
+                if wait["future"].done():
+                    continue
+                if isinstance(result, Exception):
+                    logger.warning(f"Failed to get the state of dataset {wait['dataset_id']}: {result}")
+                elif result.get("state") == "ok":
+                    logger.info(f"Dataset {wait['dataset_id']} is ready")
+                    wait["future"].set_result(result)
+                    continue
+                elif result.get("state") in FAILED_STATES:
+                    wait["future"].set_exception(
+                        ValueError(f"Dataset {wait['dataset_id']} is in state {result.get('state')}"))
+                    continue
+                wait["delay"] = min(wait["delay"] * self.backoff, self.max_delay)
+                wait["next_poll"] = self.loop.time() + wait["delay"]
+
+            self._waits = [wait for wait in self._waits if not wait["future"].done()]
+            if not self._waits:
+                break
+            self._wake_up.clear()
+            sleep_time = max(0.0, min(wait["next_poll"] for wait in self._waits) - self.loop.time())
+            try:
+                # New waits wake the scheduler up so that their first poll is not delayed
+                await asyncio.wait_for(self._wake_up.wait(), sleep_time)
+            except asyncio.TimeoutError:
+                pass
+
+
+# One scheduler per event loop: cohort workflow runs have their own event loops
+_schedulers = weakref.WeakKeyDictionary()
+_schedulers_lock = threading.Lock()
+
+
+async def wait_for_dataset(gi: GalaxyInstance, dataset_id: str, timeout: float) -> Dict:
+    loop = asyncio.get_running_loop()
+    with _schedulers_lock:
+        scheduler = _schedulers.get(loop)
+        if scheduler is None:
+            scheduler = _schedulers[loop] = DatasetReadinessScheduler()
+    return await scheduler.wait_until_ready(gi, dataset_id, timeout)
@@ -0,0 +1,115 @@
+import gzip
+from io import BytesIO
+from typing import Dict, Iterator, Optional
+
+from bioblend.galaxy import GalaxyInstance
+from bioblend.util import FileStream
+
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+# Number of characters encoded at a time
+ENCODE_CHUNK_SIZE = 1024 * 1024
+
+
+def get_body_start(text: str, first_line: Optional[str]) -> int:
+    if first_line is None:
+        return 0
+    newline = text.find("\n")
+    return len(text) if newline == -1 else newline + 1
+
+
+def iter_text(text: str, first_line: Optional[str] = None) -> Iterator[str]:
+    """
+    Yields text in chunks, with its first line replaced by first_line when given.
+    """
+    if first_line is not None:
+        yield f"{first_line}\n"
+    for position in range(get_body_start(text, first_line), len(text), ENCODE_CHUNK_SIZE):
+        yield text[position:position + ENCODE_CHUNK_SIZE]
+
+
+class TextReader:
+    """
+    Read-only file object returning text as encoded bytes, one chunk at a time.
+
+    ``len`` is the number of bytes left to read, as expected by requests_toolbelt's MultipartEncoder.
+    """
+
+    def __init__(self, text: str, first_line: Optional[str] = None, encoding: str = "utf-8"):
+        self.encoding = encoding
+        if text.isascii() and (first_line is None or first_line.isascii()):
+            self.size = len(text) - get_body_start(text, first_line)
+            self.size += 0 if first_line is None else len(first_line) + 1
+        else:
+            self.size = sum(len(chunk.encode(encoding)) for chunk in iter_text(text, first_line))
+        self.bytes_read = 0
+        self._chunks = iter_text(text, first_line)
+        self._buffer = b""
+
+    @property
+    def len(self) -> int:
+        return self.size - self.bytes_read
+
+    def read(self, size: int = -1) -> bytes:
+        while size is None or size < 0 or len(self._buffer) < size:
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                break
+            self._buffer += chunk.encode(self.encoding)
+        if size is None or size < 0:
+            size = len(self._buffer)
+        data, self._buffer = self._buffer[:size], self._buffer[size:]
+        self.bytes_read += len(data)
+        return data
+
+    def close(self) -> None:
+        self._buffer = b""
+
+
+def gzip_text(text: str, first_line: Optional[str] = None, encoding: str = "utf-8") -> BytesIO:
+    buffer = BytesIO()
+    with gzip.GzipFile(fileobj=buffer, mode="wb", compresslevel=6, mtime=0) as f:
+        for chunk in iter_text(text, first_line):
+            f.write(chunk.encode(encoding))
+    buffer.seek(0)
+    return buffer
+
+
+def upload_text(gi: GalaxyInstance, history_id: str, text: str, file_name: str,
+                compress_threshold: int = 0, first_line: Optional[str] = None) -> Dict:
+    """
+    Uploads text to a new dataset through the fetch API, attaching it from memory.
+
+    The first line of the text is replaced by first_line while it is sent, without copying the text.
+    Text of at least compress_threshold characters is gzipped and decompressed by Galaxy,
+    a compress_threshold of 0 disables the compression.
+    """
+    compress = 0 < compress_threshold <= len(text)
+    if compress:
+        body = gzip_text(text, first_line)
+        logger.info(f"Uploading {file_name} gzipped from {len(text)} characters to {len(body.getbuffer())} bytes")
+    else:
+        body = TextReader(text, first_line)
+
+    payload = {
+        "history_id": history_id,
+        "targets": [{
+            "destination": {"type": "hdas"},
+            "elements": [{
+                "src": "files",
+                "ext": "auto",
+                "dbkey": "?",
+                "to_posix_lines": True,
+                "space_to_tab": False,
+                "name": file_name,
+            }],
+        }],
+        "auto_decompress": compress,
+        "files_0|file_data": FileStream(f"{file_name}.gz" if compress else file_name, body),
+    }
+    try:
+        return gi.make_post_request(f"{gi.url}/tools/fetch", payload=payload, files_attached=True)
+    finally:
+        body.close()
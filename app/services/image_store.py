@@ -0,0 +1,143 @@
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import closing
+from typing import Optional, Tuple
+
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+INDEX_FILE_NAME = ".image_index.sqlite"
+BLOB_DIRECTORY_NAME = ".blobs"
+RESERVED_IMAGE_NAMES = {INDEX_FILE_NAME, BLOB_DIRECTORY_NAME}
+
+
+def is_valid_image_name(name: str) -> bool:
+    """
+    Image names are plain file names. Hidden names are refused so that the index, the blobs and the
+    temporary files of the store are never served, replaced or deleted as legacy images.
+    """
+    return bool(name) and os.path.basename(name) == name and not name.startswith(".") \
+        and name not in RESERVED_IMAGE_NAMES
+
+
+class ImageStore:
+    """
+    Content-addressed image storage.
+
+    Image content is stored once per SHA-256 under hash-sharded subdirectories of ``.blobs`` and a
+    SQLite index maps image names to hashes. Images stored flat in the upload directory by older
+    versions are still served, and replaced by the indexed version when overwritten.
+    """
+
+    def __init__(self, upload_directory: str):
+        self.upload_directory = upload_directory
+        self.blob_directory = os.path.join(upload_directory, BLOB_DIRECTORY_NAME)
+        self.tmp_directory = os.path.join(self.blob_directory, "tmp")
+        self.index_path = os.path.join(upload_directory, INDEX_FILE_NAME)
+        os.makedirs(self.tmp_directory, exist_ok=True)
+        with closing(self._connect()) as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS images (name TEXT PRIMARY KEY, sha256 TEXT NOT NULL, "
+                               "size INTEGER NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS images_sha256 ON images (sha256)")
+
+    def blob_path(self, sha256: str) -> str:
+        return os.path.join(self.blob_directory, sha256[:2], sha256[2:4], sha256)
+
+    def legacy_path(self, name: str) -> str:
+        return os.path.join(self.upload_directory, name)
+
+    def lookup(self, name: str) -> Optional[Tuple[str, Optional[str]]]:
+        """
+        Returns the path of the image content and its SHA-256 (None for legacy images), or None if it does not exist.
+        """
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT sha256 FROM images WHERE name = ?", (name,)).fetchone()
+        if row:
+            return self.blob_path(row[0]), row[0]
+        if self.is_legacy_image(name):
+            return self.legacy_path(name), None
+        return None
+
+    def is_legacy_image(self, name: str) -> bool:
+        return is_valid_image_name(name) and os.path.isfile(self.legacy_path(name))
+
+    def create_temp_file(self):
+        return tempfile.NamedTemporaryFile(mode="wb", dir=self.tmp_directory, prefix=".upload_", delete=False)
+
+    def commit(self, name: str, tmp_path: str, sha256: str) -> None:
+        """
+        Stores the content of tmp_path under name, replacing the previous content of name.
+        """
+        if not is_valid_image_name(name):
+            raise ValueError(f"Invalid image name '{name}'")
+        connection = self._connect()
+        try:
+            # The write lock serializes commits and deletes, so a blob is never removed while being referenced
+            connection.execute("BEGIN IMMEDIATE")
+            blob_path = self.blob_path(sha256)
+            if os.path.exists(blob_path):
+                os.remove(tmp_path)
+                logger.info(f"Image '{name}' has the same content as an existing image, reusing {sha256}")
+            else:
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.chmod(tmp_path, 0o644)
+                os.replace(tmp_path, blob_path)
+
+            row = connection.execute("SELECT sha256 FROM images WHERE name = ?", (name,)).fetchone()
+            connection.execute("INSERT OR REPLACE INTO images (name, sha256, size) VALUES (?, ?, ?)",
+                               (name, sha256, os.stat(blob_path).st_size))
+            if row and row[0] != sha256:
+                self._remove_unreferenced_blob(connection, row[0])
+            if self.is_legacy_image(name):
+                os.remove(self.legacy_path(name))
+            connection.execute("COMMIT")
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def delete(self, name: str) -> bool:
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT sha256 FROM images WHERE name = ?", (name,)).fetchone()
+            if row:
+                connection.execute("DELETE FROM images WHERE name = ?", (name,))
+                self._remove_unreferenced_blob(connection, row[0])
+            deleted = row is not None
+            if self.is_legacy_image(name):
+                os.remove(self.legacy_path(name))
+                deleted = True
+            connection.execute("COMMIT")
+            return deleted
+        except BaseException:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+
+    def _remove_unreferenced_blob(self, connection: sqlite3.Connection, sha256: str) -> None:
+        if connection.execute("SELECT 1 FROM images WHERE sha256 = ? LIMIT 1", (sha256,)).fetchone() is None:
+            try:
+                os.remove(self.blob_path(sha256))
+            except FileNotFoundError:
+                pass
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.index_path, timeout=60, isolation_level=None)
+
+
+_image_stores = {}
+_image_stores_lock = threading.Lock()
+
+
+def get_image_store(env_vars: dict) -> ImageStore:
+    upload_directory = env_vars['image_upload_directory']
+    with _image_stores_lock:
+        if upload_directory not in _image_stores:
+            _image_stores[upload_directory] = ImageStore(upload_directory)
+        return _image_stores[upload_directory]
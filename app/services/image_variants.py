@@ -0,0 +1,148 @@
+import asyncio
+import os
+import shutil
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+VARIANT_FORMATS = {
+    "png": ("PNG", "image/png"),
+    "jpeg": ("JPEG", "image/jpeg"),
+    "webp": ("WEBP", "image/webp"),
+}
+
+# Default format of variants of images in a format that can not be written back
+DEFAULT_VARIANT_FORMAT = "png"
+
+_executor = None
+_executor_lock = threading.Lock()
+_variant_sizes = {}
+_variant_sizes_lock = threading.Lock()
+
+
+def get_variant_executor(env_vars: dict) -> ThreadPoolExecutor:
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=env_vars['image_variant_workers'],
+                                           thread_name_prefix="image-variant")
+        return _executor
+
+
+def get_variant_directory(env_vars: dict) -> str:
+    return env_vars['image_variant_directory'] or f"{env_vars['image_upload_directory'].rstrip('/')}_variants"
+
+
+def get_variant_path(env_vars: dict, image_name: str, stat_result: os.stat_result, width: int, height: int,
+                     variant_format: str) -> str:
+    # The original's inode and mtime are part of the name so that a variant of a replaced image is never served
+    file_name = f"{width or 0}x{height or 0}-{stat_result.st_ino:x}-{stat_result.st_mtime_ns:x}.{variant_format}"
+    return os.path.join(get_variant_directory(env_vars), image_name, file_name)
+
+
+# Errors of images that can not be rendered, DecompressionBombError is raised for images with too many pixels
+RENDER_ERRORS = (OSError, Image.DecompressionBombError)
+
+
+def render_variant(file_location: str, variant_path: str, width: int, height: int, variant_format: str) -> None:
+    with Image.open(file_location) as image:
+        image.thumbnail((width or image.width, height or image.height))
+        if variant_format == "jpeg" and image.mode not in ("RGB", "L"):
+            image = image.convert("RGB")
+        os.makedirs(os.path.dirname(variant_path), exist_ok=True)
+        with tempfile.NamedTemporaryFile(dir=os.path.dirname(variant_path), prefix=".tmp_", delete=False) as f:
+            try:
+                image.save(f, format=VARIANT_FORMATS[variant_format][0])
+            except BaseException:
+                f.close()
+                os.remove(f.name)
+                raise
+    os.replace(f.name, variant_path)
+
+
+def list_variants(variant_directory: str) -> list:
+    variants = []
+    for directory, _, file_names in os.walk(variant_directory):
+        for file_name in file_names:
+            try:
+                stat_result = os.stat(os.path.join(directory, file_name))
+                variants.append((stat_result.st_mtime, stat_result.st_size, os.path.join(directory, file_name)))
+            except FileNotFoundError:
+                pass
+    return variants
+
+
+def evict_variants(variant_directory: str, max_size: int) -> int:
+    """
+    Removes the least recently used variants until the variant cache fits in max_size bytes.
+    Returns the size of the remaining variants.
+    """
+    variants = list_variants(variant_directory)
+    total_size = sum(size for _, size, _ in variants)
+    for _, size, path in sorted(variants):
+        if total_size <= max_size:
+            break
+        try:
+            os.remove(path)
+            total_size -= size
+            logger.debug(f"Evicted image variant {path}")
+        except FileNotFoundError:
+            pass
+    return total_size
+
+
+def track_variant_size(variant_directory: str, size: int, max_size: int) -> None:
+    """
+    Adds size to the tracked size of the variant cache and evicts variants once it goes over max_size.
+    The variant directory is only walked the first time and when evicting, which also corrects the
+    tracked size for variants rendered or removed by other worker processes.
+    """
+    with _variant_sizes_lock:
+        total_size = _variant_sizes.get(variant_directory)
+        if total_size is None:
+            # The first walk already counts the new variant
+            total_size = sum(size for _, size, _ in list_variants(variant_directory))
+        else:
+            total_size += size
+        if total_size > max_size:
+            total_size = evict_variants(variant_directory, max_size)
+        _variant_sizes[variant_directory] = total_size
+
+
+def get_or_render_variant(file_location: str, variant_path: str, width: int, height: int, variant_format: str,
+                          env_vars: dict) -> None:
+    try:
+        # Variants are evicted by mtime, touching them on use makes the eviction LRU
+        os.utime(variant_path)
+        return
+    except FileNotFoundError:
+        pass
+    render_variant(file_location, variant_path, width, height, variant_format)
+    logger.info(f"Rendered image variant {variant_path}")
+    track_variant_size(get_variant_directory(env_vars), os.stat(variant_path).st_size,
+                       env_vars['image_variant_cache_size'])
+
+
+async def get_image_variant(file_location: str, image_name: str, stat_result: os.stat_result, width: int,
+                            height: int, variant_format: str, env_vars: dict) -> str:
+    variant_path = get_variant_path(env_vars, image_name, stat_result, width, height, variant_format)
+    await asyncio.get_running_loop().run_in_executor(get_variant_executor(env_vars), get_or_render_variant,
+                                                     file_location, variant_path, width, height, variant_format,
+                                                     env_vars)
+    return variant_path
+
+
+def delete_image_variants(image_name: str, env_vars: dict) -> None:
+    variant_directory = get_variant_directory(env_vars)
+    image_variant_directory = os.path.join(variant_directory, image_name)
+    removed_size = sum(size for _, size, _ in list_variants(image_variant_directory))
+    shutil.rmtree(image_variant_directory, ignore_errors=True)
+    with _variant_sizes_lock:
+        if variant_directory in _variant_sizes:
+            _variant_sizes[variant_directory] = max(0, _variant_sizes[variant_directory] - removed_size)
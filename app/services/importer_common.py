@@ -1,69 +1,161 @@
 import os
 import re
-import subprocess
 import logging
+import threading
+import time
 from fastapi import HTTPException
-from typing import Dict
+from typing import Dict, List
+from app.dependencies import get_env_vars
+from app.services.cbioportal_client import get_cbioportal_client
+from app.services.importer_worker import run_meta_import
 
 logger = logging.getLogger(__name__)
 
 
-def clear_cache_cbioportal(cbioportal_url: str, api_key: str) -> Dict[str, str]:
+def clear_cache_cbioportal(cbioportal_url: str, api_key: str, env_vars: dict = None) -> Dict[str, str]:
     try:
-        command = ["curl", "-X", "DELETE",
-                   f"{cbioportal_url}/api/cache",
-                   "-H", f"X-API-KEY: {api_key}"]
-
-        result = subprocess.run(command, capture_output=True, text=True)
-
-        if result.returncode != 0:
-            logger.error(f"Failed to clear cache: {result.stderr}")
-            raise HTTPException(status_code=500, detail=result.stderr)
-
-        logger.info(f"Cache cleared: {result.stdout}")
-        return {"output": result.stdout}
+        client = get_cbioportal_client(cbioportal_url, env_vars or get_env_vars())
+        result = client.invalidate_cache(api_key)
+        logger.info(f"Cache cleared: {result['output']}")
+        return result
+    except HTTPException as e:
+        logger.error(f"Failed to clear cache: {e.detail}")
+        raise
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
-def load_data_to_cbioportal(study_id_directory_path: str, cbioportal_url: str, incremental: bool = False) -> Dict[str, str]:
+def load_data_to_cbioportal(study_id_directory_path: str, cbioportal_url: str, incremental: bool = False,
+                            env_vars: dict = None) -> Dict[str, str]:
     try:
-        command = ["python", "/scripts/importer/metaImport.py",
-                   "-d" if incremental else "-s", study_id_directory_path,
-                   "-u", cbioportal_url,
-                   "-o"]
+        args = ["-d" if incremental else "-s", study_id_directory_path,
+                "-u", cbioportal_url,
+                "-o"]
 
-        result = subprocess.run(command, capture_output=True, text=True)
+        returncode, stdout, stderr = run_meta_import(args, env_vars or get_env_vars())
 
-        if result.returncode != 0:
-            logger.error(f"Failed to load data: {result.stderr}")
-            raise HTTPException(status_code=500, detail=result.stderr)
+        if returncode != 0:
+            logger.error(f"Failed to load data: {stderr}")
+            raise HTTPException(status_code=500, detail=stderr)
 
-        logger.info(f"Data loaded: {result.stdout}")
-        return {"output": result.stdout}
+        logger.info(f"Data loaded: {stdout}")
+        return {"output": stdout}
+    except HTTPException:
+        raise
     except Exception as e:
         logger.error(f"An error occurred: {e}")
         raise HTTPException(status_code=500, detail=str(e))
 
 
+def import_study_to_cbioportal(study_id_directory_path: str, cbioportal_url: str, api_key: str,
+                               delta_directory_path: str = None, env_vars: dict = None) -> Dict[str, str]:
+    import_mode = "full"
+    if delta_directory_path:
+        try:
+            load_message = load_data_to_cbioportal(delta_directory_path, cbioportal_url, incremental=True,
+                                                   env_vars=env_vars)
+            import_mode = "incremental"
+        except HTTPException as e:
+            logger.warning(f"Incremental import of {delta_directory_path} failed, falling back to a full reload: {e.detail}")
+
+    if import_mode == "full":
+        load_message = load_data_to_cbioportal(study_id_directory_path, cbioportal_url, incremental=False,
+                                               env_vars=env_vars)
+    logger.debug(f"Load message: {load_message}")
+
+    clear_cache_message = clear_cache_cbioportal(cbioportal_url, api_key, env_vars)
+    logger.debug(f"Clear cache message: {clear_cache_message}")
+
+    return {"import_mode": import_mode,
+            "import_output": load_message["output"],
+            "clear_cache_output": clear_cache_message["output"]}
+
+
+STUDY_IDENTIFIER_PATTERN = re.compile(r"^cancer_study_identifier: (.*)$")
+
+
+# Minimum time in seconds between two rebuilds of the study index caused by lookups of unknown studies
+MISSING_STUDY_REBUILD_INTERVAL = 5.0
+
+
+class StudyDirectoryIndex:
+    """
+    Maps cancer_study_identifier to the study directories containing it.
+
+    The index is rebuilt when the mtime of the study directory or of any indexed meta_study.txt
+    changes. Lookups of unknown studies rebuild it at most every MISSING_STUDY_REBUILD_INTERVAL seconds.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._path_to_study = None
+        self._root_mtime = None
+        self._index = {}
+        self._meta_mtimes = {}
+        self._rebuilt_at = None
+
+    def rebuild(self, path_to_study: str) -> Dict[str, List[str]]:
+        with self._lock:
+            self._rebuild(path_to_study)
+            return dict(self._index)
+
+    def lookup(self, study_id: str, path_to_study: str) -> List[str]:
+        with self._lock:
+            if self._is_stale(path_to_study):
+                self._rebuild(path_to_study)
+            elif study_id not in self._index and \
+                    time.monotonic() - self._rebuilt_at >= MISSING_STUDY_REBUILD_INTERVAL:
+                # Catches changes within the mtime granularity of the file system
+                self._rebuild(path_to_study)
+            return list(self._index.get(study_id, []))
+
+    def _is_stale(self, path_to_study: str) -> bool:
+        if path_to_study != self._path_to_study or os.stat(path_to_study).st_mtime_ns != self._root_mtime:
+            return True
+        # A meta_study.txt edited to the identifier of another study does not change the mtime of the root
+        return any(self._meta_mtime(d) != mtime for d, mtime in self._meta_mtimes.items())
+
+    @staticmethod
+    def _meta_mtime(study_directory: str):
+        try:
+            return os.stat(os.path.join(study_directory, "meta_study.txt")).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def _rebuild(self, path_to_study: str) -> None:
+        root_mtime = os.stat(path_to_study).st_mtime_ns
+        index = {}
+        meta_mtimes = {}
+
+        # Get list directories in the study directory
+        for file in sorted(os.listdir(path_to_study)):
+            d = os.path.join(path_to_study, file)
+            if os.path.isdir(d):
+                # Only index directories with a meta_study.txt file
+                try:
+                    meta_mtimes[d] = self._meta_mtime(d)
+                    with open(os.path.join(d, "meta_study.txt")) as f:
+                        for line in f:
+                            match = STUDY_IDENTIFIER_PATTERN.match(line.strip())
+                            if match and d not in index.get(match.group(1), []):
+                                index.setdefault(match.group(1), []).append(d)
+                except FileNotFoundError:
+                    pass
+
+        self._path_to_study = path_to_study
+        self._root_mtime = root_mtime
+        self._index = index
+        self._meta_mtimes = meta_mtimes
+        self._rebuilt_at = time.monotonic()
+        logger.info(f"Indexed {len(index)} studies in {path_to_study}")
+
+
+study_directory_index = StudyDirectoryIndex()
+
+
 def get_study_directory(study_id: str, path_to_study: str) -> str:
-    list_dir = []
-    pattern = re.compile(rf"^cancer_study_identifier: {re.escape(study_id)}$")
-
-    # Get list directories in the study directory
-    for file in os.listdir(path_to_study):
-        d = os.path.join(path_to_study, file)
-        if os.path.isdir(d):
-            # Only append if a file meta_study.txt is present with the correct study_id
-            try:
-                with open(os.path.join(d, "meta_study.txt")) as f:
-                    for line in f:
-                        if pattern.match(line.strip()):
-                            list_dir.append(d)
-                            break
-            except FileNotFoundError:
-                pass
+    list_dir = study_directory_index.lookup(study_id, path_to_study)
 
     if len(list_dir) == 0:
         logger.error(f"No directory found for study {study_id} in {path_to_study}")
@@ -74,4 +166,4 @@ def get_study_directory(study_id: str, path_to_study: str) -> str:
 
     logger.info(f"Study directory found: {list_dir[0]}")
 
-    return list_dir[0]
\ No newline at end of file
+    return list_dir[0]
@@ -0,0 +1,266 @@
+import importlib
+import logging
+import os
+import runpy
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import traceback
+import uuid
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import List, Optional, Tuple
+
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+IMPORTER_SCRIPT = "/scripts/importer/metaImport.py"
+
+# Modules of the cBioPortal importer loaded by the workers before their first job
+WARM_MODULES = ("cbioportal_common", "validateData", "cbioportalImporter",
+                "importer.cbioportal_common", "importer.validateData", "importer.cbioportalImporter")
+
+_progress_queue = None
+# Process state of a fresh worker, restored after every job
+_worker_state = None
+# Restores the state of the worker after a job, while the worker waits for the next one
+_reset_thread = None
+
+
+def init_worker(script: str, progress_queue) -> None:
+    global _progress_queue, _worker_state
+    _progress_queue = progress_queue
+    # Same module search path as when running the script with python
+    sys.path.insert(0, os.path.dirname(script))
+    warm_modules(script)
+    _worker_state = {"cwd": os.getcwd(), "environ": dict(os.environ),
+                     "root_handlers": list(logging.root.handlers), "root_level": logging.root.level}
+
+
+def warm_modules(script: str) -> None:
+    """
+    Imports the importer modules. Modules missing in this version of the importer are reported, the others are
+    still loaded.
+    """
+    loaded = []
+    for module in WARM_MODULES:
+        try:
+            importlib.import_module(module)
+            loaded.append(module)
+        except Exception as e:
+            logger.warning(f"Importer worker {os.getpid()} could not load module '{module}': {e}")
+    if not loaded:
+        logger.warning(f"Importer worker {os.getpid()} loaded none of the importer modules next to {script}")
+
+
+def reset_worker_state(script: str) -> None:
+    """
+    Gives the next job the state of a fresh worker: the importer modules are loaded again, dropping their globals,
+    and the working directory, the environment and the root logger are restored. Third-party modules such as
+    pandas stay loaded. State kept elsewhere, for example by the Java loader, is only dropped when the worker
+    is replaced after IMPORTER_WORKER_MAX_JOBS jobs.
+    """
+    script_directory = os.path.dirname(os.path.abspath(script))
+    for name, module in list(sys.modules.items()):
+        module_file = getattr(module, "__file__", None)
+        if module_file and os.path.abspath(module_file).startswith(script_directory + os.sep):
+            del sys.modules[name]
+    warm_modules(script)
+    os.chdir(_worker_state["cwd"])
+    os.environ.clear()
+    os.environ.update(_worker_state["environ"])
+    logging.root.handlers[:] = _worker_state["root_handlers"]
+    logging.root.setLevel(_worker_state["root_level"])
+
+
+def warm_up() -> int:
+    return os.getpid()
+
+
+def forward_output(fd: int, stream: str, lines: List[str]) -> None:
+    with os.fdopen(fd, errors="replace") as f:
+        for line in f:
+            lines.append(line)
+            if _progress_queue is not None:
+                _progress_queue.put((os.getpid(), stream, line.rstrip("\n")))
+
+
+def run_importer(script: str, args: List[str], started_path: Optional[str] = None) -> Tuple[int, str, str]:
+    """
+    Runs the importer script in this process and returns its return code, stdout and stderr.
+
+    The output is captured at the file descriptor level so that the output of the processes
+    started by the script, such as the Java loader, is captured too. started_path is created
+    once the job starts, so that the pool knows whether a job may have run when its worker dies.
+    """
+    global _reset_thread
+    if _reset_thread is not None:
+        # Almost always done already, the reset runs as soon as the previous job returns
+        _reset_thread.join()
+        _reset_thread = None
+    if started_path is not None:
+        open(started_path, "w").close()
+
+    outputs = {"stdout": [], "stderr": []}
+    saved_fds = {}
+    readers = []
+    for stream, fd in (("stdout", 1), ("stderr", 2)):
+        getattr(sys, stream).flush()
+        read_fd, write_fd = os.pipe()
+        saved_fds[fd] = os.dup(fd)
+        os.dup2(write_fd, fd)
+        os.close(write_fd)
+        reader = threading.Thread(target=forward_output, args=(read_fd, stream, outputs[stream]), daemon=True)
+        reader.start()
+        readers.append(reader)
+
+    saved_argv = sys.argv
+    sys.argv = [script] + list(args)
+    try:
+        runpy.run_path(script, run_name="__main__")
+        returncode = 0
+    except SystemExit as e:
+        if e.code is None or isinstance(e.code, int):
+            returncode = e.code or 0
+        else:
+            print(e.code, file=sys.stderr)
+            returncode = 1
+    except BaseException:
+        traceback.print_exc()
+        returncode = 1
+    finally:
+        sys.argv = saved_argv
+        for fd, saved_fd in saved_fds.items():
+            (sys.stdout if fd == 1 else sys.stderr).flush()
+            os.dup2(saved_fd, fd)
+            os.close(saved_fd)
+        for reader in readers:
+            reader.join()
+        if _worker_state is not None:
+            _reset_thread = threading.Thread(target=reset_worker_state, args=(script,), name="importer-reset")
+            _reset_thread.start()
+    return returncode, "".join(outputs["stdout"]), "".join(outputs["stderr"])
+
+
+def run_importer_subprocess(script: str, args: List[str]) -> Tuple[int, str, str]:
+    result = subprocess.run(["python", script] + list(args), capture_output=True, text=True)
+    return result.returncode, result.stdout, result.stderr
+
+
+class ImporterPool:
+    """
+    Pool of long-lived processes running the importer script with its modules already loaded.
+
+    The importer modules are loaded again after every job, while the worker waits for the next one, and workers
+    are replaced after ``max_jobs`` jobs so that state left behind by the importer elsewhere does not pile up.
+    The output of running jobs is logged line by line as it is produced.
+
+    When a worker dies, the jobs it never started raise BrokenProcessPool so that they can run elsewhere, while
+    the jobs that had started fail, since they may have loaded part of their data.
+    """
+
+    def __init__(self, workers: int, max_jobs: int, script: str = IMPORTER_SCRIPT):
+        self.workers = workers
+        self.max_jobs = max_jobs
+        self.script = script
+        self._context = multiprocessing.get_context("spawn")
+        self._progress_queue = self._context.Queue()
+        self._executor = None
+        self._jobs = 0
+        self._lock = threading.Lock()
+        # Holds a file per job created by the worker when the job starts
+        self._started_directory = None
+        threading.Thread(target=self._log_progress, name="importer-progress", daemon=True).start()
+
+    def start(self) -> None:
+        with self._lock:
+            executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(warm_up)
+
+    def run(self, args: List[str]) -> Tuple[int, str, str]:
+        with self._lock:
+            if self._jobs >= self.max_jobs:
+                # Jobs already submitted still complete on the previous workers
+                self._executor.shutdown(wait=False)
+                self._executor = None
+            executor = self._get_executor()
+            self._jobs += 1
+            if self._started_directory is None:
+                self._started_directory = tempfile.mkdtemp(prefix="cbioportal-importer-")
+            started_path = os.path.join(self._started_directory, uuid.uuid4().hex)
+            future = executor.submit(run_importer, self.script, args, started_path)
+        try:
+            return future.result()
+        except BrokenProcessPool as e:
+            with self._lock:
+                if self._executor is executor:
+                    self._executor = None
+            if not os.path.exists(started_path):
+                raise
+            logger.error(f"Importer worker died while running an import with arguments {args}: {e}")
+            return 1, "", f"The importer process died while running the import, it may have loaded part of the data: {e}"
+        finally:
+            if os.path.exists(started_path):
+                os.remove(started_path)
+
+    def shutdown(self, wait: bool = True) -> None:
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=wait)
+                self._executor = None
+            if wait and self._started_directory is not None:
+                shutil.rmtree(self._started_directory, ignore_errors=True)
+                self._started_directory = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers, mp_context=self._context,
+                                                 initializer=init_worker, initargs=(self.script, self._progress_queue))
+            self._jobs = 0
+        return self._executor
+
+    def _log_progress(self) -> None:
+        while True:
+            pid, stream, line = self._progress_queue.get()
+            logger.info(f"Importer {pid} {stream}: {line}")
+
+
+_importer_pool = None
+_importer_pool_lock = threading.Lock()
+
+
+def get_importer_pool(env_vars: dict) -> Optional[ImporterPool]:
+    """
+    Returns the importer pool, or None when it is disabled or the importer script is not installed.
+    """
+    global _importer_pool
+    if env_vars['importer_workers'] <= 0 or not os.path.isfile(IMPORTER_SCRIPT):
+        return None
+    with _importer_pool_lock:
+        if _importer_pool is None:
+            _importer_pool = ImporterPool(env_vars['importer_workers'], env_vars['importer_worker_max_jobs'])
+        return _importer_pool
+
+
+def shutdown_importer_pool() -> None:
+    with _importer_pool_lock:
+        if _importer_pool is not None:
+            _importer_pool.shutdown()
+
+
+def run_meta_import(args: List[str], env_vars: dict) -> Tuple[int, str, str]:
+    """
+    Runs metaImport.py with args on the importer pool, or in a new process when the pool is not available.
+    """
+    pool = get_importer_pool(env_vars)
+    if pool is not None:
+        try:
+            return pool.run(args)
+        except BrokenProcessPool as e:
+            logger.warning(f"Importer worker died before starting the import, running it in a new process: {e}")
+    return run_importer_subprocess(IMPORTER_SCRIPT, args)
@@ -0,0 +1,293 @@
+import json
+import os
+import sqlite3
+import threading
+import uuid
+import logging
+from collections import OrderedDict
+from contextlib import closing
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Callable, Dict, Optional
+
+from fastapi import HTTPException
+
+logger = logging.getLogger(__name__)
+
+# Number of finished jobs kept in memory so that their status can still be queried
+MAX_FINISHED_JOBS = 1000
+
+
+class JobStore:
+    def __init__(self, max_finished_jobs: int = MAX_FINISHED_JOBS):
+        self._jobs = OrderedDict()
+        self._lock = threading.Lock()
+        self._max_finished_jobs = max_finished_jobs
+
+    @staticmethod
+    def new_job(key: str) -> Dict:
+        return {
+            "id": uuid.uuid4().hex,
+            "key": key,
+            "status": "queued",
+            "created_at": datetime.now().isoformat(),
+            "started_at": None,
+            "finished_at": None,
+            "output": None,
+            "error": None,
+            "batch_id": None,
+            "batch_size": None,
+        }
+
+    def create(self, key: str) -> Dict:
+        job = self.new_job(key)
+        with self._lock:
+            self._jobs[job["id"]] = job
+            self._evict()
+        return dict(job)
+
+    def update(self, job_id: str, **fields) -> None:
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def fail_interrupted_jobs(self) -> int:
+        # Jobs kept in memory do not outlive the process that runs them
+        return 0
+
+    def _evict(self) -> None:
+        finished = [job_id for job_id, job in self._jobs.items() if job["status"] in ("succeeded", "failed")]
+        for job_id in finished[:max(0, len(finished) - self._max_finished_jobs)]:
+            del self._jobs[job_id]
+
+
+def get_process_start_time(pid: int) -> Optional[int]:
+    """
+    Returns the start time of a process in clock ticks since boot, None if it is not running or /proc is not available.
+    """
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            # The command name in parentheses may contain spaces, the start time is the 20th field after it
+            return int(f.read().rsplit(")", 1)[1].split()[19])
+    except (OSError, IndexError, ValueError):
+        return None
+
+
+def is_process_running(pid: int, start_time: Optional[int]) -> bool:
+    if start_time is None:
+        # Without /proc, a reused PID cannot be told apart from the process that created the job
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    return get_process_start_time(pid) == start_time
+
+
+class SQLiteJobStore:
+    """
+    Job store kept in a SQLite database, so that every worker process sees the jobs of the others.
+
+    Each job records the process that created it. Jobs left queued or running by a process that
+    no longer runs are marked as failed by ``fail_interrupted_jobs``.
+    """
+
+    def __init__(self, path: str, max_finished_jobs: int = MAX_FINISHED_JOBS):
+        self.path = path
+        self._max_finished_jobs = max_finished_jobs
+        self._pid = os.getpid()
+        self._pid_start_time = get_process_start_time(self._pid)
+        with closing(self._connect()) as connection:
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("CREATE TABLE IF NOT EXISTS jobs (id TEXT PRIMARY KEY, status TEXT NOT NULL, "
+                               "pid INTEGER NOT NULL, pid_start_time INTEGER, job TEXT NOT NULL)")
+            connection.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status)")
+
+    def create(self, key: str) -> Dict:
+        job = JobStore.new_job(key)
+        with closing(self._connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            connection.execute("INSERT INTO jobs (id, status, pid, pid_start_time, job) VALUES (?, ?, ?, ?, ?)",
+                               (job["id"], job["status"], self._pid, self._pid_start_time, json.dumps(job)))
+            connection.execute("DELETE FROM jobs WHERE rowid IN (SELECT rowid FROM jobs WHERE status IN "
+                               "('succeeded', 'failed') ORDER BY rowid DESC LIMIT -1 OFFSET ?)",
+                               (self._max_finished_jobs,))
+            connection.execute("COMMIT")
+        return job
+
+    def update(self, job_id: str, **fields) -> None:
+        with closing(self._connect()) as connection:
+            connection.execute("BEGIN IMMEDIATE")
+            row = connection.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()
+            if row:
+                job = json.loads(row[0])
+                job.update(fields)
+                connection.execute("UPDATE jobs SET status = ?, job = ? WHERE id = ?",
+                                   (job["status"], json.dumps(job), job_id))
+            connection.execute("COMMIT")
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        with closing(self._connect()) as connection:
+            row = connection.execute("SELECT job FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def fail_interrupted_jobs(self) -> int:
+        with closing(self._connect()) as connection:
+            rows = connection.execute("SELECT id, pid, pid_start_time FROM jobs "
+                                      "WHERE status IN ('queued', 'running')").fetchall()
+        interrupted = [job_id for job_id, pid, pid_start_time in rows if not is_process_running(pid, pid_start_time)]
+        for job_id in interrupted:
+            self.update(job_id, status="failed", error="Interrupted by a restart of the connector",
+                        finished_at=datetime.now().isoformat())
+        if interrupted:
+            logger.warning(f"Marked {len(interrupted)} interrupted jobs as failed")
+        return len(interrupted)
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=60, isolation_level=None)
+
+
+class StudyJobQueue:
+    """
+    Runs jobs on a bounded thread pool, one batch at a time per key (study directory).
+
+    Jobs submitted for the same key within ``coalesce_window`` seconds are merged into
+    a single batch: the runner is called once with the items of every job in the batch
+    and each job gets the outcome of that run.
+    """
+
+    def __init__(self, max_workers: int, coalesce_window: float = 0.0, store: JobStore = None):
+        self.store = store or JobStore()
+        self.coalesce_window = coalesce_window
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="import-worker")
+        self._pending = {}
+        self._running = set()
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._draining = False
+
+    def submit(self, key: str, item, runner: Callable[[list], Dict]) -> str:
+        """
+        Queues item for key and returns the id of its job. Writes the job store, so it must not be called
+        from the event loop.
+        """
+        job = self.store.create(key)
+        timer = None
+        with self._lock:
+            batch = self._pending.get(key)
+            is_new_batch = batch is None
+            if is_new_batch:
+                batch = self._pending[key] = {"id": uuid.uuid4().hex, "job_ids": [], "items": [], "ready": False}
+            batch["job_ids"].append(job["id"])
+            batch["items"].append(item)
+            # The latest runner wins, all runners submitted for a key are expected to be equivalent
+            batch["runner"] = runner
+            if is_new_batch and self.coalesce_window > 0 and not self._draining:
+                timer = batch["timer"] = threading.Timer(self.coalesce_window, self._dispatch,
+                                                         args=(key, batch["id"]))
+                timer.daemon = True
+        # The store may wait for other worker processes, so it is not written while holding the queue lock
+        self.store.update(job["id"], batch_id=batch["id"])
+        logger.info(f"Queued job {job['id']} for {key} in batch {batch['id']}")
+
+        if timer is not None:
+            timer.start()
+        elif is_new_batch:
+            self._dispatch(key, batch["id"])
+        return job["id"]
+
+    def get(self, job_id: str) -> Optional[Dict]:
+        return self.store.get(job_id)
+
+    def shutdown(self, wait: bool = True, timeout: Optional[float] = None) -> bool:
+        """
+        Starts the batches still waiting for their coalesce window and, if wait is set, waits up to
+        timeout seconds for every batch to finish. Returns False if batches were still running.
+        """
+        with self._lock:
+            self._draining = True
+            for key, batch in list(self._pending.items()):
+                if batch.get("timer") is not None:
+                    batch["timer"].cancel()
+                batch["ready"] = True
+                if key not in self._running:
+                    self._start(key)
+            drained = not wait or self._idle.wait_for(lambda: not self._pending and not self._running, timeout)
+            if not drained:
+                logger.warning(f"Stopped waiting for imports of {sorted(self._running)} after {timeout} seconds")
+        self._executor.shutdown(wait=wait and drained)
+        return drained
+
+    def _dispatch(self, key: str, batch_id: str) -> None:
+        with self._lock:
+            batch = self._pending.get(key)
+            # The batch may already have been started by shutdown
+            if batch is None or batch["id"] != batch_id:
+                return
+            batch["ready"] = True
+            if key not in self._running:
+                self._start(key)
+
+    def _start(self, key: str) -> None:
+        # Must be called with self._lock held
+        batch = self._pending.pop(key)
+        self._running.add(key)
+        self._executor.submit(self._run_batch, key, batch)
+
+    def _run_batch(self, key: str, batch: Dict) -> None:
+        job_ids = batch["job_ids"]
+        for job_id in job_ids:
+            self.store.update(job_id, status="running", started_at=datetime.now().isoformat(),
+                              batch_size=len(job_ids))
+        try:
+            output = batch["runner"](batch["items"])
+            for job_id in job_ids:
+                self.store.update(job_id, status="succeeded", output=output, finished_at=datetime.now().isoformat())
+            logger.info(f"Batch {batch['id']} for {key} succeeded ({len(job_ids)} jobs)")
+        except Exception as e:
+            error = e.detail if isinstance(e, HTTPException) else str(e)
+            for job_id in job_ids:
+                self.store.update(job_id, status="failed", error=error, finished_at=datetime.now().isoformat())
+            logger.error(f"Batch {batch['id']} for {key} failed: {error}")
+        finally:
+            with self._lock:
+                self._running.discard(key)
+                # A batch whose window expired while this one was running starts now
+                next_batch = self._pending.get(key)
+                if next_batch and next_batch["ready"]:
+                    self._start(key)
+                self._idle.notify_all()
+
+
+_import_queue = None
+_import_queue_lock = threading.Lock()
+
+
+def get_import_queue(env_vars: dict) -> StudyJobQueue:
+    global _import_queue
+    with _import_queue_lock:
+        if _import_queue is None:
+            # Worker processes share the jobs through the SQLite store, so any of them can report a job status
+            store = SQLiteJobStore(env_vars['job_store_path']) if env_vars['job_store_path'] else JobStore()
+            _import_queue = StudyJobQueue(env_vars['import_max_workers'], env_vars['import_coalesce_window'], store)
+        return _import_queue
+
+
+def shutdown_import_queue(timeout: Optional[float] = None) -> bool:
+    """
+    Runs the queued imports of this process to completion, waiting up to timeout seconds.
+    """
+    global _import_queue
+    with _import_queue_lock:
+        queue, _import_queue = _import_queue, None
+    if queue is None:
+        return True
+    logger.info("Waiting for the queued imports to finish")
+    return queue.shutdown(wait=True, timeout=timeout)
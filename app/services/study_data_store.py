@@ -0,0 +1,158 @@
+import csv
+import json
+import logging
+import os
+import sqlite3
+import tempfile
+from io import StringIO
+from typing import Iterator, List
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedDataStore:
+    """
+    SQLite sidecar of a tab-delimited study data file, keyed on the key columns.
+
+    Upserts replace only the rows sharing a key with the new data and the data file is then
+    regenerated by streaming the rows from the store. The store is re-seeded from the data file
+    when the file was changed by something else.
+    """
+
+    def __init__(self, data_file_path: str, key_columns: List[str]):
+        self.data_file_path = data_file_path
+        self.key_columns = key_columns
+        directory, file_name = os.path.split(data_file_path)
+        self.store_path = os.path.join(directory, f".{file_name}.sqlite")
+
+    def upsert(self, new_data: str) -> int:
+        columns, rows = read_tsv_rows(StringIO(new_data))
+
+        connection = self._connect()
+        try:
+            connection.execute("BEGIN IMMEDIATE")
+            self._sync_with_data_file(connection)
+            stored_columns = self._get_meta(connection, "columns") or []
+
+            has_key_columns = all(key in columns for key in self.key_columns)
+            if not has_key_columns or \
+                    (stored_columns and not all(key in stored_columns for key in self.key_columns)):
+                logger.warning(f"Previous file {self.data_file_path} does not have the required key columns. "
+                               f"Previous file will be overwritten.")
+                connection.execute("DELETE FROM rows")
+                stored_columns = []
+
+            all_columns = stored_columns + [column for column in columns if column not in stored_columns]
+            if stored_columns and all_columns != stored_columns:
+                self._add_columns(connection, stored_columns, all_columns)
+            self._set_meta(connection, "columns", all_columns)
+
+            new_rows = {}
+            for row in rows:
+                record = dict(zip(columns, row))
+                values = [record.get(column, "") for column in all_columns]
+                # Without key columns the new data replaces the whole file, its rows are only deduplicated
+                row_key = self._row_key(record) if has_key_columns else ""
+                new_rows.setdefault(row_key, {})[json.dumps(values)] = None
+
+            connection.executemany("DELETE FROM rows WHERE row_key = ?", [(key,) for key in new_rows])
+            connection.executemany("INSERT INTO rows (row_key, row) VALUES (?, ?)",
+                                   [(key, row) for key, key_rows in new_rows.items() for row in key_rows])
+
+            row_count = self._write_data_file(connection, all_columns)
+            connection.execute("COMMIT")
+        except Exception:
+            connection.execute("ROLLBACK")
+            raise
+        finally:
+            connection.close()
+        logger.info(f"Upserted {len(rows)} rows for {len(new_rows)} keys into {self.data_file_path}")
+        return row_count
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self.store_path, timeout=60, isolation_level=None)
+        connection.execute("CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value TEXT)")
+        connection.execute("CREATE TABLE IF NOT EXISTS rows (id INTEGER PRIMARY KEY AUTOINCREMENT, "
+                           "row_key TEXT NOT NULL, row TEXT NOT NULL)")
+        connection.execute("CREATE INDEX IF NOT EXISTS rows_row_key ON rows (row_key)")
+        return connection
+
+    def _row_key(self, record: dict) -> str:
+        return json.dumps([record[key] for key in self.key_columns])
+
+    def _sync_with_data_file(self, connection: sqlite3.Connection) -> None:
+        if self._get_meta(connection, "data_file_stat") == self._data_file_stat():
+            return
+
+        logger.info(f"Seeding {self.store_path} from {self.data_file_path}")
+        connection.execute("DELETE FROM rows")
+        connection.execute("DELETE FROM meta")
+        if not os.path.exists(self.data_file_path):
+            return
+
+        with open(self.data_file_path, newline='') as f:
+            columns, rows = read_tsv_rows(f)
+        self._set_meta(connection, "columns", columns)
+        if all(key in columns for key in self.key_columns):
+            connection.executemany("INSERT INTO rows (row_key, row) VALUES (?, ?)",
+                                   ((self._row_key(dict(zip(columns, row))), json.dumps(row))
+                                    for row in unique_rows(rows)))
+        else:
+            connection.executemany("INSERT INTO rows (row_key, row) VALUES ('', ?)",
+                                   ((json.dumps(row),) for row in unique_rows(rows)))
+
+    def _add_columns(self, connection: sqlite3.Connection, stored_columns: list, all_columns: list) -> None:
+        padding = [""] * (len(all_columns) - len(stored_columns))
+        updated = [(json.dumps(json.loads(row) + padding), row_id)
+                   for row_id, row in connection.execute("SELECT id, row FROM rows")]
+        connection.executemany("UPDATE rows SET row = ? WHERE id = ?", updated)
+
+    def _write_data_file(self, connection: sqlite3.Connection, columns: list) -> int:
+        directory = os.path.dirname(self.data_file_path) or "."
+        row_count = 0
+        with tempfile.NamedTemporaryFile("w", dir=directory, prefix=".tmp_", delete=False, newline='') as f:
+            writer = csv.writer(f, delimiter='\t', lineterminator='\n')
+            writer.writerow(columns)
+            for (row,) in connection.execute("SELECT row FROM rows ORDER BY id"):
+                writer.writerow(json.loads(row))
+                row_count += 1
+        previous_stat = self._data_file_stat()
+        os.chmod(f.name, os.stat(self.data_file_path).st_mode if previous_stat else 0o644)
+        os.replace(f.name, self.data_file_path)
+        self._set_meta(connection, "data_file_stat", self._data_file_stat())
+        return row_count
+
+    def _data_file_stat(self):
+        try:
+            stat = os.stat(self.data_file_path)
+            return [stat.st_size, stat.st_mtime_ns]
+        except FileNotFoundError:
+            return None
+
+    @staticmethod
+    def _get_meta(connection: sqlite3.Connection, name: str):
+        row = connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    @staticmethod
+    def _set_meta(connection: sqlite3.Connection, name: str, value) -> None:
+        connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, json.dumps(value)))
+
+
+def read_tsv_rows(f) -> tuple:
+    reader = csv.reader(f, delimiter='\t')
+    columns = next(reader, [])
+    rows = [row + [""] * (len(columns) - len(row)) for row in reader if row]
+    return columns, rows
+
+
+def unique_rows(rows: list) -> Iterator[list]:
+    seen = set()
+    for row in rows:
+        if tuple(row) not in seen:
+            seen.add(tuple(row))
+            yield row
+
+
+def upsert_data_file(new_data: str, data_file_path: str, key_columns: List[str]) -> int:
+    return KeyedDataStore(data_file_path, key_columns).upsert(new_data)
@@ -0,0 +1,107 @@
+import fcntl
+import os
+import tempfile
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+from fastapi import HTTPException
+
+from app.utils.logger import setup_logger
+
+logger = setup_logger(__name__)
+
+STUDY_LOCK_FILE_NAME = ".connector.lock"
+IMPORT_LOCK_FILE_NAME = ".connector.import.lock"
+
+# Delay between two attempts to take a busy study lock, in seconds
+LOCK_POLL_INTERVAL = 0.05
+
+# Metrics key and error detail, when the lock is not acquired in time, of each lock file
+LOCK_TYPES = {
+    STUDY_LOCK_FILE_NAME: ("study_locks", "The study is being updated by another export, try again later."),
+    IMPORT_LOCK_FILE_NAME: ("import_locks", "Another import of the study did not finish in time, try again later."),
+}
+
+_lock_metrics = {
+    metrics_key: {
+        "acquired": 0,
+        "contended": 0,
+        "timeouts": 0,
+        "wait_total": 0.0,
+        "wait_max": 0.0,
+    }
+    for metrics_key, _ in LOCK_TYPES.values()
+}
+_lock_metrics_lock = threading.Lock()
+
+
+@contextmanager
+def study_lock(study_directory_path: str, timeout: Optional[float], lock_file_name: str = STUDY_LOCK_FILE_NAME):
+    """
+    Holds the exclusive lock of a study directory.
+
+    The lock is a flock on a file of the study directory, so it excludes other threads and other
+    worker processes alike. Raises a 503 when the lock is not acquired within timeout seconds,
+    waits as long as needed when timeout is None. Each lock file has its own metrics.
+    """
+    metrics_key, timeout_detail = LOCK_TYPES[lock_file_name]
+    fd = os.open(os.path.join(study_directory_path, lock_file_name), os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+        start = time.monotonic()
+        contended = False
+        while True:
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                break
+            except BlockingIOError:
+                contended = True
+                if timeout is not None and time.monotonic() - start >= timeout:
+                    record_lock_wait(metrics_key, time.monotonic() - start, contended, timed_out=True)
+                    logger.error(f"Timed out after {timeout} seconds waiting for {lock_file_name} of {study_directory_path}")
+                    raise HTTPException(status_code=503, detail=timeout_detail)
+                time.sleep(LOCK_POLL_INTERVAL)
+
+        wait = time.monotonic() - start
+        record_lock_wait(metrics_key, wait, contended, timed_out=False)
+        if contended:
+            logger.info(f"Waited {wait:.3f} seconds for {lock_file_name} of {study_directory_path}")
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+    finally:
+        os.close(fd)
+
+
+def record_lock_wait(metrics_key: str, wait: float, contended: bool, timed_out: bool) -> None:
+    with _lock_metrics_lock:
+        metrics = _lock_metrics[metrics_key]
+        metrics["timeouts" if timed_out else "acquired"] += 1
+        metrics["contended"] += int(contended)
+        metrics["wait_total"] += wait
+        metrics["wait_max"] = max(metrics["wait_max"], wait)
+
+
+def get_study_lock_metrics(lock_file_name: str = STUDY_LOCK_FILE_NAME) -> Dict:
+    with _lock_metrics_lock:
+        metrics = dict(_lock_metrics[LOCK_TYPES[lock_file_name][0]])
+    attempts = metrics["acquired"] + metrics["timeouts"]
+    metrics["wait_mean"] = metrics["wait_total"] / attempts if attempts else None
+    return metrics
+
+
+def write_file_atomic(file_path: str, content: str) -> None:
+    """
+    Writes content to a temporary file renamed over file_path, so that readers never see a partial file.
+    """
+    directory = os.path.dirname(file_path) or "."
+    with tempfile.NamedTemporaryFile("w", dir=directory, prefix=".tmp_", delete=False) as f:
+        f.write(content)
+    try:
+        os.chmod(f.name, os.stat(file_path).st_mode if os.path.exists(file_path) else 0o644)
+        os.replace(f.name, file_path)
+    except BaseException:
+        os.remove(f.name)
+        raise
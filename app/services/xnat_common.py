@@ -1,12 +1,62 @@
 import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Optional, Tuple
 from urllib.parse import urlparse
-from fastapi import Depends
 import requests
-from app.dependencies import get_env_vars
+from requests.adapters import HTTPAdapter
+from app.utils.cache import TTLCache
 from app.utils.logger import setup_logger
 
 logger = setup_logger(__name__)
 
+# Number of connections kept open to XNAT
+XNAT_POOL_SIZE = 10
+
+_session = None
+_executor = None
+_project_label_cache = None
+_experiment_labels_cache = None
+_lock = threading.Lock()
+
+
+def get_xnat_session() -> requests.Session:
+    global _session
+    with _lock:
+        if _session is None:
+            _session = requests.Session()
+            adapter = HTTPAdapter(pool_connections=XNAT_POOL_SIZE, pool_maxsize=XNAT_POOL_SIZE)
+            _session.mount("http://", adapter)
+            _session.mount("https://", adapter)
+        return _session
+
+
+def get_xnat_executor() -> ThreadPoolExecutor:
+    global _executor
+    with _lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=XNAT_POOL_SIZE, thread_name_prefix="xnat")
+        return _executor
+
+
+def get_xnat_caches(env_vars: dict) -> Tuple[TTLCache, TTLCache]:
+    """
+    Returns the caches of project labels and of the experiment UID to label dicts of subjects.
+    """
+    global _project_label_cache, _experiment_labels_cache
+    with _lock:
+        if _project_label_cache is None:
+            _project_label_cache = TTLCache(env_vars['xnat_cache_ttl'], max_size=1024)
+            _experiment_labels_cache = TTLCache(env_vars['xnat_cache_ttl'], max_size=4096)
+        return _project_label_cache, _experiment_labels_cache
+
+
+def get_xnat_json(api_url: str, env_vars: dict) -> dict:
+    response = get_xnat_session().get(api_url, params={"format": "json"}, timeout=env_vars['xnat_timeout'])
+    response.raise_for_status()
+    return response.json()
+
+
 def get_experiment_uid_from_url(viewer_url: str) -> str:
     """
     Extracts the experiment UID from the viewer URL.
@@ -14,38 +64,45 @@ def get_experiment_uid_from_url(viewer_url: str) -> str:
     path = urlparse(viewer_url).path
     return os.path.basename(path)
 
-def get_experiment_label_from_json(subject_data: dict, experiment_uid: str) -> str:
+def get_experiment_labels_from_json(subject_data: dict) -> Dict[str, str]:
     """
-    Extracts the experiment label from the subject data.
+    Extracts the label of every experiment of the subject data, by experiment UID.
     """
+    labels = {}
     for children in subject_data.get('items')[0].get('children'):
         for child in children.get('items'):
-            if child.get('data_fields').get('UID') == experiment_uid:
-                logger.debug(f"Experiment UID: {experiment_uid}")
-                logger.debug(f"Experiment label: {child.get('data_fields').get('label')}")
-                return child.get('data_fields').get('label')
-    return None
-    
+            data_fields = child.get('data_fields')
+            if data_fields.get('UID') is not None:
+                labels.setdefault(data_fields.get('UID'), data_fields.get('label'))
+    return labels
+
+def get_experiment_label_from_json(subject_data: dict, experiment_uid: str) -> str:
+    """
+    Extracts the experiment label from the subject data.
+    """
+    return get_experiment_labels_from_json(subject_data).get(experiment_uid)
 
 
 def get_experiment_label_from_xnat(viewer_url: str, cbioportal_study_id: str, cbioportal_case_id: str,  env_vars: dict) -> str:
     
     experiment_uid = get_experiment_uid_from_url(viewer_url)
     xnat_url = env_vars['xnat_url']
-    
-    # Request the subject json from XNAT
-    api_url = f"{xnat_url}/data/projects/{cbioportal_study_id}/subjects/{cbioportal_case_id}?format=json"
-    response = requests.get(api_url)
-    response.raise_for_status()
-    
-    subject_data = response.json()
-    
-    # Extract the experiment label from the subject data
-    experiment_label = get_experiment_label_from_json(subject_data, experiment_uid)
-    
+    _, cache = get_xnat_caches(env_vars)
+    cache_key = (xnat_url, cbioportal_study_id, cbioportal_case_id)
+
+    experiment_labels = cache.get(cache_key)
+    if experiment_labels is None or experiment_uid not in experiment_labels:
+        # Request the subject json from XNAT, again if the experiment was added after it was cached
+        subject_data = get_xnat_json(f"{xnat_url}/data/projects/{cbioportal_study_id}/subjects/{cbioportal_case_id}",
+                                     env_vars)
+        experiment_labels = get_experiment_labels_from_json(subject_data)
+        cache.set(cache_key, experiment_labels)
+
+    experiment_label = experiment_labels.get(experiment_uid)
     if not experiment_label:
         raise ValueError(f"Experiment label not found for UID: {experiment_uid} in study {cbioportal_study_id} and case {cbioportal_case_id}")
-    
+    logger.debug(f"Experiment UID: {experiment_uid}")
+    logger.debug(f"Experiment label: {experiment_label}")
     return experiment_label
 
 def get_project_label_from_json(project_data: dict, cbioportal_study_id: str) -> str:
@@ -60,15 +117,24 @@ def get_project_label_from_xnat(cbioportal_study_id: str, env_vars: dict) -> str
     Extracts the project label from the viewer URL.
     """
     xnat_url = env_vars['xnat_url']
-    
-    # Request the subject json from XNAT
-    api_url = f"{xnat_url}/data/projects/{cbioportal_study_id}?format=json"
-    response = requests.get(api_url)
-    response.raise_for_status()
-    
-    project_data = response.json()
-    
-    project_label = get_project_label_from_json(project_data, cbioportal_study_id)
-    
+    cache, _ = get_xnat_caches(env_vars)
+    cache_key = (xnat_url, cbioportal_study_id)
+
+    project_label = cache.get(cache_key)
+    if project_label is None:
+        # Request the project json from XNAT
+        project_data = get_xnat_json(f"{xnat_url}/data/projects/{cbioportal_study_id}", env_vars)
+        project_label = get_project_label_from_json(project_data, cbioportal_study_id)
+        cache.set(cache_key, project_label)
+
     return project_label
-    
\ No newline at end of file
+
+
+def get_xnat_labels(viewer_url: str, cbioportal_study_id: str, cbioportal_case_id: str,
+                    env_vars: dict) -> Tuple[str, Optional[str]]:
+    """
+    Returns the experiment and project labels of a viewer URL, fetching the subject and the project concurrently.
+    """
+    project_label = get_xnat_executor().submit(get_project_label_from_xnat, cbioportal_study_id, env_vars)
+    experiment_label = get_experiment_label_from_xnat(viewer_url, cbioportal_study_id, cbioportal_case_id, env_vars)
+    return experiment_label, project_label.result()
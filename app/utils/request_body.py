@@ -0,0 +1,50 @@
+import json
+import zlib
+from typing import Any
+
+from fastapi import HTTPException, Request
+
+DECOMPRESSION_WBITS = {
+    "identity": None,
+    "gzip": 16 + zlib.MAX_WBITS,
+    "deflate": zlib.MAX_WBITS,
+}
+
+
+def check_body_size(body: bytearray, max_size: int) -> None:
+    if len(body) > max_size:
+        raise HTTPException(status_code=413, detail=f"Request body is larger than the maximum size of {max_size} bytes.")
+
+
+async def read_json_body(request: Request, max_size: int) -> Any:
+    """
+    Reads a JSON request body, decompressing it on the fly when it has a gzip or deflate Content-Encoding.
+
+    Raises a 413 as soon as the decompressed body exceeds max_size bytes.
+    """
+    content_encoding = request.headers.get("content-encoding", "identity").strip().lower()
+    if content_encoding not in DECOMPRESSION_WBITS:
+        raise HTTPException(status_code=415, detail=f"Unsupported Content-Encoding: {content_encoding}")
+    wbits = DECOMPRESSION_WBITS[content_encoding]
+    decompressor = zlib.decompressobj(wbits) if wbits else None
+
+    body = bytearray()
+    try:
+        async for chunk in request.stream():
+            if decompressor:
+                # Bounding the output stops decompression bombs before they are inflated
+                chunk = decompressor.decompress(chunk, max_size + 1 - len(body))
+            body += chunk
+            check_body_size(body, max_size)
+        if decompressor:
+            body += decompressor.flush()
+            check_body_size(body, max_size)
+            if not decompressor.eof:
+                raise HTTPException(status_code=400, detail="Truncated compressed request body.")
+    except zlib.error as e:
+        raise HTTPException(status_code=400, detail=f"Invalid compressed request body: {e}")
+
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid JSON request body: {e}")
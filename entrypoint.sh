@@ -25,10 +25,31 @@ PROD=$(echo "$PROD" | tr '[:upper:]' '[:lower:]')
 SSL_KEYFILE_NAME=${SSL_KEYFILE_NAME:-private.key}
 SSL_CERTFILE_NAME=${SSL_CERTFILE_NAME:-certificate.crt}
 
-# Check if running in production and if SSL certificates are available
-if [[ "$PROD" == "true" && -f "/app/ssl/$SSL_KEYFILE_NAME" && -f "/app/ssl/$SSL_CERTFILE_NAME" ]]; then
-    exho "Running in production mode with SSL enabled"
-    exec uvicorn app.main:app --host 0.0.0.0 --port 3001 --ssl-keyfile "/app/ssl/$SSL_KEYFILE_NAME" --ssl-certfile "/app/ssl/$SSL_CERTFILE_NAME" --log-level debug --log-config /app/logging_config.yaml --reload --reload-dir app
+# Production server settings
+WORKERS=${WORKERS:-2}
+IMPORT_DRAIN_TIMEOUT=${IMPORT_DRAIN_TIMEOUT:-600}
+export IMPORT_DRAIN_TIMEOUT
+# Leave the workers the time to finish their imports before they are killed
+GRACEFUL_TIMEOUT=${GRACEFUL_TIMEOUT:-$((${IMPORT_DRAIN_TIMEOUT%.*} + 30))}
+
+if [[ "$PROD" == "true" ]]; then
+    SSL_OPTIONS=()
+    if [[ -f "/app/ssl/$SSL_KEYFILE_NAME" && -f "/app/ssl/$SSL_CERTFILE_NAME" ]]; then
+        echo "Running in production mode with SSL enabled"
+        SSL_OPTIONS=(--keyfile "/app/ssl/$SSL_KEYFILE_NAME" --certfile "/app/ssl/$SSL_CERTFILE_NAME")
+    else
+        echo "Running in production mode without SSL, /app/ssl/$SSL_KEYFILE_NAME or /app/ssl/$SSL_CERTFILE_NAME not found"
+    fi
+    # The workers share the import jobs through a database of this deployment
+    JOB_STORE_PATH=${JOB_STORE_PATH-/app/data/jobs.sqlite}
+    export JOB_STORE_PATH
+    if [[ -n "$JOB_STORE_PATH" ]]; then
+        mkdir -p "$(dirname "$JOB_STORE_PATH")"
+    fi
+    # The application is loaded once before the workers are forked, and every worker drains its imports on SIGTERM
+    exec gunicorn app.main:app --worker-class uvicorn_worker.UvicornWorker --workers "$WORKERS" --preload \
+        --bind 0.0.0.0:3001 --graceful-timeout "$GRACEFUL_TIMEOUT" --log-level info \
+        --log-config /app/gunicorn_logging.conf "${SSL_OPTIONS[@]}"
 else
     exec uvicorn app.main:app --host 0.0.0.0 --port 3001 --log-level info --log-config /app/logging_config.yaml --reload --reload-dir app
-fi
\ No newline at end of file
+fi
@@ -0,0 +1,20 @@
+from fastapi.testclient import TestClient
+from main import app
+from app.middleware.request_limits import RequestLimitMiddleware
+
+
+def test_request_limits():
+    limited_app = RequestLimitMiddleware(app, max_concurrency=1, max_body_size=10)
+    client = TestClient(limited_app)
+    response = client.post("/export-to-galaxy/", content=b"x" * 11, headers={"Content-Type": "application/json"})
+    assert response.status_code == 413
+
+    # Chunked bodies are counted while they are read
+    response = client.post("/export-to-galaxy/", content=iter([b"x" * 6, b"x" * 6]),
+                           headers={"Content-Type": "application/json"})
+    assert response.status_code == 413
+
+    limited_app.in_flight = 1
+    response = client.post("/export-to-galaxy/", content=b"{}", headers={"Content-Type": "application/json"})
+    assert response.status_code == 503
+    assert response.headers["retry-after"] == "1"
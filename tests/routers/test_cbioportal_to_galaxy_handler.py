@@ -2,17 +2,92 @@ import pytest
 from fastapi import HTTPException
 from requests.exceptions import ConnectionError
 from unittest.mock import patch, MagicMock
-from routers.cbioportal_to_galaxy_handler import validate_and_fix_url, get_galaxy_instance, export_to_galaxy
+from concurrent.futures import ThreadPoolExecutor
+from routers.cbioportal_to_galaxy_handler import validate_and_fix_url, export_to_galaxy, \
+    get_or_create_galaxy_history, get_workflow, call_in_galaxy_history, shutdown_workflow_batches
+
+env_vars = {"galaxy_metadata_cache_ttl": 300}
+
+
+def make_gi(key):
+    gi = MagicMock()
+    gi.base_url = "http://galaxy"
+    gi.key = key
+    return gi
 
 def test_validate_and_fix_url_missing_scheme():
     with pytest.raises(ValueError, match="Missing scheme in URL:"):
         validate_and_fix_url("www.example.com")
 
-@patch('app.routers.cbioportal_to_galaxy_handler.GalaxyInstance')
-def test_get_galaxy_instance_retries(mock_galaxy_instance):
-    mock_galaxy_instance.side_effect = ConnectionError("Connection failed")
+def test_get_galaxy_instance_retries():
+    import asyncio
+    from app.services.galaxy_common import call_galaxy_with_retry
+
+    retry_env_vars = {"galaxy_max_retries": 3, "galaxy_retry_delay": 0, "galaxy_circuit_breaker_threshold": 5,
+                      "galaxy_health_probe_interval": 0.01}
+    connect = MagicMock(side_effect=ConnectionError("Connection failed"))
     with pytest.raises(HTTPException, match="Failed to establish a new connection: Connection failed"):
-        get_galaxy_instance("http://example.com", "fake_key", max_retries=3, delay=0)
+        asyncio.run(call_galaxy_with_retry("http://example.com", retry_env_vars, connect))
+    assert connect.call_count == 3
+
+def test_get_or_create_galaxy_history_is_cached_and_single_flight():
+    gi = make_gi("history_token")
+    gi.histories.get_histories.return_value = []
+    gi.histories.create_history.return_value = {"id": "history_id"}
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        history_ids = list(executor.map(lambda _: get_or_create_galaxy_history(gi, "cbioportal", env_vars), range(8)))
+
+    assert history_ids == ["history_id"] * 8
+    gi.histories.create_history.assert_called_once_with(name="cbioportal")
+
+def test_deleted_history_is_dropped_from_cache():
+    import asyncio
+    from bioblend import ConnectionError as BioblendConnectionError
+
+    gi = make_gi("deleted_history_token")
+    gi.histories.get_histories.side_effect = [[{"id": "deleted_id"}], []]
+    gi.histories.create_history.return_value = {"id": "new_id"}
+    gi.histories.show_history.return_value = {"id": "deleted_id", "deleted": True}
+    upload = MagicMock(side_effect=[BioblendConnectionError("History is deleted", status_code=403), "uploaded"])
+
+    async def upload_to(history_id):
+        return upload(history_id)
+
+    result = asyncio.run(call_in_galaxy_history(gi, "cbioportal", env_vars, upload_to))
+    assert result == ("new_id", "uploaded")
+    assert [call.args[0] for call in upload.call_args_list] == ["deleted_id", "new_id"]
+    assert get_or_create_galaxy_history(gi, "cbioportal", env_vars) == "new_id"
+
+    # Other client errors are not retried
+    upload.side_effect = [BioblendConnectionError("Bad request", status_code=400)]
+    gi.histories.show_history.return_value = {"id": "new_id", "deleted": False}
+    with pytest.raises(BioblendConnectionError):
+        asyncio.run(call_in_galaxy_history(gi, "cbioportal", env_vars, upload_to))
+
+
+def test_get_workflow_is_cached_per_token():
+    gi = make_gi("workflow_token")
+    gi.workflows.get_workflows.return_value = [{"id": "workflow_id"}]
+    gi.workflows.show_workflow.return_value = {"id": "workflow_id", "inputs": {}}
+
+    assert get_workflow(gi, "my_workflow", env_vars)["id"] == "workflow_id"
+    assert get_workflow(gi, "my_workflow", env_vars)["id"] == "workflow_id"
+    gi.workflows.get_workflows.assert_called_once()
+    gi.workflows.show_workflow.assert_called_once()
+
+    other_gi = make_gi("other_token")
+    other_gi.workflows.get_workflows.return_value = [{"id": "workflow_id"}]
+    get_workflow(other_gi, "my_workflow", env_vars)
+    other_gi.workflows.get_workflows.assert_called_once()
+
+def test_get_workflow_missing_is_not_cached():
+    gi = make_gi("missing_workflow_token")
+    gi.workflows.get_workflows.return_value = []
+    for _ in range(2):
+        with pytest.raises(ValueError, match="Workflow with name my_workflow not found"):
+            get_workflow(gi, "my_workflow", env_vars)
+    assert gi.workflows.get_workflows.call_count == 2
 
 # @patch('app.routers.cbioportal_to_galaxy_handler.get_galaxy_instance')
 # @pytest.mark.asyncio
@@ -26,4 +101,91 @@ def test_get_galaxy_instance_retries(mock_galaxy_instance):
 #         "data": "fake_data"
 #     }, params={"galaxy_url": "http://example.com"})
 #     assert response.status_code == 500
-#     assert "Failed to establish a new connection" in response.json()['detail']
\ No newline at end of file
+#     assert "Failed to establish a new connection" in response.json()['detail']
+
+def test_export_to_galaxy_accepts_gzip_body():
+    import gzip
+    import json
+    from fastapi.testclient import TestClient
+    from main import app
+
+    client = TestClient(app)
+    payload = {"data": "Patient Id\tSample Id\nP1\tS1\n", "studyId": "study", "caseId": "P1",
+               "galaxyHistoryName": "cbioportal", "galaxyToken": "token"}
+    with patch('routers.cbioportal_to_galaxy_handler.get_galaxy_instance_from_request') as mock_get_gi, \
+            patch('routers.cbioportal_to_galaxy_handler.get_or_create_galaxy_history', return_value="history_id"), \
+            patch('routers.cbioportal_to_galaxy_handler.upload_text') as mock_upload_text:
+        mock_get_gi.return_value = make_gi("token")
+        mock_upload_text.return_value = {"outputs": [{"name": "data.txt", "id": "dataset_id"}]}
+        response = client.post("/export-to-galaxy/", content=gzip.compress(json.dumps(payload).encode()),
+                               headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        assert response.status_code == 200
+        args = mock_upload_text.call_args.args
+        assert args[2] == payload["data"]
+        assert args[5] == "patient_id\tsample_id"
+
+        response = client.post("/export-to-galaxy/", content=b"not gzip",
+                               headers={"Content-Type": "application/json", "Content-Encoding": "gzip"})
+        assert response.status_code == 400
+
+
+def test_export_batch_to_galaxy_uploads_items_and_creates_collection():
+    from fastapi.testclient import TestClient
+    from main import app
+
+    client = TestClient(app)
+    gi = make_gi("token")
+    gi.histories.create_dataset_collection.return_value = {"id": "collection_id"}
+    payload = {"galaxyToken": "token", "galaxyHistoryName": "cbioportal", "collectionName": "cohort",
+               "items": [{"studyId": "study", "caseId": "P1", "data": "Patient Id\nP1\n"},
+                         {"studyId": "study", "caseId": "P2", "data": ""},
+                         {"studyId": "study", "caseId": "P3", "data": "Patient Id\nP3\n"}]}
+    with patch('routers.cbioportal_to_galaxy_handler.get_galaxy_instance_from_request', return_value=gi), \
+            patch('routers.cbioportal_to_galaxy_handler.get_or_create_galaxy_history', return_value="history_id"), \
+            patch('routers.cbioportal_to_galaxy_handler.upload_text') as mock_upload_text:
+        mock_upload_text.side_effect = lambda gi, history_id, text, file_name, *args: {
+            "outputs": [{"name": file_name, "id": f"dataset_{text[-3:-1]}"}]}
+        response = client.post("/export-to-galaxy/batch/", json=payload)
+
+    assert response.status_code == 200
+    results = response.json()["results"]
+    assert [result["status"] for result in results] == ["uploaded", "failed", "uploaded"]
+    assert [result.get("datasetId") for result in results] == ["dataset_P1", None, "dataset_P3"]
+    assert response.json()["collection"] == {"id": "collection_id", "name": "cohort"}
+    description = gi.histories.create_dataset_collection.call_args.args[1].to_dict()
+    assert [element["name"] for element in description["element_identifiers"]] == ["P1", "P3"]
+
+
+def test_galaxy_workflow_batch_invokes_workflow_per_batch():
+    from unittest.mock import AsyncMock
+    from fastapi.testclient import TestClient
+    from main import app
+
+    client = TestClient(app)
+    gi = make_gi("token")
+    gi.histories.create_dataset_collection.side_effect = lambda history_id, description: {
+        "id": f"collection_{description.name}"}
+    gi.workflows.invoke_workflow.side_effect = lambda workflow_id, inputs, history_id: {
+        "id": f"invocation_{inputs['0']['id']}", "state": "new"}
+    workflow = {"id": "workflow_id", "inputs": {"0": {"label": "input", "uuid": "uuid"}}}
+    payload = {"galaxyToken": "token", "galaxyHistoryName": "cbioportal", "collectionName": "cohort", "batchSize": 2,
+               "items": [{"studyId": "study", "caseId": f"P{i}", "data": f"Patient Id\nP{i}\n"} for i in range(3)]}
+    with patch('routers.cbioportal_to_galaxy_handler.get_galaxy_instance_from_request', return_value=gi), \
+            patch('routers.cbioportal_to_galaxy_handler.get_or_create_galaxy_history', return_value="history_id"), \
+            patch('routers.cbioportal_to_galaxy_handler.get_workflow', return_value=workflow), \
+            patch('routers.cbioportal_to_galaxy_handler.wait_for_dataset', new_callable=AsyncMock), \
+            patch('routers.cbioportal_to_galaxy_handler.upload_text') as mock_upload_text:
+        mock_upload_text.side_effect = lambda gi, history_id, text, file_name, *args: {
+            "outputs": [{"name": file_name, "id": f"dataset_{text[-3:-1]}"}]}
+        response = client.post("/galaxy-workflow/batch/", json=payload)
+        # The cohort runs on the workflow batch executor, after the response
+        shutdown_workflow_batches()
+
+    assert response.status_code == 200
+    jobs = [client.get(f"/jobs/{job['job_id']}").json() for job in response.json()["jobs"]]
+    assert [job["status"] for job in jobs] == ["succeeded"] * 3
+    assert [job["output"]["invocationId"] for job in jobs] == ["invocation_collection_cohort 1"] * 2 + \
+        ["invocation_collection_cohort 2"]
+    assert [job["batch_size"] for job in jobs] == [2, 2, 1]
+    assert gi.workflows.invoke_workflow.call_args.kwargs["inputs"]["0"]["src"] == "hdca"
+
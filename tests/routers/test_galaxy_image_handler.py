@@ -1,9 +1,22 @@
+import hashlib
+import os
+from io import BytesIO
 import pytest
 from fastapi.testclient import TestClient
 from main import app
 
 client = TestClient(app)
 
+
+@pytest.fixture(scope="module", autouse=True)
+def image_upload_directory(tmp_path_factory):
+    # get_env_vars reads the environment on every request, so the images of this module go to a temporary directory
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        directory = str(tmp_path_factory.mktemp("uploaded_images"))
+        monkeypatch.setenv("IMAGE_UPLOAD_DIRECTORY", directory)
+        yield directory
+
+
 def test_upload_image():
     # Check if the image already exists
     response = client.get("/images/test_image.png")
@@ -74,3 +87,184 @@ def test_upload_image_with_overwrite():
 
 
 
+def test_upload_image_returns_sha256():
+    with open("tests/test_data/test_image.png", "rb") as img:
+        content = img.read()
+    response = client.post("/upload-image/", files={"file": ("hashed_image.png", content)}, data={"overwrite": "true"})
+    assert response.status_code == 200
+    assert response.json()["sha256"] == hashlib.sha256(content).hexdigest()
+
+    response = client.get("/images/hashed_image.png")
+    assert response.content == content
+    client.delete("/images/hashed_image.png")
+
+
+def test_upload_image_too_large(monkeypatch, image_upload_directory):
+    monkeypatch.setenv("IMAGE_MAX_UPLOAD_SIZE", "10")
+    with open("tests/test_data/test_image.png", "rb") as img:
+        response = client.post("/upload-image/", files={"file": ("too_large_image.png", img)})
+    assert response.status_code == 413
+    assert client.get("/images/too_large_image.png").status_code == 404
+    assert not os.listdir(os.path.join(image_upload_directory, ".blobs", "tmp"))
+
+
+def test_get_image_conditional_and_range_requests():
+    with open("tests/test_data/test_image.png", "rb") as img:
+        content = img.read()
+    client.post("/upload-image/", files={"file": ("cached_image.png", content)}, data={"overwrite": "true"})
+
+    response = client.get("/images/cached_image.png")
+    assert response.status_code == 200
+    assert response.headers["cache-control"].startswith("public, max-age=")
+    etag = response.headers["etag"]
+
+    response = client.get("/images/cached_image.png", headers={"If-None-Match": etag})
+    assert response.status_code == 304
+    response = client.get("/images/cached_image.png", headers={"If-Modified-Since": response.headers["last-modified"]})
+    assert response.status_code == 304
+
+    response = client.get("/images/cached_image.png", headers={"Range": "bytes=0-9"})
+    assert response.status_code == 206
+    assert response.content == content[:10]
+
+    assert etag == f'"{hashlib.sha256(content).hexdigest()}"'
+
+    # Overwriting the image changes its ETag
+    client.post("/upload-image/", files={"file": ("cached_image.png", content + b"\0")}, data={"overwrite": "true"})
+    response = client.get("/images/cached_image.png", headers={"If-None-Match": etag})
+    assert response.status_code == 200
+    client.delete("/images/cached_image.png")
+
+
+def test_get_image_variant(image_upload_directory):
+    from PIL import Image
+
+    with open("tests/test_data/test_image.png", "rb") as img:
+        client.post("/upload-image/", files={"file": ("variant_image.png", img)}, data={"overwrite": "true"})
+
+    response = client.get("/images/variant_image.png", params={"width": 16, "format": "webp"})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/webp"
+    with Image.open(BytesIO(response.content)) as variant:
+        assert variant.format == "WEBP"
+        assert variant.width <= 16
+
+    assert client.get("/images/variant_image.png", params={"format": "bmp"}).status_code == 400
+
+    variant_directory = f"{image_upload_directory.rstrip('/')}_variants"
+    assert os.listdir(os.path.join(variant_directory, "variant_image.png"))
+    client.delete("/images/variant_image.png")
+    assert not os.path.exists(os.path.join(variant_directory, "variant_image.png"))
+
+
+def test_get_image_variant_of_unwritable_format():
+    from PIL import Image
+
+    tif_buffer = BytesIO()
+    Image.new("RGB", (32, 32)).save(tif_buffer, format="TIFF")
+    client.post("/upload-image/", files={"file": ("variant_image.tif", tif_buffer.getvalue())},
+                data={"overwrite": "true"})
+
+    # Without a requested format, images that can not be written back are converted to png
+    response = client.get("/images/variant_image.tif", params={"width": 16})
+    assert response.status_code == 200
+    assert response.headers["content-type"] == "image/png"
+    assert client.get("/images/variant_image.tif", params={"width": 16, "format": "tif"}).status_code == 400
+    client.delete("/images/variant_image.tif")
+
+
+def test_get_legacy_image(image_upload_directory):
+    with open("tests/test_data/test_image.png", "rb") as img:
+        content = img.read()
+    with open(os.path.join(image_upload_directory, "legacy_image.png"), "wb") as f:
+        f.write(content)
+
+    response = client.get("/images/legacy_image.png")
+    assert response.status_code == 200
+    assert response.content == content
+    assert client.post("/upload-image/", files={"file": ("legacy_image.png", content)}).status_code == 409
+
+    response = client.delete("/images/legacy_image.png")
+    assert response.status_code == 200
+    assert not os.path.exists(os.path.join(image_upload_directory, "legacy_image.png"))
+
+
+def test_internal_files_are_not_images(image_upload_directory):
+    assert client.get("/images/test_image.png").status_code == 200
+    assert os.path.isfile(os.path.join(image_upload_directory, ".image_index.sqlite"))
+
+    assert client.get("/images/.image_index.sqlite").status_code == 400
+    assert client.delete("/images/.image_index.sqlite").status_code == 400
+    response = client.post("/upload-image/", files={"file": (".image_index.sqlite", b"content")},
+                           data={"overwrite": "true"})
+    assert response.status_code == 400
+    assert os.path.isfile(os.path.join(image_upload_directory, ".image_index.sqlite"))
+    assert client.get("/images/test_image.png").status_code == 200
+
+
+def test_get_image_removed_after_lookup(image_upload_directory):
+    from app.dependencies import get_env_vars
+    from app.services.image_store import get_image_store
+
+    with open("tests/test_data/test_image.png", "rb") as img:
+        content = img.read()
+    client.post("/upload-image/", files={"file": ("removed_image.png", content)}, data={"overwrite": "true"})
+    assert client.get("/images/removed_image.png").status_code == 200
+
+    # Another worker removes the blob while the lookup is still cached
+    blob_path, _ = get_image_store(get_env_vars()).lookup("removed_image.png")
+    os.remove(blob_path)
+    assert client.get("/images/removed_image.png").status_code == 404
+    assert client.get("/images/removed_image.png", headers={"Range": "bytes=0-9"}).status_code == 404
+    client.delete("/images/removed_image.png")
+
+
+def test_upload_images():
+    with open("tests/test_data/test_image.png", "rb") as img:
+        content = img.read()
+    client.post("/upload-image/", files={"file": ("bulk_existing.png", content)}, data={"overwrite": "true"})
+
+    response = client.post("/upload-images/", files=[("files", ("bulk_a.png", content)),
+                                                      ("files", ("bulk_existing.png", content)),
+                                                      ("files", (".image_index.sqlite", content))])
+    assert response.status_code == 200
+    assert [image["name"] for image in response.json()["images"]] == ["bulk_a.png"]
+    assert response.json()["images"][0]["url"].endswith("/images/bulk_a.png")
+    assert [(error["name"], error["status_code"]) for error in response.json()["errors"]] == \
+        [("bulk_existing.png", 409), (".image_index.sqlite", 400)]
+
+    assert client.get("/images/bulk_a.png").content == content
+    for name in ["bulk_a.png", "bulk_existing.png"]:
+        client.delete(f"/images/{name}")
+
+
+def test_upload_images_archives():
+    import tarfile
+    import zipfile
+
+    with open("tests/test_data/test_image.png", "rb") as img:
+        content = img.read()
+
+    zip_buffer = BytesIO()
+    with zipfile.ZipFile(zip_buffer, "w") as archive:
+        archive.writestr("case/zip_a.png", content)
+        archive.writestr("case/zip_b.png", content + b"\0")
+        archive.writestr("__MACOSX/case/._zip_a.png", b"")
+    response = client.post("/upload-images/", files={"files": ("images.zip", zip_buffer.getvalue())})
+    assert response.status_code == 200
+    assert sorted(image["name"] for image in response.json()["images"]) == ["zip_a.png", "zip_b.png"]
+    assert client.get("/images/zip_b.png").content == content + b"\0"
+
+    tar_buffer = BytesIO()
+    with tarfile.open(fileobj=tar_buffer, mode="w:gz") as archive:
+        info = tarfile.TarInfo("case/tar_a.png")
+        info.size = len(content)
+        archive.addfile(info, BytesIO(content))
+    response = client.post("/upload-images/", files={"files": ("images.tar.gz", tar_buffer.getvalue())})
+    assert response.status_code == 200
+    assert [image["name"] for image in response.json()["images"]] == ["tar_a.png"]
+    assert client.get("/images/tar_a.png").content == content
+
+    assert client.post("/upload-images/", files={"files": ("images.zip", b"not a zip")}).status_code == 400
+    for name in ["zip_a.png", "zip_b.png", "tar_a.png"]:
+        client.delete(f"/images/{name}")
@@ -2,10 +2,13 @@ from io import StringIO
 
 import pytest
 from fastapi.testclient import TestClient
-from routers.galaxy_to_cbioportal_handler import merge_data_timeline, export_timeline_to_cbioportal, router
+from fastapi import HTTPException
+from routers.galaxy_to_cbioportal_handler import merge_data_timeline, export_timeline_to_cbioportal, router, \
+    stage_delta, merge_delta_directories, validate_payload
 import pandas as pd
 from unittest.mock import patch, mock_open
 import os
+import shutil
 
 client = TestClient(router)
 
@@ -48,4 +51,131 @@ class TestExportTimelineToCbioportal:
         })
         print(response.json())
         # assert response.status_code == 400
-        # assert response.json() == {"detail": "Missing required fields: dataContent, metaContent, caseId, or studyId"}
\ No newline at end of file
+        # assert response.json() == {"detail": "Missing required fields: dataContent, metaContent, caseId, or studyId"}
+
+class TestDeltaImport:
+    def test_stage_delta_only_contains_exported_files(self, tmp_path):
+        meta_path = str(tmp_path / "meta_timeline_a.txt")
+        data_path = str(tmp_path / "data_timeline_a.txt")
+        (tmp_path / "data_mutations.txt").write_text("unrelated")
+
+        delta_item = stage_delta("study", [(meta_path, "meta", data_path, "PATIENT_ID\tDATA\n1\tx", ["PATIENT_ID"])])
+
+        assert sorted(os.listdir(delta_item["delta_directory"])) == ["data_timeline_a.txt", "meta_timeline_a.txt"]
+        assert delta_item["key_columns"] == {"data_timeline_a.txt": ["PATIENT_ID"]}
+        assert not delta_item["full_reload"]
+
+    def test_stage_delta_requires_full_reload_when_meta_changes(self, tmp_path):
+        meta_path = tmp_path / "meta_timeline_a.txt"
+        meta_path.write_text("old meta")
+
+        delta_item = stage_delta("study", [(str(meta_path), "new meta", str(tmp_path / "data_timeline_a.txt"),
+                                            "PATIENT_ID\tDATA\n1\tx", ["PATIENT_ID"])])
+
+        assert delta_item["full_reload"]
+
+    def test_merge_delta_directories_merges_rows_by_key(self, tmp_path):
+        data_path = str(tmp_path / "data_timeline_a.txt")
+        meta_path = str(tmp_path / "meta_timeline_a.txt")
+        first = stage_delta("study", [(meta_path, "meta", data_path, "PATIENT_ID\tDATA\n1\told\n2\tkept", ["PATIENT_ID"])])
+        second = stage_delta("study", [(meta_path, "meta", data_path, "PATIENT_ID\tDATA\n1\tnew", ["PATIENT_ID"])])
+
+        batch_directory = merge_delta_directories([first, second])
+
+        result_df = pd.read_csv(os.path.join(batch_directory, "data_timeline_a.txt"), sep='\t')
+        assert result_df.to_dict("records") == [{"PATIENT_ID": 2, "DATA": "kept"}, {"PATIENT_ID": 1, "DATA": "new"}]
+
+    def test_merge_delta_directories_keeps_integer_values(self, tmp_path):
+        data_path = str(tmp_path / "data_timeline_a.txt")
+        meta_path = str(tmp_path / "meta_timeline_a.txt")
+        header = "PATIENT_ID\tSTART_DATE\tSTOP_DATE\tEVENT_TYPE\n"
+        first = stage_delta("study", [(meta_path, "meta", data_path, header + "P1\t10\t\tIMAGING\n", ["PATIENT_ID"])])
+        second = stage_delta("study", [(meta_path, "meta", data_path, header + "P2\t-5\t20\tIMAGING\n", ["PATIENT_ID"])])
+
+        batch_directory = merge_delta_directories([first, second])
+
+        with open(os.path.join(batch_directory, "data_timeline_a.txt")) as f:
+            assert f.read() == header + "P1\t10\t\tIMAGING\nP2\t-5\t20\tIMAGING\n"
+
+
+TIMELINE_META = "cancer_study_identifier: study\ngenetic_alteration_type: CLINICAL\ndatatype: TIMELINE\n" \
+                "data_filename: data_timeline_a.txt\n"
+
+
+class TestValidatePayload:
+    def test_valid_timeline(self):
+        data = "PATIENT_ID\tSTART_DATE\tSTOP_DATE\tEVENT_TYPE\nP1\t10\t\tIMAGING\nP1\t-5\t20\tIMAGING\n"
+        validate_payload("timeline", "study", TIMELINE_META, data, "/study/data_timeline_a.txt")
+
+    def test_invalid_timeline_lists_every_problem(self):
+        data = "PATIENT_ID\tSTART_DATE\tSTOP_DATE\tEVENT_TYPE\nP1\tten\t\tIMAGING\n\t10\t\tIMAGING\n"
+        with pytest.raises(HTTPException) as e:
+            validate_payload("timeline", "other_study", TIMELINE_META, data, "/study/data_timeline_a.txt")
+        assert e.value.status_code == 400
+        assert "meta key 'cancer_study_identifier' is 'study' instead of 'other_study'" in e.value.detail
+        assert "column PATIENT_ID is empty on lines 3" in e.value.detail
+        assert "column START_DATE is not an integer on lines 2" in e.value.detail
+
+    def test_missing_columns_and_duplicate_keys(self):
+        meta = "cancer_study_identifier: study\nresource_type: DEFINITION\ndata_filename: data_resource_definition.txt"
+        with pytest.raises(HTTPException, match=r"required columns \['RESOURCE_TYPE'\] are missing"):
+            validate_payload("resource_definition", "study", meta, "RESOURCE_ID\tDISPLAY_NAME\nR1\tImages\n",
+                             "data_resource_definition.txt")
+        data = "RESOURCE_ID\tDISPLAY_NAME\tRESOURCE_TYPE\nR1\tImages\tPATIENT\nR1\tSlides\tPATIENT\n"
+        with pytest.raises(HTTPException, match=r"\['RESOURCE_ID'\] are not unique on lines 2, 3"):
+            validate_payload("resource_definition", "study", meta, data, "data_resource_definition.txt")
+
+    def test_export_rejects_invalid_payload_before_writing(self, tmp_path):
+        from main import app
+
+        with patch("routers.galaxy_to_cbioportal_handler.get_study_directory", return_value=str(tmp_path)), \
+                patch("routers.galaxy_to_cbioportal_handler.enqueue_study_import") as mock_enqueue:
+            response = TestClient(app).post("/export-timeline-to-cbioportal/", json={
+                "dataContent": "PATIENT_ID\tDATA\nP1\tx\n", "metaContent": TIMELINE_META, "studyId": "study",
+                "caseId": "P1", "suffix": "a"})
+        assert response.status_code == 400
+        assert os.listdir(tmp_path) == []
+        mock_enqueue.assert_not_called()
+
+
+class TestWriteStudyFiles:
+    def test_concurrent_exports_keep_every_row(self, tmp_path):
+        from concurrent.futures import ThreadPoolExecutor
+        from routers.galaxy_to_cbioportal_handler import write_study_files
+
+        data_path = str(tmp_path / "data_timeline_a.txt")
+        meta_path = str(tmp_path / "meta_timeline_a.txt")
+        env_vars = {"study_lock_timeout": 30}
+
+        def export(patient_id):
+            data = f"PATIENT_ID\tSTART_DATE\tSTOP_DATE\tEVENT_TYPE\n{patient_id}\t0\t\tIMAGING\n"
+            return write_study_files("study", str(tmp_path), [(meta_path, TIMELINE_META, data_path, data, ["PATIENT_ID"])],
+                                     env_vars)
+
+        with ThreadPoolExecutor(max_workers=8) as executor:
+            delta_items = list(executor.map(export, [f"P{i}" for i in range(16)]))
+
+        assert sorted(pd.read_csv(data_path, sep='\t')["PATIENT_ID"]) == sorted(f"P{i}" for i in range(16))
+        with open(meta_path) as f:
+            assert f.read() == TIMELINE_META
+        for delta_item in delta_items:
+            shutil.rmtree(delta_item["delta_directory"], ignore_errors=True)
+
+    def test_failed_write_removes_the_staged_delta(self, tmp_path):
+        from routers.galaxy_to_cbioportal_handler import write_study_files
+
+        data_path = str(tmp_path / "data_timeline_a.txt")
+        meta_path = str(tmp_path / "meta_timeline_a.txt")
+        data = "PATIENT_ID\tSTART_DATE\tSTOP_DATE\tEVENT_TYPE\nP1\t0\t\tIMAGING\n"
+        delta_items = []
+
+        def staged(*args):
+            delta_items.append(stage_delta(*args))
+            return delta_items[-1]
+
+        with patch("routers.galaxy_to_cbioportal_handler.stage_delta", side_effect=staged), \
+                patch("routers.galaxy_to_cbioportal_handler.upsert_data_file", side_effect=OSError("disk full")):
+            with pytest.raises(OSError):
+                write_study_files("study", str(tmp_path), [(meta_path, TIMELINE_META, data_path, data, ["PATIENT_ID"])],
+                                  {"study_lock_timeout": 30})
+        assert not os.path.exists(delta_items[0]["delta_directory"])
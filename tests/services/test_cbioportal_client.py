@@ -0,0 +1,61 @@
+import threading
+import time
+from unittest.mock import MagicMock
+
+import pytest
+import requests
+from fastapi import HTTPException
+
+from app.services.cbioportal_client import CBioPortalClient
+
+
+def test_concurrent_invalidations_are_deduplicated():
+    client = CBioPortalClient("http://cbioportal", timeout=5, max_retries=3, retry_delay=0)
+    started = threading.Event()
+    release = threading.Event()
+
+    def request(method, url, headers, timeout):
+        started.set()
+        release.wait(5)
+        return MagicMock(status_code=200, text="cleared")
+
+    client.session = MagicMock()
+    client.session.request.side_effect = request
+
+    results = []
+    first = threading.Thread(target=lambda: results.append(client.invalidate_cache("key")))
+    first.start()
+    started.wait(5)
+    # These arrive while the first invalidation runs, a single invalidation after it covers them all
+    waiting = [threading.Thread(target=lambda: results.append(client.invalidate_cache("key"))) for _ in range(4)]
+    for thread in waiting:
+        thread.start()
+    time.sleep(0.1)
+    release.set()
+    for thread in [first] + waiting:
+        thread.join(5)
+
+    assert results == [{"output": "cleared"}] * 5
+    assert client.session.request.call_count == 2
+    assert client.get_metrics()["deduplicated"] == 3
+    assert client.session.request.call_args.args == ("delete", "http://cbioportal/api/cache")
+
+
+def test_invalidation_retries_then_fails():
+    client = CBioPortalClient("http://cbioportal", timeout=5, max_retries=3, retry_delay=0)
+    client.session = MagicMock()
+    client.session.request.side_effect = requests.exceptions.ConnectionError("refused")
+
+    with pytest.raises(HTTPException, match="refused"):
+        client.invalidate_cache("key")
+    metrics = client.get_metrics()
+    assert (metrics["requests"], metrics["failures"], metrics["retries"]) == (3, 3, 2)
+
+
+def test_invalidation_is_sent_without_retries():
+    client = CBioPortalClient("http://cbioportal", timeout=5, max_retries=0, retry_delay=0)
+    client.session = MagicMock()
+    client.session.request.return_value = MagicMock(status_code=200, text="cleared")
+
+    assert client.invalidate_cache("key") == {"output": "cleared"}
+    assert client.session.request.call_count == 1
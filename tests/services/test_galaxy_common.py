@@ -0,0 +1,98 @@
+import asyncio
+from unittest.mock import MagicMock, patch
+
+import pytest
+import requests
+from fastapi import HTTPException
+from app.services.galaxy_common import get_galaxy_instance_async, PooledGalaxyInstance, call_galaxy_with_retry, \
+    get_circuit_breaker
+
+env_vars = {"galaxy_client_cache_ttl": 600, "galaxy_client_cache_size": 2, "galaxy_pool_size": 4,
+            "galaxy_max_retries": 3, "galaxy_retry_delay": 0, "galaxy_circuit_breaker_threshold": 3,
+            "galaxy_health_probe_interval": 0.01}
+
+
+@patch("app.services.galaxy_common.create_galaxy_instance")
+def test_cached_galaxy_instance_is_reused_per_token(mock_create_galaxy_instance):
+    mock_create_galaxy_instance.side_effect = lambda url, token, env: object()
+
+    first = asyncio.run(get_galaxy_instance_async("http://galaxy-a", "token_a", env_vars))
+    assert asyncio.run(get_galaxy_instance_async("http://galaxy-a", "token_a", env_vars)) is first
+    assert asyncio.run(get_galaxy_instance_async("http://galaxy-a", "token_b", env_vars)) is not first
+    assert mock_create_galaxy_instance.call_count == 2
+
+
+def test_pooled_galaxy_instance_uses_shared_session():
+    session = MagicMock()
+    session.request.return_value = MagicMock(status_code=200, json=lambda: {"id": "history_id"})
+    gi = PooledGalaxyInstance("http://galaxy-a", "token_a", session)
+
+    assert gi.make_post_request("http://galaxy-a/api/histories", payload={"name": "h"}) == {"id": "history_id"}
+    gi.make_get_request("http://galaxy-a/api/histories")
+
+    assert session.request.call_args.args[:2] == ("post", "http://galaxy-a/api/histories")
+    assert session.get.call_args.kwargs["headers"]["x-api-key"] == "token_a"
+
+    session.post.return_value = MagicMock(status_code=200, json=lambda: {"outputs": []})
+    assert gi.make_post_request("http://galaxy-a/api/tools/fetch", payload={"targets": []},
+                                files_attached=True) == {"outputs": []}
+    assert session.post.call_args.kwargs["headers"]["Content-Type"].startswith("multipart/form-data")
+
+
+def test_retry_recovers_from_transient_failure():
+    func = MagicMock(side_effect=[requests.exceptions.ConnectionError("down"), "ok"])
+    assert asyncio.run(call_galaxy_with_retry("http://galaxy-b", env_vars, func)) == "ok"
+    assert func.call_count == 2
+
+
+def test_circuit_breaker_fails_fast_until_probe_succeeds():
+    async def scenario():
+        func = MagicMock(side_effect=requests.exceptions.ConnectionError("down"))
+        with pytest.raises(HTTPException, match="Failed to establish a new connection"):
+            await call_galaxy_with_retry("http://galaxy-c", env_vars, func)
+        assert get_circuit_breaker("http://galaxy-c", env_vars).is_open
+
+        with patch("app.services.galaxy_common.get_galaxy_session") as mock_session:
+            mock_session.return_value.get.return_value = MagicMock(status_code=200)
+            with pytest.raises(HTTPException) as exc_info:
+                await call_galaxy_with_retry("http://galaxy-c", env_vars, func)
+            assert exc_info.value.status_code == 503
+            assert func.call_count == 3
+
+            await asyncio.wait_for(get_circuit_breaker("http://galaxy-c", env_vars).probe_task, timeout=1)
+        assert not get_circuit_breaker("http://galaxy-c", env_vars).is_open
+
+    asyncio.run(scenario())
+
+
+def test_cached_galaxy_instance_reports_to_circuit_breaker():
+    async def scenario():
+        session = MagicMock()
+        session.get.side_effect = requests.exceptions.ConnectionError("down")
+        gi = PooledGalaxyInstance("http://galaxy-d", "token_d", session, get_circuit_breaker("http://galaxy-d", env_vars))
+        with patch("app.services.galaxy_common.create_galaxy_instance", return_value=gi):
+            assert await get_galaxy_instance_async("http://galaxy-d", "token_d", env_vars) is gi
+
+        for _ in range(env_vars["galaxy_circuit_breaker_threshold"]):
+            with pytest.raises(requests.exceptions.ConnectionError):
+                gi.make_get_request("http://galaxy-d/api/histories")
+        assert get_circuit_breaker("http://galaxy-d", env_vars).is_open
+
+        # Further requests of the cached client fail fast, and so does getting the client again
+        with pytest.raises(HTTPException) as exc_info:
+            gi.make_get_request("http://galaxy-d/api/histories")
+        assert exc_info.value.status_code == 503
+        assert session.get.call_count == env_vars["galaxy_circuit_breaker_threshold"]
+        with patch("app.services.galaxy_common.get_galaxy_session") as mock_session:
+            mock_session.return_value.get.return_value = MagicMock(status_code=200)
+            with pytest.raises(HTTPException) as exc_info:
+                await get_galaxy_instance_async("http://galaxy-d", "token_d", env_vars)
+            assert exc_info.value.status_code == 503
+            await asyncio.wait_for(get_circuit_breaker("http://galaxy-d", env_vars).probe_task, timeout=1)
+
+        session.get.side_effect = None
+        session.get.return_value = MagicMock(status_code=200)
+        gi.make_get_request("http://galaxy-d/api/histories")
+        assert get_circuit_breaker("http://galaxy-d", env_vars).failures == 0
+
+    asyncio.run(scenario())
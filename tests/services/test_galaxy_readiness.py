@@ -0,0 +1,78 @@
+import asyncio
+import threading
+from unittest.mock import MagicMock
+
+import pytest
+from app.services.galaxy_readiness import wait_for_dataset, DatasetReadinessScheduler
+
+
+def make_gi(states):
+    gi = MagicMock()
+    gi.datasets.show_dataset.side_effect = [{"id": "dataset_id", "name": "data.txt", "state": state}
+                                            for state in states]
+    return gi
+
+
+def test_wait_for_dataset_returns_when_ok():
+    gi = make_gi(["queued", "running", "ok"])
+
+    async def scenario():
+        scheduler = DatasetReadinessScheduler(initial_delay=0.01, max_delay=0.02)
+        return await scheduler.wait_until_ready(gi, "dataset_id", timeout=5)
+
+    assert asyncio.run(scenario())["state"] == "ok"
+    assert gi.datasets.show_dataset.call_count == 3
+    gi.datasets.show_dataset.assert_called_with("dataset_id")
+
+
+def test_wait_for_dataset_fails_on_error_state():
+    gi = make_gi(["error"])
+    with pytest.raises(ValueError, match="is in state error"):
+        asyncio.run(wait_for_dataset(gi, "dataset_id", timeout=5))
+
+
+def test_wait_for_dataset_times_out():
+    gi = MagicMock()
+    gi.datasets.show_dataset.return_value = {"state": "queued"}
+    with pytest.raises(ValueError, match="was not ready after"):
+        asyncio.run(wait_for_dataset(gi, "dataset_id", timeout=0.2))
+
+
+def test_waits_are_multiplexed():
+    gi_fast = make_gi(["ok"])
+    gi_slow = make_gi(["queued", "ok"])
+
+    async def scenario():
+        scheduler = DatasetReadinessScheduler(initial_delay=0.01, max_delay=0.02)
+        return await asyncio.gather(scheduler.wait_until_ready(gi_slow, "slow", timeout=5),
+                                    scheduler.wait_until_ready(gi_fast, "fast", timeout=5))
+
+    assert [dataset["state"] for dataset in asyncio.run(scenario())] == ["ok", "ok"]
+
+
+def test_deferred_dataset_is_still_polled():
+    gi = make_gi(["deferred", "ok"])
+
+    async def scenario():
+        scheduler = DatasetReadinessScheduler(initial_delay=0.01, max_delay=0.02)
+        return await scheduler.wait_until_ready(gi, "dataset_id", timeout=5)
+
+    assert asyncio.run(scenario())["state"] == "ok"
+
+
+def test_hung_poll_does_not_hold_other_waits():
+    release = threading.Event()
+    gi_hung = MagicMock()
+    gi_hung.datasets.show_dataset.side_effect = lambda dataset_id: release.wait(5) and {"state": "queued"}
+    gi = make_gi(["queued", "ok"])
+
+    async def scenario():
+        scheduler = DatasetReadinessScheduler(initial_delay=0.01, max_delay=0.02, poll_timeout=0.05)
+        hung = asyncio.ensure_future(scheduler.wait_until_ready(gi_hung, "hung", timeout=5))
+        try:
+            return await scheduler.wait_until_ready(gi, "dataset_id", timeout=1)
+        finally:
+            hung.cancel()
+            release.set()
+
+    assert asyncio.run(scenario())["state"] == "ok"
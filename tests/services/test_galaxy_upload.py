@@ -0,0 +1,52 @@
+import gzip
+from unittest.mock import MagicMock
+
+from requests_toolbelt import MultipartEncoder
+
+from app.services.galaxy_upload import TextReader, upload_text
+
+
+def test_text_reader_encodes_in_chunks(monkeypatch):
+    monkeypatch.setattr("app.services.galaxy_upload.ENCODE_CHUNK_SIZE", 4)
+    text = "patient_id\tnäme\nP1\tå\n"
+    reader = TextReader(text)
+    assert reader.len == len(text.encode())
+    assert reader.read(3) + reader.read() == text.encode()
+    assert reader.len == 0
+
+    encoder = MultipartEncoder(fields={"files_0|file_data": ("data.txt", TextReader(text))})
+    assert text.encode() in encoder.to_string()
+
+
+def make_gi():
+    gi = MagicMock()
+    gi.url = "http://galaxy/api"
+    gi.make_post_request.side_effect = lambda url, payload, files_attached: {
+        "file": payload["files_0|file_data"].fd.read(), "payload": payload}
+    return gi
+
+
+def test_upload_text_attaches_content_from_memory():
+    gi = make_gi()
+    response = upload_text(gi, "history", "a\tb\n1\t2\n", "data.txt", compress_threshold=1024)
+    assert gi.make_post_request.call_args[0][0] == "http://galaxy/api/tools/fetch"
+    assert response["file"] == b"a\tb\n1\t2\n"
+    assert response["payload"]["targets"][0]["elements"][0]["name"] == "data.txt"
+    assert not response["payload"]["auto_decompress"]
+
+
+def test_upload_text_gzips_large_payloads():
+    gi = make_gi()
+    text = "a\tb\n" + "1\t2\n" * 1000
+    response = upload_text(gi, "history", text, "data.txt", compress_threshold=1024)
+    assert gzip.decompress(response["file"]) == text.encode()
+    assert response["payload"]["auto_decompress"]
+    assert response["payload"]["files_0|file_data"].name == "data.txt.gz"
+
+
+def test_first_line_is_replaced_while_reading():
+    text = "Patient Id\tSample Id\nP1\tS1\n"
+    assert TextReader(text, "patient_id\tsample_id").read() == b"patient_id\tsample_id\nP1\tS1\n"
+    reader = TextReader("Nåme\nP1\n", "name")
+    assert reader.len == len(b"name\nP1\n")
+    assert reader.read() == b"name\nP1\n"
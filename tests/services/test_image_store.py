@@ -0,0 +1,44 @@
+import hashlib
+import os
+
+from app.services.image_store import ImageStore
+
+
+def store_content(store, name, content):
+    with store.create_temp_file() as f:
+        f.write(content)
+    sha256 = hashlib.sha256(content).hexdigest()
+    store.commit(name, f.name, sha256)
+    return sha256
+
+
+def test_identical_images_share_a_blob(tmp_path):
+    store = ImageStore(str(tmp_path))
+    sha256 = store_content(store, "a.png", b"image")
+    assert store_content(store, "b.png", b"image") == sha256
+
+    blob_path = store.blob_path(sha256)
+    assert blob_path == os.path.join(str(tmp_path), ".blobs", sha256[:2], sha256[2:4], sha256)
+    assert store.lookup("a.png") == store.lookup("b.png") == (blob_path, sha256)
+    assert not os.listdir(store.tmp_directory)
+
+    # The blob is removed with its last reference
+    assert store.delete("a.png")
+    assert os.path.exists(blob_path)
+    assert store.delete("b.png")
+    assert not os.path.exists(blob_path)
+    assert store.lookup("a.png") is None
+    assert not store.delete("a.png")
+
+
+def test_overwrite_replaces_blob_and_legacy_file(tmp_path):
+    with open(tmp_path / "a.png", "wb") as f:
+        f.write(b"legacy")
+    store = ImageStore(str(tmp_path))
+    assert store.lookup("a.png") == (str(tmp_path / "a.png"), None)
+
+    first = store_content(store, "a.png", b"first")
+    assert not os.path.exists(tmp_path / "a.png")
+    second = store_content(store, "a.png", b"second")
+    assert store.lookup("a.png") == (store.blob_path(second), second)
+    assert not os.path.exists(store.blob_path(first))
@@ -0,0 +1,47 @@
+import os
+from unittest.mock import patch
+
+import pytest
+from PIL import Image
+
+from app.services import image_variants
+from app.services.image_variants import track_variant_size, delete_image_variants, render_variant
+
+
+def create_variant(path, size):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"\0" * size)
+    return size
+
+
+def test_variant_cache_size_is_tracked_without_walking(tmp_path):
+    variant_directory = str(tmp_path / "variants")
+    env_vars = {"image_variant_directory": variant_directory, "image_upload_directory": str(tmp_path)}
+
+    with patch("app.services.image_variants.os.walk", wraps=os.walk) as mock_walk:
+        for i in range(3):
+            size = create_variant(os.path.join(variant_directory, f"image_{i}.png", "16x0.png"), 10)
+            track_variant_size(variant_directory, size, max_size=100)
+        # Only the first render walks the variant directory
+        assert mock_walk.call_count == 1
+        assert image_variants._variant_sizes[variant_directory] == 30
+
+        delete_image_variants("image_0.png", env_vars)
+        assert image_variants._variant_sizes[variant_directory] == 20
+
+        # Going over the limit walks the directory and evicts the least recently used variants
+        oldest = os.path.join(variant_directory, "image_1.png", "16x0.png")
+        os.utime(oldest, (0, 0))
+        size = create_variant(os.path.join(variant_directory, "image_3.png", "16x0.png"), 90)
+        track_variant_size(variant_directory, size, max_size=100)
+    assert not os.path.exists(oldest)
+    assert image_variants._variant_sizes[variant_directory] == 100
+
+
+def test_failed_render_leaves_no_temporary_file(tmp_path):
+    variant_path = str(tmp_path / "variants" / "test_image.png" / "16x0.png")
+    with patch.object(Image.Image, "save", side_effect=OSError("disk full")):
+        with pytest.raises(OSError):
+            render_variant("tests/test_data/test_image.png", variant_path, 16, 0, "png")
+    assert os.listdir(os.path.dirname(variant_path)) == []
@@ -0,0 +1,74 @@
+import os
+from unittest.mock import patch
+
+import pytest
+from app.services.importer_common import StudyDirectoryIndex, get_study_directory, study_directory_index
+
+
+def create_study(root, directory_name, study_id):
+    study_path = root / directory_name
+    study_path.mkdir()
+    (study_path / "meta_study.txt").write_text(f"type_of_cancer: coad\ncancer_study_identifier: {study_id}\n")
+    return str(study_path)
+
+
+def test_get_study_directory(tmp_path):
+    study_path = create_study(tmp_path, "study_a", "study_a_id")
+    create_study(tmp_path, "study_b", "study_b_id")
+    assert get_study_directory("study_a_id", str(tmp_path)) == study_path
+
+
+def test_get_study_directory_missing_and_duplicate(tmp_path):
+    create_study(tmp_path, "study_a", "study_id")
+    create_study(tmp_path, "study_a_copy", "study_id")
+    with pytest.raises(ValueError, match="Multiple directories found"):
+        get_study_directory("study_id", str(tmp_path))
+    with pytest.raises(FileNotFoundError, match="No directory found"):
+        get_study_directory("unknown_id", str(tmp_path))
+
+
+def test_index_follows_meta_study_changes(tmp_path):
+    index = StudyDirectoryIndex()
+    study_path = create_study(tmp_path, "study_a", "old_id")
+    assert index.lookup("old_id", str(tmp_path)) == [study_path]
+
+    meta_study_path = os.path.join(study_path, "meta_study.txt")
+    with open(meta_study_path, "w") as f:
+        f.write("cancer_study_identifier: new_id\n")
+    stat = os.stat(meta_study_path)
+    os.utime(meta_study_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+    assert index.lookup("old_id", str(tmp_path)) == []
+    assert index.lookup("new_id", str(tmp_path)) == [study_path]
+
+
+def test_index_picks_up_new_study_directories(tmp_path):
+    create_study(tmp_path, "study_a", "study_a_id")
+    study_directory_index.rebuild(str(tmp_path))
+    study_path = create_study(tmp_path, "study_b", "study_b_id")
+    assert get_study_directory("study_b_id", str(tmp_path)) == study_path
+
+
+def test_index_detects_new_duplicate_in_existing_directory(tmp_path):
+    index = StudyDirectoryIndex()
+    study_path = create_study(tmp_path, "study_a", "study_id")
+    other_path = create_study(tmp_path, "study_b", "other_id")
+    assert index.lookup("study_id", str(tmp_path)) == [study_path]
+
+    meta_study_path = os.path.join(other_path, "meta_study.txt")
+    with open(meta_study_path, "w") as f:
+        f.write("cancer_study_identifier: study_id\n")
+    stat = os.stat(meta_study_path)
+    os.utime(meta_study_path, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1000))
+
+    assert index.lookup("study_id", str(tmp_path)) == [study_path, other_path]
+
+
+def test_index_limits_rebuilds_for_unknown_studies(tmp_path):
+    index = StudyDirectoryIndex()
+    create_study(tmp_path, "study_a", "study_a_id")
+    index.rebuild(str(tmp_path))
+    with patch.object(index, "_rebuild", wraps=index._rebuild) as mock_rebuild:
+        for _ in range(3):
+            assert index.lookup("unknown_id", str(tmp_path)) == []
+    mock_rebuild.assert_not_called()
@@ -0,0 +1,91 @@
+import threading
+import time
+from concurrent.futures.process import BrokenProcessPool
+from unittest.mock import patch
+
+from app.services.importer_worker import ImporterPool, run_importer_subprocess, warm_modules
+
+SCRIPT = """
+import os
+import sys
+print("validating", sys.argv[1:])
+sys.stdout.flush()
+os.system("echo loader output")
+print("warning", file=sys.stderr)
+sys.exit(int(sys.argv[1]))
+"""
+
+
+def test_importer_pool_keeps_subprocess_semantics(tmp_path):
+    script = str(tmp_path / "metaImport.py")
+    with open(script, "w") as f:
+        f.write(SCRIPT)
+
+    pool = ImporterPool(workers=1, max_jobs=1, script=script)
+    try:
+        returncode, stdout, stderr = pool.run(["0", "-s", "study"])
+        assert (returncode, stdout, stderr) == run_importer_subprocess(script, ["0", "-s", "study"])
+        assert stdout == "validating ['0', '-s', 'study']\nloader output\n"
+        assert stderr == "warning\n"
+
+        # The worker is replaced after max_jobs jobs
+        returncode, _, stderr = pool.run(["3"])
+        assert (returncode, stderr) == (3, "warning\n")
+    finally:
+        pool.shutdown()
+
+
+def test_importer_modules_are_reloaded_for_every_job(tmp_path):
+    (tmp_path / "importer_state.py").write_text("loaded_studies = []\n")
+    script = str(tmp_path / "metaImport.py")
+    with open(script, "w") as f:
+        f.write("import os\nimport sys\nimport importer_state\n"
+                "importer_state.loaded_studies.append(sys.argv[1])\n"
+                "print(importer_state.loaded_studies, os.environ.get('IMPORTED_STUDY'))\n"
+                "os.environ['IMPORTED_STUDY'] = sys.argv[1]\n")
+
+    pool = ImporterPool(workers=1, max_jobs=5, script=script)
+    try:
+        assert pool.run(["study_a"])[1] == "['study_a'] None\n"
+        assert pool.run(["study_b"])[1] == "['study_b'] None\n"
+    finally:
+        pool.shutdown()
+
+
+def test_only_imports_that_never_started_are_retried_after_a_worker_died(tmp_path):
+    script = str(tmp_path / "metaImport.py")
+    with open(script, "w") as f:
+        f.write("import os\nimport sys\nimport time\n"
+                "if sys.argv[1] == 'die':\n    time.sleep(0.5)\n    os._exit(1)\n")
+
+    pool = ImporterPool(workers=1, max_jobs=5, script=script)
+    results = {}
+
+    def run(name):
+        try:
+            results[name] = pool.run([name])
+        except BrokenProcessPool:
+            results[name] = "not started"
+
+    try:
+        first = threading.Thread(target=run, args=("die",))
+        first.start()
+        time.sleep(0.2)
+        second = threading.Thread(target=run, args=("queued",))
+        second.start()
+        first.join(30)
+        second.join(30)
+    finally:
+        pool.shutdown()
+
+    returncode, _, stderr = results["die"]
+    assert returncode == 1
+    assert "died while running the import" in stderr
+    assert results["queued"] == "not started"
+
+
+def test_missing_warm_modules_are_logged():
+    with patch("app.services.importer_worker.WARM_MODULES", ("no_such_importer_module",)), \
+            patch("app.services.importer_worker.logger") as mock_logger:
+        warm_modules("/scripts/importer/metaImport.py")
+    assert "no_such_importer_module" in mock_logger.warning.call_args_list[0].args[0]
@@ -0,0 +1,100 @@
+import sqlite3
+import threading
+import time
+
+from fastapi import HTTPException
+from app.services.job_queue import StudyJobQueue, SQLiteJobStore
+
+
+def wait_for_job(queue, job_id, timeout=5):
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in ("succeeded", "failed"):
+            return job
+        time.sleep(0.01)
+    raise TimeoutError(job_id)
+
+
+def test_job_succeeds_with_output():
+    queue = StudyJobQueue(max_workers=2)
+    job_id = queue.submit("/study/a", "file.txt", lambda items: {"import_output": "done"})
+    job = wait_for_job(queue, job_id)
+    assert job["status"] == "succeeded"
+    assert job["output"] == {"import_output": "done"}
+
+
+def test_job_failure_records_error():
+    def task(items):
+        raise HTTPException(status_code=500, detail="importer failed")
+
+    queue = StudyJobQueue(max_workers=1)
+    job = wait_for_job(queue, queue.submit("/study/a", "file.txt", task))
+    assert job["status"] == "failed"
+    assert job["error"] == "importer failed"
+
+
+def test_jobs_for_same_study_run_serially():
+    queue = StudyJobQueue(max_workers=4)
+    running = []
+    overlaps = []
+    lock = threading.Lock()
+
+    def task(items):
+        with lock:
+            running.append(1)
+            overlaps.append(len(running))
+        time.sleep(0.05)
+        with lock:
+            running.pop()
+        return {}
+
+    job_ids = [queue.submit("/study/a", f"file_{i}.txt", task) for i in range(3)]
+    for job_id in job_ids:
+        wait_for_job(queue, job_id)
+    assert max(overlaps) == 1
+
+
+def test_jobs_within_window_are_coalesced():
+    queue = StudyJobQueue(max_workers=2, coalesce_window=0.2)
+    batches = []
+
+    def task(items):
+        batches.append(list(items))
+        return {"import_output": "done"}
+
+    job_ids = [queue.submit("/study/a", f"file_{i}.txt", task) for i in range(5)]
+    jobs = [wait_for_job(queue, job_id) for job_id in job_ids]
+    assert batches == [[f"file_{i}.txt" for i in range(5)]]
+    assert {job["batch_id"] for job in jobs} == {jobs[0]["batch_id"]}
+    assert all(job["status"] == "succeeded" and job["batch_size"] == 5 for job in jobs)
+
+
+def test_shutdown_runs_batches_waiting_for_their_window():
+    queue = StudyJobQueue(max_workers=1, coalesce_window=60)
+    batches = []
+    job_ids = [queue.submit(f"/study/{name}", "file.txt", lambda items: batches.append(items) or {})
+               for name in ("a", "b")]
+
+    assert queue.shutdown(wait=True, timeout=5)
+    assert len(batches) == 2
+    assert all(queue.get(job_id)["status"] == "succeeded" for job_id in job_ids)
+
+
+def test_sqlite_job_store_is_shared_between_processes(tmp_path):
+    path = str(tmp_path / "jobs.sqlite")
+    queue = StudyJobQueue(max_workers=1, store=SQLiteJobStore(path))
+    job = wait_for_job(queue, queue.submit("/study/a", "file.txt", lambda items: {"import_output": "done"}))
+    assert job["status"] == "succeeded"
+
+    other_worker_store = SQLiteJobStore(path)
+    assert other_worker_store.get(job["id"]) == job
+    assert other_worker_store.get("unknown") is None
+
+    # A job left running by a process that is gone is failed by the next worker starting
+    interrupted = other_worker_store.create("/study/b")
+    with sqlite3.connect(path) as connection:
+        connection.execute("UPDATE jobs SET pid_start_time = -1 WHERE id = ?", (interrupted["id"],))
+    assert SQLiteJobStore(path).fail_interrupted_jobs() == 1
+    assert other_worker_store.get(interrupted["id"])["status"] == "failed"
+    assert other_worker_store.get(job["id"])["status"] == "succeeded"
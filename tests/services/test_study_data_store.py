@@ -0,0 +1,57 @@
+import os
+
+import pandas as pd
+from app.services.study_data_store import upsert_data_file
+
+
+def test_upsert_replaces_rows_of_updated_keys(tmp_path):
+    data_path = str(tmp_path / "data_timeline_a.txt")
+    upsert_data_file("PATIENT_ID\tSTART_DATE\tEVENT_TYPE\nP1\t0\tA\nP1\t5\tB\nP2\t1\tA\n", data_path, ["PATIENT_ID"])
+    upsert_data_file("PATIENT_ID\tSTART_DATE\tEVENT_TYPE\nP1\t7\tC\nP3\t2\tA\n", data_path, ["PATIENT_ID"])
+
+    with open(data_path) as f:
+        assert f.read() == "PATIENT_ID\tSTART_DATE\tEVENT_TYPE\nP2\t1\tA\nP1\t7\tC\nP3\t2\tA\n"
+
+
+def test_upsert_matches_pandas_merge_semantics(tmp_path):
+    data_path = str(tmp_path / "data_resource_patient.txt")
+    upsert_data_file("PATIENT_ID\tRESOURCE_ID\tURL\nP1\tR1\tu1\nP1\tR2\tu2\n", data_path, ["PATIENT_ID", "RESOURCE_ID"])
+    upsert_data_file("PATIENT_ID\tRESOURCE_ID\tURL\nP1\tR2\tu3\nP1\tR2\tu3\n", data_path, ["PATIENT_ID", "RESOURCE_ID"])
+
+    df = pd.read_csv(data_path, sep='\t')
+    assert df.to_dict("records") == [{"PATIENT_ID": "P1", "RESOURCE_ID": "R1", "URL": "u1"},
+                                     {"PATIENT_ID": "P1", "RESOURCE_ID": "R2", "URL": "u3"}]
+
+
+def test_upsert_reseeds_after_external_change(tmp_path):
+    data_path = str(tmp_path / "data_timeline_a.txt")
+    upsert_data_file("PATIENT_ID\tDATA\nP1\ta\n", data_path, ["PATIENT_ID"])
+    with open(data_path, "w") as f:
+        f.write("PATIENT_ID\tDATA\nP2\tedited by hand\n")
+
+    upsert_data_file("PATIENT_ID\tDATA\nP3\tc\n", data_path, ["PATIENT_ID"])
+
+    with open(data_path) as f:
+        assert f.read() == "PATIENT_ID\tDATA\nP2\tedited by hand\nP3\tc\n"
+
+
+def test_upsert_adds_new_columns_and_overwrites_without_key_columns(tmp_path):
+    data_path = str(tmp_path / "data_timeline_a.txt")
+    with open(data_path, "w") as f:
+        f.write("DATA\nold\n")
+
+    upsert_data_file("PATIENT_ID\tDATA\nP1\ta\n", data_path, ["PATIENT_ID"])
+    upsert_data_file("PATIENT_ID\tDATA\tNOTE\nP2\tb\tn\n", data_path, ["PATIENT_ID"])
+
+    with open(data_path) as f:
+        assert f.read() == "PATIENT_ID\tDATA\tNOTE\nP1\ta\t\nP2\tb\tn\n"
+    assert os.path.exists(str(tmp_path / ".data_timeline_a.txt.sqlite"))
+
+
+def test_upsert_without_key_columns_overwrites_file(tmp_path):
+    data_path = str(tmp_path / "data_timeline_a.txt")
+    upsert_data_file("PATIENT_ID\tDATA\nP1\ta\n", data_path, ["PATIENT_ID"])
+    upsert_data_file("X\tD\nP1\ta\nP1\ta\nP2\tb\n", data_path, ["PATIENT_ID"])
+
+    with open(data_path) as f:
+        assert f.read() == "X\tD\nP1\ta\nP2\tb\n"
@@ -0,0 +1,63 @@
+import multiprocessing
+import os
+
+import pytest
+from fastapi import HTTPException
+from app.services.study_files import study_lock, write_file_atomic, get_study_lock_metrics, IMPORT_LOCK_FILE_NAME
+
+
+def hold_study_lock(study_directory_path, locked, release):
+    with study_lock(study_directory_path, timeout=5):
+        locked.set()
+        release.wait(10)
+
+
+def test_study_lock_excludes_other_processes(tmp_path):
+    context = multiprocessing.get_context("spawn")
+    locked, release = context.Event(), context.Event()
+    process = context.Process(target=hold_study_lock, args=(str(tmp_path), locked, release))
+    process.start()
+    try:
+        assert locked.wait(30)
+        timeouts = get_study_lock_metrics()["timeouts"]
+        with pytest.raises(HTTPException) as e:
+            with study_lock(str(tmp_path), timeout=0.2):
+                pass
+        assert e.value.status_code == 503
+        assert get_study_lock_metrics()["timeouts"] == timeouts + 1
+    finally:
+        release.set()
+        process.join(30)
+
+    contended = get_study_lock_metrics()["contended"]
+    with study_lock(str(tmp_path), timeout=1):
+        pass
+    assert get_study_lock_metrics()["contended"] == contended
+
+
+def test_import_lock_has_its_own_timeout_and_metrics(tmp_path):
+    study_metrics = get_study_lock_metrics()
+    import_timeouts = get_study_lock_metrics(IMPORT_LOCK_FILE_NAME)["timeouts"]
+    with study_lock(str(tmp_path), None, IMPORT_LOCK_FILE_NAME):
+        # Exports still write the study files while it is imported
+        with study_lock(str(tmp_path), timeout=0.2):
+            pass
+        with pytest.raises(HTTPException, match="Another import of the study"):
+            with study_lock(str(tmp_path), 0.1, IMPORT_LOCK_FILE_NAME):
+                pass
+
+    assert get_study_lock_metrics(IMPORT_LOCK_FILE_NAME)["timeouts"] == import_timeouts + 1
+    assert get_study_lock_metrics()["timeouts"] == study_metrics["timeouts"]
+    assert get_study_lock_metrics()["acquired"] == study_metrics["acquired"] + 1
+
+
+def test_write_file_atomic_keeps_mode(tmp_path):
+    file_path = str(tmp_path / "meta_timeline_a.txt")
+    write_file_atomic(file_path, "first")
+    os.chmod(file_path, 0o664)
+    write_file_atomic(file_path, "second")
+
+    with open(file_path) as f:
+        assert f.read() == "second"
+    assert os.stat(file_path).st_mode & 0o777 == 0o664
+    assert os.listdir(tmp_path) == ["meta_timeline_a.txt"]
@@ -0,0 +1,30 @@
+import json
+from pathlib import Path
+from unittest.mock import MagicMock, patch
+
+from app.services.xnat_common import get_xnat_labels
+
+env_vars = {"xnat_url": "http://xnat", "xnat_timeout": 5, "xnat_cache_ttl": 600}
+
+EXPERIMENT_UID = "1.3.6.1.4.1.14519.5.2.1.8421.4017.143112626223669848047982968345"
+
+
+def test_repeat_lookups_are_served_from_cache():
+    with open(Path(__file__).parent.parent / "test_data" / "test_xnat.json") as f:
+        subject_data = json.load(f)
+    project_data = {"items": [{"data_fields": {"secondary_ID": "TCGA-COAD"}}]}
+
+    def get(url, params, timeout):
+        assert timeout == 5
+        return MagicMock(json=lambda: subject_data if "/subjects/" in url else project_data)
+
+    session = MagicMock()
+    session.get.side_effect = get
+    with patch("app.services.xnat_common.get_xnat_session", return_value=session):
+        viewer_url = f"http://viewer.imaging.datacommons/viewer/{EXPERIMENT_UID}"
+        labels = get_xnat_labels(viewer_url, "cached_study", "cached_case", env_vars)
+        assert labels == ("10-31-2002-NA-CT-ABDOMEN-PELVIS-W-CONT-2-68345", "TCGA-COAD")
+        assert session.get.call_count == 2
+
+        assert get_xnat_labels(viewer_url, "cached_study", "cached_case", env_vars) == labels
+        assert session.get.call_count == 2